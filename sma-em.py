@@ -20,23 +20,40 @@
 """
 
 #  load necessary libraries
-import _thread
-import socket
-import struct
-import binascii
 import sdnotify
 import os, sys
+import ssl
+import asyncio
 import json
 import argparse
-import sdnotify
+import signal
 import threading
 from configparser import ConfigParser
-from uftools import print_line
-from smaem_decoder import decode_SMAEM
+from uftools import print_line, log
+from smaem_listener import SMAEMListener, MCAST_GRP, MCAST_PORT, DEFAULT_RCVBUF
+from smaem_decoder import sma_units
+from smaem_filters import StreamFilter
+from smaem_aggregator import WindowAggregator
+from smaem_payload import PayloadTemplate, SEPARATORS
+from smaem_scheduler import Scheduler
+from smaem_queue import OfflineQueue
+from smaem_recorder import Recorder
+from smaem_energy import EnergyTracker, energy_units
+from smaem_cache import DeviceCache, device_identity, identity_data
+from smaem_metrics import PublishTracker, PUBLISH_LATENCY_SECONDS, MQTT_INFLIGHT, MQTT_QUEUED, MQTT_CONNECTED, MQTT_RECONNECTS
+from smaem_exporter import MetricsExporter
+from smaem_diagnostics import Diagnostics, DIAGNOSTIC_SENSORS, METER_DIAGNOSTIC_SENSORS
+from smaem_capture import ReplaySource
+from smaem_pipeline import Pipeline, output_from_config, SOURCE_RAW
+from smaem_events import EventEngine, rule_from_config
+from smaem_shm import SnapshotWriter, DEFAULT_PATH as DEFAULT_SNAPSHOT_PATH, DEFAULT_SLOTS as DEFAULT_SNAPSHOT_SLOTS
+from smaem_discovery import DiscoveryManager, DEFAULT_BIRTH_TOPIC, DEFAULT_BATCH_SIZE
+from smaem_async import AsyncScheduler, AsyncMQTTHelper, listen
 from tzlocal import get_localzone
-from time import time, sleep, localtime, strftime
+from time import time, sleep, monotonic, perf_counter
 from datetime import datetime
 from collections import OrderedDict
+from operator import itemgetter
 import paho.mqtt.client as mqtt
 
 script_version = '1.0.4'
@@ -47,7 +64,7 @@ project_url = 'https://github.com/ufankhau/sma-em'
 
 if False:
     # will be caught by python 2.7 to be illegal syntax
-    print_line('Sorry, this script requries a python3 runtime environment.', file=sys.stderr)
+    print_line('Sorry, this script requries a python3 runtime environment.', error=True)
     os._exit(1)
 
 # construct the argument parse and parse the arguments
@@ -56,15 +73,20 @@ ap.add_argument("-v", "--verbose", help="increase output verbosity", action="sto
 ap.add_argument("-d", "--debug", help = "show debug output", action = "store_true")
 ap.add_argument("-l", "--logfile", help = "store log in logfile", action = "store_true")
 ap.add_argument("-c", "--config_dir", help = "set directory where config.ini is located", default=sys.path[0])
+ap.add_argument("-r", "--replay", help = "replay the telegrams of a capture file (see smaem_capture.py) instead of listening to the multicast group")
+ap.add_argument("--replay-speed", help = "speed of the replay, 1 = recorded rate, 0 = as fast as possible", type=float, default=1.0)
+ap.add_argument("--replay-repeat", help = "restart the replay at the end of the capture file", action = "store_true")
 args = vars(ap.parse_args())
 
 opt_verbose = args["verbose"]
 opt_debug = args["debug"]
 opt_logfile = args["logfile"]
 config_dir = args["config_dir"]
+opt_replay = args["replay"]
 
 #  -------------
-#  start logging
+#  start logging, the log file is set up once config.ini is read
+log.setup(verbose=opt_verbose, debug=opt_debug)
 print_line(script_info, info=True)
 if opt_verbose:
     print_line('Verbose enabled ...', info=True)
@@ -75,55 +97,71 @@ if opt_debug:
 #  ------------------
 #  set default values
 local_tz = get_localzone()
-smaserials = ''
 
 #  Systemd Service Notifications - https://github.com/bb4242/sdnotify
 sd_notifier = sdnotify.SystemdNotifier()
 
-def getDatafromSMAEnergyMeter():
-    #  --------------------------------------------------------------------
-    #  create socket to listen to UDP broadcasting on MCAST_GRP, MCAST_PORT
-    ipbind = '0.0.0.0'
-    MCAST_GRP = '239.12.255.254'
-    MCAST_PORT = 9522
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', MCAST_PORT))
-    try:
-        mreq = struct.pack("4s4s", socket.inet_aton(MCAST_GRP), socket.inet_aton(ipbind))
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        print_line('Successfully connected to multicast group', info=True)
-    except BaseException:
-        print_line('* SOCKET: could not connect to multicast group or bind to given interface', error=True)
-        sys.exit(1)
-    smaeminfo = sock.recv(1024)
-    #sock.shutdown()
-    sock.close()
-    sleep(0.3)
-    return decode_SMAEM(smaeminfo, opt_debug)
-
 #  ------------
 #  MQTT handler
 mqtt_client_connected = False
-print_line('* INIT mqtt_client_connected = [{}]'.format(mqtt_client_connected), debug=opt_debug)
+log.debug('* INIT mqtt_client_connected = [{}]', mqtt_client_connected)
 mqtt_client_should_attempt_reconnect = True
+mqtt_client_connects = 0
+#  set while connected, startup waits on it instead of polling mqtt_client_connected
+mqtt_connected_event = threading.Event()
+
+#  CONNACK result codes of a permanent refusal, reconnecting does not help
+MQTT_PERMANENT_REFUSALS = (1, 2, 4, 5)
 
 def onConnect(client, userdata, flags, rc):
-    global mqtt_client_connected
+    global mqtt_client_connected, mqtt_client_connects
     if rc == 0:
         print_line('* MQTT connection established', console=True, sd_notify=True)
         print_line('')
         mqtt_client_connected = True
-        print_line('on_connect() mqtt_client_connected = [{}]'.format(mqtt_client_connected), debug=opt_debug)
-    else:
+        mqtt_connected_event.set()
+        discovery.connected()
+        mqtt_client_connects += 1
+        if mqtt_client_connects > 1:
+            MQTT_RECONNECTS.inc()
+            publish_tracker.reset()
+        log.debug('on_connect() mqtt_client_connected = [{}]', mqtt_client_connected)
+        if offline_queue is not None and offline_queue.count:
+            scheduler.submit(replayOfflineQueue)
+    elif rc in MQTT_PERMANENT_REFUSALS:
         print_line('MQTT connection error with result code {} - {}'.format(str(rc), mqtt.connack_string(rc)), error=True, sd_notify=True)
         mqtt_client_connected = False
         print_line('on_connect() mqtt_client_connected = [{}]'.format(mqtt_client_connected), error=True)
         os._exit(1)
+    else:
+        #  e.g. broker restarting, paho keeps reconnecting
+        print_line('MQTT connection refused with result code {} - {}, retrying ...'.format(str(rc), mqtt.connack_string(rc)), warning=True, sd_notify=True)
+        mqtt_client_connected = False
+
+def onDisconnect(client, userdata, rc):
+    global mqtt_client_connected
+    mqtt_client_connected = False
+    mqtt_connected_event.clear()
+    discovery.disconnected()
+    if rc != 0:
+        print_line('* MQTT connection lost with result code {}, reconnecting ...'.format(rc), warning=True, sd_notify=True)
 
 def onPublish(client, userdata, mid):
-    print_line('* Data successfully published.', info=True)
-    pass
+    log.debug('* Data successfully published (mid {})', mid)
+    publish_tracker.acknowledged(mid)
+    if mid in replay_mids and offline_queue.count:
+        scheduler.submit(replayOfflineQueue)
+
+#  time from publish to the acknowledgement of the broker (or the socket write for QoS 0)
+publish_tracker = PublishTracker(PUBLISH_LATENCY_SECONDS)
+MQTT_INFLIGHT.set_function(publish_tracker.pending)
+MQTT_CONNECTED.set_function(lambda: 1 if mqtt_client_connected else 0)
+
+def publishTracked(topic, payload=None, qos=0, retain=False):
+    started = perf_counter()
+    info = mqtt_client.publish(topic, payload, qos, retain=retain)
+    publish_tracker.published(info.mid, started)
+    return info
 
 #  load configuration file config.ini
 config = ConfigParser(delimiters=('=', ), inline_comment_prefixes=('#'))
@@ -135,6 +173,27 @@ except IOError:
     print_line('No configuration file "config.ini" found in directory {}'.format(config_dir), error=True)
     sys.exit(1)
 
+#  optional sections may be missing in older configuration files
+for section in ('Log', 'Daemon', 'Listener', 'Stream', 'Aggregate', 'Events', 'Energy', 'Recorder', 'Exporter', 'Snapshot', 'Diagnostics', 'MQTT'):
+    if not config.has_section(section):
+        config.add_section(section)
+
+#  logging: log file (enabled by -l or [Log] enable) and journald output
+log_file_enabled = opt_logfile or config['Log'].getboolean('enable', False)
+log_file_path = config['Log'].get('path', '/var/log/sma-em.log')
+log_file_max_bytes = config['Log'].getint('max_size_in_kb', 1024) * 1024
+log_file_backup_count = config['Log'].getint('backup_count', 3)
+log_journal = config['Log'].get('journal', 'auto').lower()
+if log_journal not in ('auto', 'true', 'false'):
+    print_line('ERROR: Invalid "journal" in section [Log] of configuration file "config.ini"! Value must be "auto", "true" or "false". Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+try:
+    log.setup(verbose=opt_verbose, debug=opt_debug, journal=None if log_journal == 'auto' else log_journal == 'true',
+        logfile=log_file_path if log_file_enabled else None, max_bytes=log_file_max_bytes, backup_count=log_file_backup_count)
+except OSError as e:
+    print_line('ERROR: Could not open log file {}: {}'.format(log_file_path, e), error=True, sd_notify=True)
+    sys.exit(1)
+
 daemon_enabled = config['Daemon'].getboolean('enabled', True)
 
 default_base_topic = 'home/nodes'
@@ -144,62 +203,212 @@ default_sensor_name = 'smaem'
 sensor_name = config['MQTT'].get('sensor_name', default_sensor_name).lower()
 
 default_discovery_prefix = 'homeassistant'
-discovery_prefix = config['MQTT'].get('discovery_previx', default_discovery_prefix).lower()
+#  "discovery_previx" is the key read by earlier versions of this script
+discovery_prefix = config['MQTT'].get('discovery_prefix', config['MQTT'].get('discovery_previx', default_discovery_prefix)).lower()
+#  birth message of Home Assistant, the discovery configs are checked when it comes online
+birth_topic = config['MQTT'].get('birth_topic', DEFAULT_BIRTH_TOPIC)
+discovery_batch_size = config['MQTT'].getint('discovery_batch_size', DEFAULT_BATCH_SIZE)
 
-#  requency of reporting data from SMA Energy Meter
-min_interval_in_seconds = 20
+#  requency of reporting data from SMA Energy Meter, on the wall clock or on the clock
+#  of the meter (timestamp of its telegrams), which allows reports down to every telegram
+report_clock = config['Daemon'].get('report_clock', 'wall').lower()
+min_interval_in_seconds = 20 if report_clock == 'wall' else 0
 max_interval_in_seconds = 300
 default_interval_in_seconds = 60
-interval_in_seconds = config['Daemon'].getint('interval_in_seconds', default_interval_in_seconds)
+if report_clock == 'wall':
+    interval_in_seconds = config['Daemon'].getint('interval_in_seconds', default_interval_in_seconds)
+else:
+    interval_in_seconds = config['Daemon'].getfloat('interval_in_seconds', default_interval_in_seconds)
+report_interval_ms = int(round(interval_in_seconds * 1000))
+
+#  local time-series recorder of all telegrams or of the aggregates of every report
+recorder_enabled = config['Recorder'].getboolean('enabled', False)
+recorder_path = config['Recorder'].get('path', '/var/lib/sma-em/recorder')
+recorder_source = config['Recorder'].get('source', 'telegrams').lower()
+recorder_channels = config['Recorder'].get('channels', 'all').replace(',', ' ').split()
+if recorder_channels == ['all']:
+    recorder_channels = [channel for channel in sma_units if channel != 'speedwire_version']
+recorder_flush_interval = config['Recorder'].getint('flush_interval_in_seconds', 60)
+
+#  Prometheus endpoint
+exporter_enabled = config['Exporter'].getboolean('enabled', False)
+exporter_address = config['Exporter'].get('address', '0.0.0.0')
+exporter_port = config['Exporter'].getint('port', 9523)
+
+#  latest values of every meter in shared memory for local processes
+snapshot_enabled = config['Snapshot'].getboolean('enabled', False)
+snapshot_path = config['Snapshot'].get('path', DEFAULT_SNAPSHOT_PATH)
+snapshot_slots = config['Snapshot'].getint('slots', DEFAULT_SNAPSHOT_SLOTS)
+
+#  self-diagnostics published to MQTT
+diagnostics_enabled = config['Diagnostics'].getboolean('enabled', False)
+diagnostics_interval = config['Diagnostics'].getint('interval_in_seconds', 60)
+diagnostics_discovery = config['Diagnostics'].getboolean('discovery', True)
+
+#  store-and-forward queue for reports that can not be published while the broker is unreachable
+offline_queue_path = config['MQTT'].get('offline_queue', '')
+offline_queue_size = config['MQTT'].getint('offline_queue_size', 100000)
+offline_replay_window = config['MQTT'].getint('offline_replay_window', 10)
+
+#  additional outputs in [Output:<name>] sections: other MQTT brokers, udp relay of the raw
+#  telegrams, files and unix sockets, each with its own stages and queue
+pipeline = Pipeline()
+for section in config.sections():
+    if section.startswith('Output:'):
+        try:
+            pipeline.add(*output_from_config(section[len('Output:'):].strip(), config[section]))
+        except ValueError as e:
+            print_line('ERROR: Invalid section [{}] in configuration file "config.ini": {}. Fix it and try again ... aborting'.format(section, e), error=True, sd_notify=True)
+            sys.exit(1)
+
+#  edge-triggered events in [Event:<name>] sections: thresholds, sign of the net power,
+#  overcurrent of a phase and deviation of the grid frequency, checked on every telegram
+event_conditions = []
+for section in config.sections():
+    if section.startswith('Event:'):
+        try:
+            event_conditions += rule_from_config(section[len('Event:'):].strip(), config[section])
+        except ValueError as e:
+            print_line('ERROR: Invalid section [{}] in configuration file "config.ini": {}. Fix it and try again ... aborting'.format(section, e), error=True, sd_notify=True)
+            sys.exit(1)
+events_qos = config['Events'].getint('qos', 1)
+events_report = config['Events'].getboolean('report', False)
+
+#  receive the telegrams from the multicast group, joined on one or more interfaces, or relayed
+#  by another instance to a unicast port
+listener_source = config['Listener'].get('source', 'multicast').lower()
+listener_interfaces = config['Listener'].get('interfaces', '0.0.0.0').replace(',', ' ').split()
+listener_group = config['Listener'].get('group', MCAST_GRP)
+listener_address = config['Listener'].get('address', '0.0.0.0').replace(',', ' ').split()
+listener_port = config['Listener'].getint('port', MCAST_PORT)
+listener_rcvbuf = config['Listener'].getint('rcvbuf_in_kb', DEFAULT_RCVBUF // 1024) * 1024
+listener_dedup = config['Listener'].get('dedup', 'auto').lower()
+
+#  only relay the raw telegrams to the udp outputs, without decoding, MQTT and reports
+relay_only = config['Daemon'].getboolean('relay_only', False)
+
+#  run the daemon with threads or on an asyncio event loop
+event_loop = config['Daemon'].get('event_loop', 'threads').lower()
+
+#  serial numbers of the devices to report, all devices on the multicast group if empty
+smaserials = [int(serial) for serial in config['Daemon'].get('serials', '').replace(',', ' ').split()]
+
+#  channels of the meter to report as Home Assistant sensors, see "sma_channels" in smaem_decoder.py
+report_channels = config['Daemon'].get('channels', '').replace(',', ' ').split()
+if report_channels == ['all']:
+    report_channels = [channel for channel in sma_units if channel != 'speedwire_version']
+topic_per_channel = config['Daemon'].getboolean('topic_per_channel', False)
+
+#  streaming of live values at the rate of the telegrams, filtered by deadband and rate limit
+default_stream_channels = 'p_consume, p_supply, p1_consume, p1_supply, p2_consume, p2_supply, p3_consume, p3_supply'
+stream_enabled = config['Stream'].getboolean('enabled', False)
+stream_channels = config['Stream'].get('channels', default_stream_channels).replace(',', ' ').split()
+stream_deadband = config['Stream'].getfloat('deadband', 0.0)
+stream_max_rate = config['Stream'].getfloat('max_rate', 0.0)
+stream_heartbeat = config['Stream'].getfloat('heartbeat_in_seconds', 60.0)
+stream_qos = config['Stream'].getint('qos', 0)
+
+#  aggregation of all telegrams between two reports (min/max/mean/last and counter deltas)
+aggregate_enabled = config['Aggregate'].getboolean('enabled', False)
+aggregate_channels = config['Aggregate'].get('channels', 'p_consume, p_supply').replace(',', ' ').split()
+aggregate_counters = config['Aggregate'].get('counters', 'p_consume_counter, p_supply_counter').replace(',', ' ').split()
+
+#  identity (firmware version, channels) of the devices of the last run, to announce them
+#  right after the connection to the broker instead of after their first telegram
+cache_file = config['Daemon'].get('cache_file', '/var/lib/sma-em/devices.json')
+
+#  energy and average power per report from the raw counters
+energy_enabled = config['Energy'].getboolean('enabled', False)
+energy_counters = config['Energy'].get('counters', 'all').replace(',', ' ').split()
+if energy_counters == ['all']:
+    energy_counters = [channel for channel in sma_units if channel.endswith('_counter')]
+energy_state_file = config['Energy'].get('state_file', '/var/lib/sma-em/energy.json')
 
 #  check configuration
+for channel in report_channels + stream_channels + aggregate_channels + aggregate_counters + recorder_channels:
+    if channel not in sma_units:
+        print_line('ERROR: Invalid channel "{}" in section [Daemon], [Stream], [Aggregate] or [Recorder] of configuration file "config.ini"! Fix it and try again ... aborting'.format(channel), error=True, sd_notify=True)
+        sys.exit(1)
+for counter in energy_counters:
+    if counter not in sma_units or not counter.endswith('_counter'):
+        print_line('ERROR: Invalid counter "{}" in section [Energy] of configuration file "config.ini"! Fix it and try again ... aborting'.format(counter), error=True, sd_notify=True)
+        sys.exit(1)
 if (interval_in_seconds < min_interval_in_seconds) or (interval_in_seconds > max_interval_in_seconds):
     print_line('ERROR: Invalid "interval_in_seconds" found in configuration file "config.ini"! Value must be between [{} - {}]. Fix it and try again ... aborting'.format(min_interval_in_seconds, max_interval_in_seconds), error=True, sd_notify=True)
     sys.exit(1)
-if not config['MQTT']:
+if recorder_source not in ('telegrams', 'aggregates') or (recorder_enabled and recorder_source == 'aggregates' and not aggregate_enabled):
+    print_line('ERROR: Invalid "source" in section [Recorder] of configuration file "config.ini"! Value must be "telegrams" or "aggregates" (requires [Aggregate] enabled). Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if snapshot_slots < 1 or snapshot_slots > 256:
+    print_line('ERROR: Invalid "slots" in section [Snapshot] of configuration file "config.ini"! Value must be between [1 - 256]. Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if report_clock not in ('wall', 'meter'):
+    print_line('ERROR: Invalid "report_clock" found in configuration file "config.ini"! Value must be "wall" or "meter". Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if event_loop not in ('threads', 'asyncio'):
+    print_line('ERROR: Invalid "event_loop" found in configuration file "config.ini"! Value must be "threads" or "asyncio". Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if listener_source not in ('multicast', 'unicast'):
+    print_line('ERROR: Invalid "source" in section [Listener] of configuration file "config.ini"! Value must be "multicast" or "unicast". Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if listener_dedup not in ('auto', 'true', 'false'):
+    print_line('ERROR: Invalid "dedup" in section [Listener] of configuration file "config.ini"! Value must be "auto", "true" or "false". Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if relay_only and not pipeline.routes[SOURCE_RAW]:
+    print_line('ERROR: "relay_only" requires an [Output:<name>] section of type udp in configuration file "config.ini"! Fix it and try again ... aborting', error=True, sd_notify=True)
+    sys.exit(1)
+if not config['MQTT'] and not relay_only:
     print_line('ERROR: No MQTT settings found in configuration file "config.ini"! Fix it and try again ... aborting', error=True, sd_notify=True)
     sys.exit(1)
 
 print_line('MQTT configuration accepted', console=True, sd_notify=True)
 
 
+#  ---------------------------------------------------------------
+#  persistent listener on the multicast group of the Energy Meter(s)
+#  (joins the group once and keeps the latest decoded telegram per device)
+listener = SMAEMListener(listener_address if listener_source == 'unicast' else listener_interfaces,
+    None if listener_source == 'unicast' else listener_group, listener_port, serials=smaserials, opt_debug=opt_debug,
+    decode=not relay_only, rcvbuf=listener_rcvbuf, dedup=None if listener_dedup == 'auto' else listener_dedup == 'true')
+
+def openListenerFailed():
+    print_line('* SOCKET: could not connect to multicast group or bind to given interface', error=True)
+    sys.exit(1)
+
+#  a snapshot older than this is considered stale and is not reported
+max_snapshot_age_in_seconds = 10
+
+def getDatafromSMAEnergyMeter(serial):
+    #  (em_data, time received) of the latest telegram of a device
+    return listener.snapshot(serial, max_age=max_snapshot_age_in_seconds)
+
+
+#  ---------------------------------------------------------------
+#  scheduler running period reports, alive pings and publishes on a
+#  fixed, small set of worker threads, or on the asyncio event loop
+if event_loop == 'asyncio':
+    scheduler = AsyncScheduler(opt_debug=opt_debug)
+else:
+    scheduler = Scheduler(workers=2, opt_debug=opt_debug)
+
 #  ---------------------------------------------------------
-#  timer and timer functions for ALIVE MQTT Notices handling
+#  job for ALIVE MQTT Notices handling
 ALIVE_TIMEOUT_IN_SECONDS = 60
 
 def publishAliveStatus():
-    print_line('- SEND: yes, still alive -', debug=opt_debug)
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
-
-def aliveTimeoutHandler():
-    print_line('- MQTT timer interrupt -', debug=opt_debug)
-    _thread.start_new_thread(publishAliveStatus, ())
-    startAliveTimer()
+    log.debug('- SEND: yes, still alive -')
+    publishTracked(lwt_topic, payload=lwt_online_val, retain=False)
 
 def startAliveTimer():
-    global aliveTimer
-    global aliveTimerRunningsStatus
-    stopAliveTimer()
-    aliveTimer = threading.Timer(ALIVE_TIMEOUT_IN_SECONDS, aliveTimeoutHandler)
-    aliveTimer.start()
-    aliveTimerRunningStatus = True
-    print_line('- started MQTT timer - every {} seconds'.format(ALIVE_TIMEOUT_IN_SECONDS), debug=opt_debug)
+    global aliveJob
+    aliveJob = scheduler.every(ALIVE_TIMEOUT_IN_SECONDS, publishAliveStatus, name='alive')
 
 def stopAliveTimer():
-    global aliveTimer
-    global aliveTimerRunningsStatus
-    aliveTimer.cancel()
-    aliveTimerRunningStatus = False
-    print_line('- stopped MQTT timer', debug=opt_debug)
-
-def isAliveTimerRunning():
-    global aliveTimerRunningStatus
-    return aliveTimerRunningsStatus
+    if aliveJob is not None:
+        aliveJob.cancel()
+    log.debug('- stopped MQTT timer')
 
-#  alive timer
-aliveTimer = threading.Timer(ALIVE_TIMEOUT_IN_SECONDS, aliveTimeoutHandler)
-# bool tracking state of alive timer
-aliveTimerRunningsStatus = False
+aliveJob = None
 
 #  ----------------------
 #  MQTT setup and startup
@@ -207,10 +416,14 @@ lwt_topic = '{}/sensor/{}/status'.format(base_topic, sensor_name.lower())
 lwt_online_val = 'online'
 lwt_offline_val = 'offline'
 
-print_line('Connecting to MQTT broker ...', verbose=opt_verbose)
 mqtt_client = mqtt.Client()
 mqtt_client.on_connect = onConnect
 mqtt_client.on_publish = onPublish
+mqtt_client.on_disconnect = onDisconnect
+
+#  retained discovery configs, only missing or changed ones are published
+discovery = DiscoveryManager(mqtt_client, publishTracked, birth_topic, discovery_batch_size, on_online=publishAliveStatus)
+mqtt_client.on_message = discovery.on_message
 
 mqtt_client.will_set(lwt_topic, payload=lwt_offline_val, retain=True)
 
@@ -227,28 +440,14 @@ mqtt_password = os.environ.get('MQTT_PASSWROD', config['MQTT'].get('password', N
 
 if mqtt_username:
     mqtt_client.username_pw_set(mqtt_username, mqtt_password)
-try:
-    mqtt_client.connect(os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost')), port=int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883'))), keepalive=config['MQTT'].getint('keepalive', 60))
-except:
-    print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
-    sys.exit(1)
-else:
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
-    mqtt_client.loop_start()
-    while mqtt_client_connected == False:
-        print_line('* Wait on mqtt_client_connected = [{}]'.format(mqtt_client_connected), debug=opt_debug)
-        sleep(1.0)   # some c^slack to estabish the connection
-    startAliveTimer()
 
-sd_notifier.notify('READY=1')
-
-#  performe MQTT discovery announcement
-#  create uniqID using the unique serial number of the SMA Energy Meter
-emdata = {}
-emdata = getDatafromSMAEnergyMeter()
-serial = str(emdata['serial'])
-uniqID = 'SMA-{}EM{}'.format(serial[:5], serial[5:])
-print_line('uniqID: {}'.format(uniqID), debug=opt_debug)
+def connectMQTT():
+    try:
+        mqtt_client.connect(os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost')), port=int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883'))), keepalive=config['MQTT'].getint('keepalive', 60))
+    except:
+        print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
+        sys.exit(1)
+    publishTracked(lwt_topic, payload=lwt_online_val, retain=False)
 
 #  SMA Energy Meter reporting device
 LD_MONITOR = 'monitor'
@@ -256,151 +455,669 @@ LD_ENERGY_CONSUME = 'grid_consume_total'
 LD_ENERGY_SUPPLY = 'grid_supply_total'
 LDS_PAYLOAD_NAME = 'info'
 
-#  table of key items to publish:
+#  table of key items to publish per device:
 detectorValues = OrderedDict([
-    (LD_MONITOR, dict(title='SMA Energy Meter Monitor', device_class='timestamp', no_title_prefix='yes', json_value='timestamp', json_attr='yes', icon='mdi:counter', device_ident='SMA-EM-{}'.format(emdata['serial']))),
+    (LD_MONITOR, dict(title='SMA Energy Meter Monitor', device_class='timestamp', no_title_prefix='yes', json_value='timestamp', json_attr='yes', icon='mdi:counter', device_ident='SMA-EM-{}')),
     (LD_ENERGY_CONSUME, dict(title='Grid Consume', device_class='energy', state_class='total', no_title_prefix='yes', json_value='grid_consume_total', unit='kWh', icon='mdi:counter')),
     (LD_ENERGY_SUPPLY, dict(title='Grid Supply', device_class='energy', state_class='total', no_title_prefix='yes', json_value='grid_supply_total', unit='kWh', icon='mdi:counter')),
 ])
-print_line('Announcing SMA Energy Meter to MQTT broker for auto-discovery ...')
 
+#  versions for a single meter announced its sensors below {discovery_prefix}/sensor/{sensor_name}, with
+#  the unique_ids used now below {discovery_prefix}/sensor/{sensor_name}_{serial}: remove these configs
+discovery.clear(['{}/sensor/{}/{}/config'.format(discovery_prefix, sensor_name.lower(), sensor) for sensor in (LD_MONITOR, LD_ENERGY_CONSUME, LD_ENERGY_SUPPLY)])
+
+#  Home Assistant device classes of the units in "sma_units"
+ha_device_classes = {
+    'W': 'power',
+    'VA': 'apparent_power',
+    'VAr': 'reactive_power',
+    'kWh': 'energy',
+    'A': 'current',
+    'V': 'voltage',
+    'Hz': 'frequency',
+    '': 'power_factor',
+}
+
+#  icons of the units in "sma_units"
+ha_icons = {
+    'W': 'mdi:flash',
+    'VA': 'mdi:flash',
+    'VAr': 'mdi:flash',
+    'kWh': 'mdi:counter',
+    'kVAh': 'mdi:counter',
+    'kVArh': 'mdi:counter',
+    'A': 'mdi:current-ac',
+    'V': 'mdi:sine-wave',
+    'Hz': 'mdi:sine-wave',
+    '': 'mdi:angle-acute',
+}
+
+def channelSensorParams(channel):
+    #  sensor of a channel of the meter, generated from the channel table
+    unit = sma_units[channel]
+    params = dict(title=channel.replace('_', ' '), no_title_prefix='yes', channel=channel, icon=ha_icons[unit])
+    if channel.endswith('_counter'):
+        params['state_class'] = 'total_increasing'
+    else:
+        params['state_class'] = 'measurement'
+    if ha_device_classes.get(unit):
+        params['device_class'] = ha_device_classes[unit]
+    if unit:
+        params['unit'] = unit
+    if topic_per_channel:
+        params['state_topic'] = '~/{}'.format(channel)
+    else:
+        params['json_value'] = channel
+    return params
+
+for channel in report_channels:
+    detectorValues[channel] = channelSensorParams(channel)
+
+#  sensors of the aggregated values (mean of each channel and delta of each counter per window)
+if aggregate_enabled:
+    for channel in aggregate_channels:
+        unit = sma_units[channel]
+        params = dict(title='{} mean'.format(channel.replace('_', ' ')), state_class='measurement', no_title_prefix='yes', json_value='{}_mean'.format(channel), icon='mdi:chart-bell-curve')
+        if ha_device_classes.get(unit):
+            params['device_class'] = ha_device_classes[unit]
+        if unit:
+            params['unit'] = unit
+        detectorValues['{}_mean'.format(channel)] = params
+    for counter in aggregate_counters:
+        detectorValues['{}_delta'.format(counter)] = dict(title='{} delta'.format(counter.replace('_', ' ')), state_class='measurement', no_title_prefix='yes', json_value='{}_delta'.format(counter), unit=sma_units[counter], icon='mdi:delta')
+
+#  sensors of the energy and average power of each counter per report
+if energy_enabled:
+    for counter in energy_counters:
+        (energy_unit, power_unit) = energy_units(counter)
+        name = counter[:-len('_counter')].replace('_', ' ')
+        #  no device class: Home Assistant takes energy sensors only as totals, not as the energy of one report
+        detectorValues['{}_energy'.format(counter)] = dict(title='{} energy'.format(name), state_class='measurement', no_title_prefix='yes',
+            json_value='{}_energy'.format(counter), unit=energy_unit, icon='mdi:counter')
+        params = dict(title='{} average power'.format(name), state_class='measurement', no_title_prefix='yes', json_value='{}_power'.format(counter), unit=power_unit, icon='mdi:chart-bell-curve')
+        if ha_device_classes.get(power_unit):
+            params['device_class'] = ha_device_classes[power_unit]
+        detectorValues['{}_power'.format(counter)] = params
+
+#  NOTE: every device gets its own topics below the base topic, constructed as:
+#  {base_topic}/sensor/{sensor_name}/{serial}/monitor
 base_topic = '{}/sensor/{}'.format(base_topic, sensor_name.lower())
 values_topic_rel = '{}/{}'.format('~', LD_MONITOR)
-values_topic = '{}/{}'.format(base_topic, LD_MONITOR)
-activity_topic_rel = '{}/status'.format('~')
 activity_topic = '{}/status'.format(base_topic)
+diagnostics_topic = '{}/diagnostics'.format(base_topic)
 command_topic_rel = '~/set'
 
-print_line('base topic: {}'.format(base_topic), debug=opt_debug)
-print_line('values topic rel: {}'.format(values_topic_rel), debug=opt_debug)
-print_line('values topic: {}'.format(values_topic), debug=opt_debug)
-print_line('activity topic rel: {}'.format(activity_topic_rel), debug=opt_debug)
-print_line('activity topic: {}'.format(activity_topic), debug=opt_debug)
+log.debug('base topic: {}', base_topic)
+log.debug('values topic rel: {}', values_topic_rel)
+log.debug('activity topic: {}', activity_topic)
 
-for [sensor, params] in detectorValues.items():
-    discovery_topic = '{}/sensor/{}/{}/config'.format(discovery_prefix, sensor_name.lower(), sensor)
-    print_line('discovery topic: {}'.format(discovery_topic), debug=opt_debug)
-    payload = OrderedDict()
-    if 'no_title_prefix' in params:
-        payload['name'] = '{}'.format(params['title'].title())
+#  ---------------------------------------------------------------
+#  per device state, keyed by serial number of the device
+devices = {}
+devices_lock = threading.Lock()
+
+def prepareReport(device, emdata):
+    #  pre-serialize the static part of the reports of a device, only channels
+    #  sent by the firmware of the device are reported
+    channels = [channel for channel in report_channels if channel in emdata]
+    keys = ['p_consume_counter', 'p_supply_counter'] + channels
+    device['report_values'] = itemgetter(*keys)
+    device['report_channels'] = channels
+    device['channel_topics'] = ['{}/{}'.format(device['device_topic'], channel) for channel in channels]
+    #  time of the report, time the telegram was received and timestamp (ms) of the meter
+    time_keys = ['timestamp', 'received', 'meter_timestamp']
+    if topic_per_channel:
+        device['report_template'] = PayloadTemplate(time_keys + [LD_ENERGY_CONSUME, LD_ENERGY_SUPPLY], LDS_PAYLOAD_NAME, string_keys=('timestamp', 'received'))
     else:
-        payload['name'] = '{} {}'.format(sensor_name.title(), params['title'].title())
-    payload['uniq_id'] = '{}_{}'.format(uniqID, sensor.lower())
-    if 'device_class' in params:
-        payload['dev_cla'] = params['device_class']
-    if 'state_class' in params:
-        payload['stat_cla'] = params['state_class']
-    if 'unit' in params:
-        payload['unit_of_measurement'] = params['unit']
-    if 'icon' in params:
-        payload['ic'] = params['icon']
-    if 'json_value' in params:
-        payload['stat_t'] = values_topic_rel
-        payload['val_tpl'] = '{{{{ value_json.{}.{} }}}}'.format(LDS_PAYLOAD_NAME, params['json_value'])
-    payload['~'] = base_topic
+        device['report_template'] = PayloadTemplate(time_keys + [LD_ENERGY_CONSUME, LD_ENERGY_SUPPLY] + channels, LDS_PAYLOAD_NAME, string_keys=('timestamp', 'received'))
+
+def announceDevice(serial, emdata):
+    #  performe MQTT discovery announcement of a new device, or again if the identity
+    #  (firmware version, channels) of a device announced from the cache changed
+    #  create uniqID using the unique serial number of the SMA Energy Meter
+    identity = device_identity(emdata)
+    with devices_lock:
+        device = devices.get(serial)
+        if device is not None and device['identity'] == identity:
+            return
+        if device is None:
+            serial_str = str(serial)
+            device = dict(
+                serial = serial,
+                uniqID = 'SMA-{}EM{}'.format(serial_str[:5], serial_str[5:]),
+                device_topic = '{}/{}'.format(base_topic, serial),
+            )
+            device['values_topic'] = '{}/{}'.format(device['device_topic'], LD_MONITOR)
+            device['live_topic'] = '{}/live'.format(device['values_topic'])
+            device['event_topic'] = '{}/event'.format(device['values_topic'])
+        device['identity'] = identity
+        prepareReport(device, emdata)
+        devices[serial] = device
+    if device_cache is not None:
+        device_cache.update(serial, identity)
+    uniqID = device['uniqID']
+    print_line('Announcing SMA device {} to MQTT broker for auto-discovery ...'.format(serial))
+    log.debug('uniqID: {}', uniqID)
+    log.debug('values topic: {}', device['values_topic'])
+
+    configs = OrderedDict()
+    for [sensor, params] in detectorValues.items():
+        if 'channel' in params and params['channel'] not in emdata:
+            #  channel not sent by the firmware of this device
+            continue
+        discovery_topic = '{}/sensor/{}_{}/{}/config'.format(discovery_prefix, sensor_name.lower(), serial, sensor)
+        log.debug('discovery topic: {}', discovery_topic)
+        payload = OrderedDict()
+        if 'no_title_prefix' in params:
+            payload['name'] = '{}'.format(params['title'].title())
+        else:
+            payload['name'] = '{} {}'.format(sensor_name.title(), params['title'].title())
+        payload['uniq_id'] = '{}_{}'.format(uniqID, sensor.lower())
+        if 'device_class' in params:
+            payload['dev_cla'] = params['device_class']
+        if 'state_class' in params:
+            payload['stat_cla'] = params['state_class']
+        if 'unit' in params:
+            payload['unit_of_measurement'] = params['unit']
+        if 'icon' in params:
+            payload['ic'] = params['icon']
+        if 'state_topic' in params:
+            payload['stat_t'] = params['state_topic']
+        if 'json_value' in params:
+            payload['stat_t'] = values_topic_rel
+            payload['val_tpl'] = '{{{{ value_json.{}.{} }}}}'.format(LDS_PAYLOAD_NAME, params['json_value'])
+        payload['~'] = device['device_topic']
+        payload['pl_avail'] = lwt_online_val
+        payload['pl_not_avail'] = lwt_offline_val
+        payload['avty_t'] = activity_topic
+        if 'json_attr' in params:
+            payload['json_attr_t'] = values_topic_rel
+            payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
+        if 'device_ident' in params:
+            payload['dev'] = {
+                'identifiers' : ['{}'.format(uniqID)],
+                'manufacturer' : 'SMA Solar Technology AG',
+                'name' : params['device_ident'].format(serial),
+                'model' : 'Energy Meter',
+                'sw_version' : '{}'.format(emdata.get('speedwire_version', ''))
+            }
+        else:
+            payload['dev'] = {
+                'identifiers' : ['{}'.format(uniqID)]
+            }
+
+        log.debug('payload: {}', payload)
+        configs[discovery_topic] = json.dumps(payload)
+
+    if diagnostics_enabled and diagnostics_discovery:
+        for (key, title, unit, icon) in METER_DIAGNOSTIC_SENSORS:
+            configs.update([diagnosticSensorConfig('{}_{}'.format(sensor_name.lower(), serial), key, '{} {} {}'.format(sensor_name.title(), serial, title),
+                '{}_{}'.format(uniqID, key), "{{{{ value_json.meters['{}'].{} }}}}".format(serial, key), unit, icon, {'identifiers' : [uniqID]})])
+    discovery.update(serial, configs)
+
+#  ---------------------------------------------------------------
+#  self-diagnostics of the daemon
+diagnostics = Diagnostics()
+diagnostics_uniqID = 'SMA-EM-{}-daemon'.format(sensor_name.lower())
+
+def diagnosticSensorConfig(node, key, name, uniq_id, value_template, unit, icon, dev):
+    #  (topic, payload) of the discovery config of a diagnostic sensor
+    payload = OrderedDict()
+    payload['name'] = name
+    payload['uniq_id'] = uniq_id
+    payload['ent_cat'] = 'diagnostic'
+    payload['stat_t'] = diagnostics_topic
+    payload['val_tpl'] = value_template
+    if unit is not None:
+        payload['unit_of_measurement'] = unit
+        payload['stat_cla'] = 'measurement'
+    payload['ic'] = icon
     payload['pl_avail'] = lwt_online_val
     payload['pl_not_avail'] = lwt_offline_val
-    payload['avty_t'] = activity_topic_rel
-    if 'json_attr' in params:
-        payload['json_attr_t'] = values_topic_rel
-        payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
-    if 'device_ident' in params:
-        payload['dev'] = {
-            'identifiers' : ['{}'.format(uniqID)],
-            'manufacturer' : 'SMA Solar Technology AG',
-            'name' : params['device_ident'],
-            'model' : 'Energy Meter',
-            'sw_version' : '{}'.format(emdata['speedwire_version'])
-        }
-    else:
-        payload['dev'] = {
-            'identifiers' : ['{}'.format(uniqID)]
-        }
-    
-    print_line('payload: {}'.format(payload), debug=opt_debug)
-    mqtt_client.publish(discovery_topic, json.dumps(payload), 1, retain=True)
+    payload['avty_t'] = activity_topic
+    payload['dev'] = dev
+    return ('{}/sensor/{}/{}/config'.format(discovery_prefix, node, key), json.dumps(payload))
+
+def announceDiagnostics():
+    #  sensors of the daemon, the sensors of every meter are announced with the meter
+    device = {
+        'identifiers' : [diagnostics_uniqID],
+        'manufacturer' : 'ufankhau',
+        'name' : '{} Daemon'.format(sensor_name.title()),
+        'model' : script_name,
+        'sw_version' : script_version
+    }
+    discovery.update('daemon', OrderedDict(diagnosticSensorConfig('{}_daemon'.format(sensor_name.lower()), key, '{} {}'.format(sensor_name.title(), title),
+        '{}_{}'.format(diagnostics_uniqID, key), '{{{{ value_json.{} }}}}'.format(key), unit, icon, device) for (key, title, unit, icon) in DIAGNOSTIC_SENSORS))
+
+def publishDiagnostics():
+    publishTracked(diagnostics_topic, json.dumps(diagnostics.collect(), separators=SEPARATORS), 0, retain=False)
+
+#  ---------------------------------------------------------------
+#  streaming of live values, called by the listener for every telegram
+def streamLiveValues(serial, emdata):
+    device = devices.get(serial)
+    if device is None:
+        return
+    changed = stream_filter.update(serial, emdata, monotonic())
+    if changed:
+        changed['timestamp'] = emdata['timestamp']
+        publishTracked(device['live_topic'], json.dumps(changed, separators=SEPARATORS), stream_qos, retain=False)
+
+if stream_enabled:
+    stream_filter = StreamFilter(stream_channels, stream_deadband, stream_max_rate, stream_heartbeat,
+        deadbands = dict((channel, config['Stream'].getfloat('deadband_' + channel)) for channel in stream_channels if config.has_option('Stream', 'deadband_' + channel)),
+        max_rates = dict((channel, config['Stream'].getfloat('max_rate_' + channel)) for channel in stream_channels if config.has_option('Stream', 'max_rate_' + channel)))
+    listener.add_handler(streamLiveValues)
+    log.verbose('Streaming {} live values to {}/<serial>/{}/live', len(stream_channels), base_topic, LD_MONITOR)
+
+#  ---------------------------------------------------------------
+#  events, called by the event engine in the listener thread when the state of a rule changed
+def publishEvent(serial, emdata, event):
+    device = devices.get(serial)
+    if device is None:
+        return
+    log.verbose('* EVENT: meter {}: {}', serial, event)
+    publishTracked(device['event_topic'], json.dumps(event, separators=SEPARATORS), events_qos, retain=False)
+    if events_report and mqtt_connected_event.is_set():
+        #  out-of-band report, the aggregates and energies of the next report start from here
+        received = time()
+        report_timestamp = datetime.fromtimestamp(received).astimezone().isoformat(timespec='milliseconds')
+        scheduler.submit(reportDevice, device, emdata, received, report_timestamp, received)
+
+def checkEvents(serial, emdata):
+    #  events are only published for announced devices, the states of a device
+    #  are set from its first telegram after the announcement, so no edge is lost
+    if serial in devices:
+        event_engine.update(serial, emdata)
+
+if event_conditions:
+    event_engine = EventEngine(event_conditions, publishEvent)
+    listener.add_handler(checkEvents)
+    log.verbose('Checking {} event conditions on every telegram, events to {}/<serial>/{}/event', len(event_conditions), base_topic, LD_MONITOR)
+
+if aggregate_enabled:
+    aggregator = WindowAggregator(aggregate_channels, aggregate_counters)
+    listener.add_handler(aggregator.update)
+    log.verbose('Aggregating {} channels and {} counters per reporting window', len(aggregate_channels), len(aggregate_counters))
+
+if energy_enabled:
+    if energy_state_file:
+        try:
+            os.makedirs(os.path.dirname(energy_state_file) or '.', exist_ok=True)
+        except OSError as e:
+            print_line('ERROR: Could not create directory of energy state file {}: {}'.format(energy_state_file, e), error=True, sd_notify=True)
+            sys.exit(1)
+    energy_tracker = EnergyTracker(energy_counters, energy_state_file or None)
+    listener.add_handler(energy_tracker.update)
+    log.verbose('Computing energy and average power of {} counters per report', len(energy_counters))
+
+if recorder_enabled:
+    #  columns of the aggregates, declared up front: a report may lack some of them
+    recorder_names = ['{}_{}'.format(channel, statistic) for channel in aggregate_channels for statistic in ('min', 'max', 'mean', 'last')] \
+        + ['{}_delta'.format(counter) for counter in aggregate_counters] + ['samples']
+    if energy_enabled:
+        recorder_names += ['{}_{}'.format(counter, quantity) for counter in energy_counters for quantity in ('energy', 'power')]
+    recorder = Recorder(recorder_path, recorder_channels, recorder_names, opt_debug=opt_debug)
+    if recorder_source == 'telegrams':
+        listener.add_handler(recorder.record_telegram)
+    log.verbose('Recording {} to {}', recorder_source, recorder_path)
+
+#  ---------------------------------------------------------------
+#  identity of the devices of the last run
+device_cache = None
+if cache_file:
+    #  the cache only speeds up the startup, without it devices are announced on their first telegram
+    try:
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        device_cache = DeviceCache(cache_file)
+    except OSError as e:
+        print_line('* Could not create directory of device cache {}: {}, device cache disabled'.format(cache_file, e), warning=True, sd_notify=True)
+
+def announceCachedDevices():
+    #  the first telegram of every device reconciles its identity
+    if device_cache is None:
+        return
+    for (serial, identity) in device_cache.devices().items():
+        if smaserials and serial not in smaserials:
+            continue
+        log.verbose('Announcing SMA device {} from cache', serial)
+        announceDevice(serial, identity_data(serial, identity))
+
+def announceDevices():
+    #  announce devices already seen and every new device appearing on the multicast group
+    listener.on_new_device = announceDevice
+    for serial in listener.serials():
+        announceDevice(serial, listener.latest(serial))
 
 #  -------------------------------------------------------
-#  timer and timer functions for reporting period handling
+#  job for reporting period handling, aligned to the wall clock
 TIMER_INTERRUPT = (-1)
 TEST_INTERRUPT = (-2)
 
 def periodTimeoutHandler():
-    print_line('- PERIOD TIMER INTERRUPT - ', debug=opt_debug)
-    handle_interrupt(TIMER_INTERRUPT)
-    startPeriodTimer()
+    log.debug('- PERIOD TIMER INTERRUPT - ')
+    handle_interrupt(TIMER_INTERRUPT, datetime.fromtimestamp(periodJob.scheduled, local_tz))
 
 def startPeriodTimer():
-    global endPeriodTimer
-    global periodTimeRunningStatus
-    stopPeriodTimer()
-    endPeriodTimer = threading.Timer(interval_in_seconds, periodTimeoutHandler)
-    endPeriodTimer.start()
-    periodTimeRunningStatus = True
-    print_line('- started PERIOD timer - every {} seconds'.format(interval_in_seconds), debug=opt_debug)
+    global periodJob
+    periodJob = scheduler.every(interval_in_seconds, periodTimeoutHandler, name='period')
+    log.debug('- started PERIOD timer - every {} seconds', interval_in_seconds)
 
 def stopPeriodTimer():
-    global endPeriodTimer
-    global periodTimeRunningStatus
-    endPeriodTimer.cancel()
-    periodTimeRunningStatus = False
-    print_line('- stopped PERIOD timer', debug=opt_debug)
-
-def isPeriodTimerRunning():
-    global periodTimeRunningStatus
-    return periodTimeRunningStatus
-
-#  timer
-endPeriodTimer = threading.Timer(interval_in_seconds, periodTimeoutHandler)
-#  bool tracking state of timer
-periodTimeRunningStatus = False
+    if periodJob is not None:
+        periodJob.cancel()
+    log.debug('- stopped PERIOD timer')
+
+periodJob = None
 reported_first_time = False
 
 #  ------------
 #  MQTT reporting 
 def send_status(timestamp, nothing):
-    emdata = {}
-    emdata = getDatafromSMAEnergyMeter()
-    smaEMData = OrderedDict()
-    smaEMData['timestamp'] = timestamp.astimezone().replace(microsecond=0).isoformat()
-    smaEMData['grid_consume_total'] = emdata['p_consume_counter']
-    smaEMData['grid_supply_total'] = emdata['p_supply_counter']
+    report_timestamp = timestamp.astimezone().replace(microsecond=0).isoformat()
+    for device in list(devices.values()):
+        (emdata, received) = getDatafromSMAEnergyMeter(device['serial'])
+        if not emdata:
+            print_line('* no recent telegram from SMA device {}, skipping report'.format(device['serial']), warning=True)
+            continue
+        reportDevice(device, emdata, received, report_timestamp, timestamp.timestamp())
+
+def reportDevice(device, emdata, received, report_timestamp, report_time):
+    times = (report_timestamp, datetime.fromtimestamp(received).astimezone().isoformat(timespec='milliseconds'), emdata['timestamp'])
+    try:
+        values = device['report_values'](emdata)
+    except KeyError:
+        #  firmware of the device changed the set of channels
+        prepareReport(device, emdata)
+        values = device['report_values'](emdata)
+    extra = aggregator.collect(device['serial']) if aggregate_enabled else None
+    if energy_enabled:
+        energy = energy_tracker.collect(device['serial'])
+        extra = dict(extra, **energy) if extra else energy
+    if recorder_enabled and recorder_source == 'aggregates':
+        recorder.record(device['serial'], report_time, extra)
+
+    if topic_per_channel:
+        for (topic, value) in zip(device['channel_topics'], values[2:]):
+            publishMonitorData(repr(value), topic)
+        payload = device['report_template'].render(times + values[:2], extra)
+    else:
+        payload = device['report_template'].render(times + values, extra)
+
+    publishMonitorData(payload, device['values_topic'])
+    pipeline.report(device['serial'], payload)
+
+#  reports on the clock of the meter: every telegram that starts a new interval of
+#  the meter timestamp is reported, with interval 0 every telegram
+meter_clock_started = False
 
-    smaEMTopDict = OrderedDict()
-    smaEMTopDict['info'] = smaEMData
+def meterClockReport(serial, emdata):
+    device = devices.get(serial)
+    if device is None or not meter_clock_started:
+        return
+    slot = emdata['timestamp'] // report_interval_ms if report_interval_ms else emdata['timestamp']
+    previous = device.get('report_slot')
+    device['report_slot'] = slot
+    if previous is None or previous == slot:
+        #  first telegram seen may be anywhere in an interval
+        return
+    received = time()
+    report_timestamp = datetime.fromtimestamp(received).astimezone().isoformat(timespec='milliseconds')
+    scheduler.submit(reportDevice, device, emdata, received, report_timestamp, received)
 
-    _thread.start_new_thread(publishMonitorData, (smaEMTopDict, values_topic))
+if report_clock == 'meter':
+    listener.add_handler(meterClockReport)
 
-def publishMonitorData(latestData, topic):
-    mqtt_client.publish('{}'.format(topic), json.dumps(latestData), 1, retain=False)
-    sleep(0.5)
+def publishMonitorData(payload, topic):
+    #  paho only queues the message, its network thread does the sending
+    if offline_queue is not None and not mqtt_client_connected:
+        offline_queue.put(topic, payload, 1, False)
+        return
+    #  paho keeps every QoS 1 message it accepted, also if the connection was lost
+    #  meanwhile (MQTT_ERR_NO_CONN), and sends it after the reconnect: only a
+    #  message it refused goes to the offline queue
+    if publishTracked(topic, payload, 1, retain=False).rc == mqtt.MQTT_ERR_QUEUE_SIZE and offline_queue is not None:
+        offline_queue.put(topic, payload, 1, False)
+
+#  ---------------------------------------------------------------
+#  store-and-forward of reports while the broker is unreachable
+offline_queue = None
+if offline_queue_path:
+    try:
+        offline_queue = OfflineQueue(offline_queue_path, offline_queue_size)
+        MQTT_QUEUED.set_function(lambda: offline_queue.count)
+    except Exception as e:
+        print_line('ERROR: Could not open offline queue {}: {}'.format(offline_queue_path, e), error=True, sd_notify=True)
+        sys.exit(1)
+
+#  replayed messages not yet acknowledged by the broker: [(rowid, MQTTMessageInfo), ...]
+replay_inflight = []
+replay_mids = set()
+replay_cursor = 0
+replay_lock = threading.Lock()
+
+def replayOfflineQueue():
+    #  replay stored reports in batches, at most offline_replay_window messages
+    #  in flight; a message is deleted once the broker acknowledged it (on_publish),
+    #  the next batch is triggered by the acknowledgements and by a periodic job.
+    #  Messages in flight when the connection is lost are sent again by paho
+    #  after the reconnect, they stay in flight and are not replayed again.
+    global replay_inflight, replay_cursor
+    if not replay_lock.acquire(blocking=False):
+        return
+    try:
+        published = [entry for entry in replay_inflight if entry[1].is_published()]
+        if published:
+            offline_queue.delete([rowid for (rowid, info) in published])
+            replay_inflight = [entry for entry in replay_inflight if not entry[1].is_published()]
+            replay_mids.difference_update(info.mid for (rowid, info) in published)
+        free = offline_replay_window - len(replay_inflight)
+        if not mqtt_client_connected or free <= 0 or offline_queue.count == 0:
+            return
+        for (rowid, topic, payload, qos, retain) in offline_queue.peek(free, replay_cursor):
+            info = publishTracked(topic, payload, qos, retain=bool(retain))
+            if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                #  refused by paho, replayed again with the next batch
+                break
+            replay_inflight.append((rowid, info))
+            replay_mids.add(info.mid)
+            replay_cursor = rowid
+        log.debug('* QUEUE: replaying, {} messages in flight, {} stored', len(replay_inflight), offline_queue.count)
+    finally:
+        replay_lock.release()
 
 #  --------------
 #  interrupt handler
-def handle_interrupt(channel):
-    global reporting_first_time
+def handle_interrupt(channel, current_timestamp=None):
+    #  runs on a worker of the scheduler
+    global reported_first_time
     sourceID = '<< INTR(' + str(channel) + ')'
-    current_timestamp = datetime.now(local_tz)
-    print_line(sourceID + ' >> Time to report! {}'.format(current_timestamp.strftime('%H:%M:%S - %Y/%m/%d')), verbose=opt_verbose)
-    _thread.start_new_thread(send_status, (current_timestamp, ''))
+    if current_timestamp is None:
+        current_timestamp = datetime.now(local_tz)
+    log.verbose('{} >> Time to report! {}', sourceID, current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'))
+    send_status(current_timestamp, '')
     reported_first_time = True
 
 def afterMQTTConnect():
-    print_line('* afterMQTTConnect()', verbose=opt_verbose)
-    startPeriodTimer()
-    handle_interrupt(0)
+    global meter_clock_started
+    log.verbose('* afterMQTTConnect()')
+    if report_clock == 'meter':
+        meter_clock_started = True
+    else:
+        startPeriodTimer()
+    scheduler.submit(handle_interrupt, 0)
+    scheduler.every(1, discovery.flush, name='discovery', align=False)
+    if offline_queue is not None:
+        scheduler.every(1, replayOfflineQueue, name='replay', align=False)
+    if recorder_enabled:
+        scheduler.every(recorder_flush_interval, recorder.flush, name='recorder')
+    if diagnostics_enabled:
+        if diagnostics_discovery:
+            announceDiagnostics()
+        scheduler.every(diagnostics_interval, publishDiagnostics, name='diagnostics')
 
 #  ------------------
-#  launch reporting loop
-afterMQTTConnect()
-try:
+#  Prometheus endpoint with the latest values of all devices
+exporter = None
+if exporter_enabled:
+    exporter = MetricsExporter(exporter_address, exporter_port, opt_debug=opt_debug)
+    listener.add_handler(exporter.update)
+
+#  ------------------
+#  latest decoded telegram of every meter in shared memory, read with smaem_shm.SnapshotReader
+snapshot_writer = None
+if snapshot_enabled:
+    try:
+        snapshot_writer = SnapshotWriter(snapshot_path, snapshot_slots)
+    except OSError as e:
+        print_line('ERROR: Could not open snapshot file {}: {}'.format(snapshot_path, e), error=True, sd_notify=True)
+        sys.exit(1)
+    listener.add_handler(snapshot_writer.update)
+    log.verbose('Writing the latest values of up to {} meters to {}', snapshot_slots, snapshot_path)
+
+#  ------------------
+#  outputs of the pipeline, fed by the listener and by the reports
+pipeline.attach(listener)
+
+def startOutputs():
+    try:
+        pipeline.start()
+    except OSError as e:
+        print_line('ERROR: Could not open output: {}'.format(e), error=True, sd_notify=True)
+        sys.exit(1)
+
+def startExporter():
+    if exporter is None:
+        return
+    try:
+        exporter.start()
+    except OSError as e:
+        print_line('ERROR: Could not serve metrics on {}:{}: {}'.format(exporter_address, exporter_port, e), error=True, sd_notify=True)
+        sys.exit(1)
+
+#  ------------------
+#  replay of a capture file instead of the multicast group
+replay = None
+if opt_replay:
+    try:
+        replay = ReplaySource(listener.process, opt_replay, args["replay_speed"], args["replay_repeat"], opt_debug=opt_debug)
+    except (OSError, ValueError) as e:
+        print_line('ERROR: Could not replay {}: {}'.format(opt_replay, e), error=True, sd_notify=True)
+        sys.exit(1)
+    print_line('Replaying telegrams from {} at speed {}'.format(opt_replay, args["replay_speed"]), info=True)
+
+#  ------------------
+#  startup and reporting loop with threads
+def main():
+    startExporter()
+    startOutputs()
+    if replay is not None:
+        replay.start()
+    else:
+        try:
+            listener.open()
+        except OSError:
+            openListenerFailed()
+        listener.start()
+
+    log.verbose('Connecting to MQTT broker ...')
+    connectMQTT()
+    mqtt_client.loop_start()
+    scheduler.start()
+    mqtt_connected_event.wait()
+    startAliveTimer()
+
+    sd_notifier.notify('READY=1')
+
+    #  devices without a telegram so far are announced by the listener
+    announceCachedDevices()
+    announceDevices()
+    afterMQTTConnect()
+    while True:
+        sleep(10000)
+
+#  ------------------
+#  relay only: the telegrams are checked and relayed, but neither decoded nor reported
+def mainRelay():
+    startExporter()
+    startOutputs()
+    if replay is not None:
+        replay.start()
+    else:
+        try:
+            listener.open()
+        except OSError:
+            openListenerFailed()
+        listener.start()
+    sd_notifier.notify('READY=1')
+    print_line('Relaying telegrams ...', info=True, sd_notify=True)
     while True:
         sleep(10000)
 
+#  ------------------
+#  startup and reporting loop on an asyncio event loop, the telegrams, the
+#  MQTT client and all jobs are handled by the event loop thread
+async def mainAsync():
+    loop = asyncio.get_running_loop()
+    startExporter()
+    startOutputs()
+    if replay is not None:
+        #  telegrams are decoded on the event loop, as with the multicast socket
+        replay.process = lambda datagram: loop.call_soon_threadsafe(listener.process, datagram)
+        replay.start()
+    else:
+        try:
+            await listen(listener)
+        except OSError:
+            openListenerFailed()
+
+    log.verbose('Connecting to MQTT broker ...')
+    mqtt_helper = AsyncMQTTHelper(loop, mqtt_client)
+    connectMQTT()
+    scheduler.start()
+    #  the event is set by onConnect() on the event loop, the wait runs on an executor thread
+    await loop.run_in_executor(None, mqtt_connected_event.wait)
+    startAliveTimer()
+
+    sd_notifier.notify('READY=1')
+
+    announceCachedDevices()
+    announceDevices()
+    afterMQTTConnect()
+    try:
+        await loop.create_future()
+    finally:
+        mqtt_helper.stop()
+
+#  ------------------
+#  launch reporting loop, systemd stops the daemon with SIGTERM: exit through the cleanup below
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+try:
+    if relay_only:
+        mainRelay()
+    elif event_loop == 'asyncio':
+        asyncio.run(mainAsync())
+    else:
+        main()
+
 #  cleanup and exit
 finally:
     stopPeriodTimer()
     stopAliveTimer()
-    if opt_logfile:
-        f.close()
-
+    scheduler.stop()
+    if exporter is not None:
+        exporter.stop()
+    if replay is not None:
+        replay.stop()
+    listener.stop()
+    pipeline.stop()
+    if snapshot_writer is not None:
+        snapshot_writer.close()
+    if offline_queue is not None:
+        offline_queue.close()
+    if recorder_enabled:
+        recorder.flush()
+    if energy_enabled:
+        energy_tracker.save()
+    log.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Windowed aggregation of the SMA Energy Meter telegrams between two reports
+*
+*  Every telegram updates incremental min/max/mean/last statistics of the
+*  selected channels and the deltas of the selected counters, using constant
+*  memory per device. collect() returns the statistics of the current window
+*  and starts a new one:
+*
+*    <channel>_min, <channel>_max, <channel>_mean, <channel>_last
+*    <counter>_delta   (counter increase since the last window)
+*    samples           (number of telegrams in the window)
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import threading
+
+
+class ChannelStats:
+	__slots__ = ('min', 'max', 'sum', 'count', 'last')
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.min = None
+		self.max = None
+		self.sum = 0.0
+		self.count = 0
+
+	def add(self, value):
+		if self.count == 0:
+			self.min = value
+			self.max = value
+		elif value < self.min:
+			self.min = value
+		elif value > self.max:
+			self.max = value
+		self.sum += value
+		self.count += 1
+		self.last = value
+
+
+class DeviceWindow:
+	def __init__(self, channels, counters):
+		self.stats = tuple((channel, ChannelStats()) for channel in channels)
+		self.counters = tuple(counters)
+		#  counter value at start of window and latest counter value
+		self.start = {}
+		self.last = {}
+		self.samples = 0
+		self.lock = threading.Lock()
+
+	def add(self, em_data):
+		with self.lock:
+			for (channel, stats) in self.stats:
+				value = em_data.get(channel)
+				if value is not None:
+					stats.add(value)
+			for counter in self.counters:
+				value = em_data.get(counter)
+				if value is not None:
+					if counter not in self.start:
+						self.start[counter] = value
+					self.last[counter] = value
+			self.samples += 1
+
+	def collect(self):
+		result = {}
+		with self.lock:
+			for (channel, stats) in self.stats:
+				if stats.count > 0:
+					result[channel + '_min'] = stats.min
+					result[channel + '_max'] = stats.max
+					result[channel + '_mean'] = round(stats.sum / stats.count, 3)
+					result[channel + '_last'] = stats.last
+				stats.reset()
+			for counter in self.counters:
+				if counter in self.last:
+					result[counter + '_delta'] = round(self.last[counter] - self.start[counter], 6)
+					self.start[counter] = self.last[counter]
+			result['samples'] = self.samples
+			self.samples = 0
+		return result
+
+
+class WindowAggregator:
+	"""
+	*  Set of aggregation windows per device (serial)
+	*
+	*  update(serial, em_data) is called for every telegram,
+	*  collect(serial) at the end of every reporting window
+	"""
+	def __init__(self, channels, counters):
+		self.channels = tuple(channels)
+		self.counters = tuple(counters)
+		#  serial -> DeviceWindow
+		self._devices = {}
+
+	def update(self, serial, em_data):
+		window = self._devices.get(serial)
+		if window is None:
+			window = self._devices.setdefault(serial, DeviceWindow(self.channels, self.counters))
+		window.add(em_data)
+
+	def collect(self, serial):
+		window = self._devices.get(serial)
+		if window is None:
+			return {}
+		return window.collect()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  asyncio building blocks of sma-em.py
+*
+*  SMAEMProtocol:    DatagramProtocol feeding the multicast telegrams into
+*                    the SMAEMListener (decode and demultiplex per device)
+*  AsyncMQTTHelper:  drives the paho client from the event loop through its
+*                    socket callbacks (loop_read/loop_write/loop_misc), no
+*                    extra network thread as with loop_start()
+*  AsyncScheduler:   same interface as smaem_scheduler.Scheduler, but runs
+*                    the jobs on the event loop
+*
+*  With these, one event loop thread handles all sockets of all meters.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import asyncio
+from time import time
+import paho.mqtt.client as mqtt
+from uftools import print_line
+from smaem_scheduler import Job, OVERLAP_SKIP, first_deadline, next_deadline
+
+#  interval of the paho housekeeping (keepalive, retries) and reconnect attempts
+MQTT_MISC_INTERVAL_IN_SECONDS = 1.0
+MQTT_RECONNECT_DELAY_IN_SECONDS = 5.0
+
+
+class SMAEMProtocol(asyncio.DatagramProtocol):
+	def __init__(self, listener):
+		self.listener = listener
+
+	def datagram_received(self, data, addr):
+		self.listener.receive(data)
+
+	def error_received(self, exc):
+		print_line('* SOCKET: receive error: {}'.format(exc), error=True)
+
+
+async def listen(listener):
+	#  open the (non-blocking) sockets of the listener, one per interface, and
+	#  receive their telegrams on the running event loop
+	loop = asyncio.get_running_loop()
+	listener.open()
+	transports = []
+	for sock in listener.sockets:
+		(transport, protocol) = await loop.create_datagram_endpoint(lambda: SMAEMProtocol(listener), sock=sock)
+		transports.append(transport)
+	return transports
+
+
+class AsyncMQTTHelper:
+	def __init__(self, loop, client):
+		self.loop = loop
+		self.client = client
+		self.misc = None
+		self.client.on_socket_open = self.on_socket_open
+		self.client.on_socket_close = self.on_socket_close
+		self.client.on_socket_register_write = self.on_socket_register_write
+		self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+	def on_socket_open(self, client, userdata, sock):
+		self.loop.add_reader(sock, client.loop_read)
+		if self.misc is None or self.misc.done():
+			self.misc = self.loop.create_task(self.misc_loop())
+
+	def on_socket_close(self, client, userdata, sock):
+		self.loop.remove_reader(sock)
+
+	def on_socket_register_write(self, client, userdata, sock):
+		self.loop.add_writer(sock, client.loop_write)
+
+	def on_socket_unregister_write(self, client, userdata, sock):
+		self.loop.remove_writer(sock)
+
+	async def misc_loop(self):
+		#  housekeeping of paho and reconnect after the connection was lost
+		while True:
+			if self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+				await asyncio.sleep(MQTT_MISC_INTERVAL_IN_SECONDS)
+				continue
+			await asyncio.sleep(MQTT_RECONNECT_DELAY_IN_SECONDS)
+			try:
+				print_line('* MQTT reconnecting ...', warning=True)
+				self.client.reconnect()
+			except OSError as e:
+				print_line('* MQTT reconnect failed: {}'.format(e), error=True)
+
+	def stop(self):
+		if self.misc is not None:
+			self.misc.cancel()
+
+
+class AsyncScheduler:
+	"""
+	*  every(interval, func, *args):  run func(*args) every interval seconds
+	*  submit(func, *args):           run func(*args) once, soon
+	*
+	*  Jobs run on the event loop and must not block. Both methods may be
+	*  called from any thread.
+	"""
+	def __init__(self, opt_debug=False):
+		self.opt_debug = opt_debug
+		self.loop = None
+		self._pending = []
+
+	def every(self, interval, func, *args, name=None, align=True, overlap=OVERLAP_SKIP, run_now=False):
+		job = Job(name or func.__name__, interval, func, args, overlap)
+		job.deadline = first_deadline(interval, align, run_now)
+		if self.loop is None:
+			self._pending.append(job)
+		else:
+			self.loop.call_soon_threadsafe(self._schedule, job)
+		print_line('- scheduled job {} - every {} seconds'.format(job.name, interval), debug=self.opt_debug)
+		return job
+
+	def submit(self, func, *args):
+		if self.loop is None:
+			return False
+		self.loop.call_soon_threadsafe(self._call, func, args)
+		return True
+
+	def start(self):
+		self.loop = asyncio.get_running_loop()
+		for job in self._pending:
+			self._schedule(job)
+		self._pending = []
+
+	def stop(self):
+		self.loop = None
+
+	def _schedule(self, job):
+		self.loop.call_later(max(0.0, job.deadline - time()), self._run, job)
+
+	def _run(self, job):
+		if job.cancelled or self.loop is None:
+			return
+		job.scheduled = job.deadline
+		self._call(job.func, job.args)
+		job.deadline = next_deadline(job)
+		self._schedule(job)
+
+	def _call(self, func, args):
+		try:
+			func(*args)
+		except Exception as e:
+			print_line('* SCHEDULER: {} failed: {}'.format(func.__name__, e), error=True)
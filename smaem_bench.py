@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Benchmarks of the decode and publish path of sma-em.py
+*
+*  decode:       telegrams per second decoded by decode_SMAEM, per firmware
+*                variant (with and without channel 14 freq) or for the
+*                telegrams of a capture file
+*  decode_batch: telegrams per second decoded by decode_batch, per variant
+*                (only with numpy)
+*  allocations:  memory blocks and bytes allocated per decoded telegram
+*                (tracemalloc), retained and peak
+*  render:       reports per second rendered by PayloadTemplate
+*  latency:      telegram-to-publish latency, from sending a telegram over
+*                udp loopback through SMAEMListener, StreamFilter and the
+*                JSON payload until publish() returns on a local MQTT
+*                stand-in, or until the PUBACK of a real broker (--mqtt)
+*
+*  usage:
+*    python3 smaem_bench.py [--count N] [--capture FILE] [--mqtt HOST[:PORT]]
+*                           [--json FILE] [--compare FILE [--tolerance 0.2]]
+*
+*  With --compare, the exit code is 1 if any rate dropped (or the median or
+*  95th percentile latency or the allocations rose) by more than the
+*  tolerance against the results of an earlier --json run.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import gc
+import sys
+import json
+import socket
+import argparse
+import threading
+import tracemalloc
+from time import perf_counter, monotonic, sleep
+from smaem_decoder import decode_SMAEM, decode_batch, sma_units, np
+from smaem_listener import SMAEMListener, RECV_TIMEOUT_IN_SECONDS
+from smaem_filters import StreamFilter
+from smaem_payload import PayloadTemplate, SEPARATORS
+from smaem_capture import synthesize_telegram, synthetic_values, read_capture
+
+BENCH_SERIAL = 3004123456
+
+
+def variants(capture=None):
+	#  name -> list of telegrams
+	if capture:
+		return {'capture': [datagram for (timestamp, datagram) in read_capture(capture)]}
+	return dict(('freq' if freq else 'no_freq', [synthesize_telegram(BENCH_SERIAL, n * 1000, synthetic_values(n, freq), freq) for n in range(100)]) for freq in (True, False))
+
+def bench_decode(telegrams, count):
+	#  warm up the layout cache, then decode count telegrams
+	for datagram in telegrams:
+		decode_SMAEM(datagram)
+	rounds = max(1, count // len(telegrams))
+	gc.disable()
+	start = perf_counter()
+	for n in range(rounds):
+		for datagram in telegrams:
+			decode_SMAEM(datagram)
+	elapsed = perf_counter() - start
+	gc.enable()
+	return rounds * len(telegrams) / elapsed
+
+def bench_decode_batch(telegrams, count):
+	#  the telegrams repeated to count, decoded in a single call
+	batch = telegrams * max(1, count // len(telegrams))
+	decode_batch(telegrams)
+	start = perf_counter()
+	decode_batch(batch)
+	return len(batch) / (perf_counter() - start)
+
+def bench_allocations(telegrams):
+	decode_SMAEM(telegrams[0])
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	results = [decode_SMAEM(datagram) for datagram in telegrams]
+	after = tracemalloc.take_snapshot()
+	tracemalloc.reset_peak()
+	(current, peak) = tracemalloc.get_traced_memory()
+	decode_SMAEM(telegrams[0])
+	peak = tracemalloc.get_traced_memory()[1] - current
+	tracemalloc.stop()
+	stats = [stat for stat in after.compare_to(before, 'filename') if stat.count_diff > 0]
+	#  the list holding the results is not part of the decoding
+	blocks = sum(stat.count_diff for stat in stats) - 1
+	size = sum(stat.size_diff for stat in stats) - sys.getsizeof(results)
+	return {'blocks': blocks / len(telegrams), 'bytes': size / len(telegrams), 'peak_bytes': peak}
+
+def bench_render(telegrams, count):
+	em_data = decode_SMAEM(telegrams[0])
+	keys = ['timestamp', 'serial'] + [name for name in sma_units if name in em_data and name != 'speedwire_version']
+	template = PayloadTemplate(keys)
+	values = tuple(em_data.get(key, 0) for key in keys)
+	extra = {'p_consume_mean': 1234.5, 'p_consume_counter_delta': 0.0123, 'samples': 60}
+	start = perf_counter()
+	for n in range(count):
+		template.render(values, extra)
+	return count / (perf_counter() - start)
+
+
+class StandInClient:
+	"""
+	*  Local stand-in of the paho client, publish() only records the time
+	"""
+	def __init__(self):
+		self.published = []
+
+	def publish(self, topic, payload, qos=0, retain=False):
+		self.published.append((perf_counter(), payload))
+
+
+class BrokerClient:
+	"""
+	*  paho client publishing to a real broker, the time of the PUBACK is recorded
+	"""
+	def __init__(self, hostname, port):
+		import paho.mqtt.client as mqtt
+		self.published = []
+		self._payloads = {}
+		self._lock = threading.Lock()
+		self._connected = threading.Event()
+		self.client = mqtt.Client()
+		self.client.on_connect = lambda client, userdata, flags, rc: self._connected.set()
+		self.client.on_publish = self.on_publish
+		self.client.connect(hostname, port)
+		self.client.loop_start()
+		if not self._connected.wait(10):
+			raise RuntimeError('no connection to MQTT broker {}:{}'.format(hostname, port))
+
+	def publish(self, topic, payload, qos=1, retain=False):
+		with self._lock:
+			info = self.client.publish(topic, payload, 1, retain)
+			self._payloads[info.mid] = payload
+
+	def on_publish(self, client, userdata, mid):
+		now = perf_counter()
+		with self._lock:
+			payload = self._payloads.pop(mid, None)
+		if payload is not None:
+			self.published.append((now, payload))
+
+	def close(self):
+		self.client.loop_stop()
+		self.client.disconnect()
+
+def bench_latency(telegrams, client, count, rate=200.0):
+	#  listener on a loopback socket, the stream path publishes every telegram
+	receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	receiver.bind(('127.0.0.1', 0))
+	receiver.settimeout(RECV_TIMEOUT_IN_SECONDS)
+	listener = SMAEMListener()
+	listener.sockets = [receiver]
+	stream_filter = StreamFilter(['p_consume', 'p_supply', 'u1', 'u2', 'u3', 'freq'])
+	def publish(serial, em_data):
+		changed = stream_filter.update(serial, em_data, monotonic())
+		changed['timestamp'] = em_data['timestamp']
+		client.publish('bench/{}/live'.format(serial), json.dumps(changed, separators=SEPARATORS), 0, retain=False)
+	listener.add_handler(publish)
+	listener.start()
+
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sent = {}
+	for n in range(count):
+		#  the meter timestamp (ticks) identifies the telegram in the payload
+		datagram = bytearray(telegrams[n % len(telegrams)])
+		datagram[24:28] = n.to_bytes(4, 'big')
+		sent[n] = perf_counter()
+		sender.sendto(datagram, receiver.getsockname())
+		sleep(1.0 / rate)
+	deadline = monotonic() + 5.0
+	while len(client.published) < count and monotonic() < deadline:
+		sleep(0.01)
+	listener.stop()
+	sender.close()
+
+	latencies = sorted((published - sent[json.loads(payload)['timestamp']]) * 1e6 for (published, payload) in client.published)
+	if not latencies:
+		return {'received': 0}
+	def percentile(p):
+		return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+	return {'received': len(latencies), 'p50_us': percentile(0.5), 'p95_us': percentile(0.95), 'p99_us': percentile(0.99), 'max_us': latencies[-1]}
+
+
+def compare(results, baseline, tolerance):
+	#  list of regressions against the baseline results
+	regressions = []
+	for (name, value) in results.items():
+		if name not in baseline or not isinstance(value, (int, float)) or not baseline[name]:
+			continue
+		if name.endswith('_per_second') and value < baseline[name] * (1 - tolerance):
+			regressions.append('{}: {:.0f} < {:.0f}'.format(name, value, baseline[name]))
+		elif name.endswith(('_p50_us', '_p95_us', '_blocks', '_bytes')) and value > baseline[name] * (1 + tolerance):
+			regressions.append('{}: {:.1f} > {:.1f}'.format(name, value, baseline[name]))
+	return regressions
+
+def main(argv=None):
+	ap = argparse.ArgumentParser(description='Benchmarks of the decode and publish path of sma-em.py')
+	ap.add_argument('--count', type=int, default=100000, help='telegrams to decode per variant')
+	ap.add_argument('--latency-count', type=int, default=2000, help='telegrams sent for the latency benchmark')
+	ap.add_argument('--capture', help='decode the telegrams of a capture file instead of synthetic ones')
+	ap.add_argument('--mqtt', help='measure the latency until the PUBACK of the broker HOST[:PORT]')
+	ap.add_argument('--json', help='write the results to this file')
+	ap.add_argument('--compare', help='compare with the results of an earlier --json run')
+	ap.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+	args = ap.parse_args(argv)
+
+	results = {}
+	for (name, telegrams) in variants(args.capture).items():
+		results['decode_{}_per_second'.format(name)] = bench_decode(telegrams, args.count)
+		if np is not None:
+			results['decode_batch_{}_per_second'.format(name)] = bench_decode_batch(telegrams, args.count)
+		for (key, value) in bench_allocations(telegrams).items():
+			results['decode_{}_{}'.format(name, key)] = value
+	telegrams = next(iter(variants(args.capture).values()))
+	results['render_per_second'] = bench_render(telegrams, args.count)
+	if args.mqtt:
+		(hostname, _, port) = args.mqtt.partition(':')
+		client = BrokerClient(hostname, int(port or 1883))
+		try:
+			latency = bench_latency(telegrams, client, args.latency_count)
+		finally:
+			client.close()
+	else:
+		latency = bench_latency(telegrams, StandInClient(), args.latency_count)
+	for (key, value) in latency.items():
+		results['latency_{}'.format(key)] = value
+
+	for (name, value) in results.items():
+		print('{:<36} {:>14.1f}'.format(name, value))
+	if args.json:
+		with open(args.json, 'w') as json_file:
+			json.dump(results, json_file, indent=2)
+	if args.compare:
+		with open(args.compare) as json_file:
+			regressions = compare(results, json.load(json_file), args.tolerance)
+		for regression in regressions:
+			print('REGRESSION {}'.format(regression))
+		return 1 if regressions else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Identity of the SMA Energy Meters seen by sma-em.py, cached on disk
+*
+*  The identity of a device is the software version of its firmware and
+*  the channels it sends. With the identities of the last run, sma-em.py
+*  announces its devices to Home Assistant right after the connection to
+*  the broker, without waiting for the first telegram of every meter. The
+*  first telegram of a device then only triggers a new announcement if its
+*  identity changed (e.g. after a firmware update).
+*
+*  The cache is a small JSON file, written atomically when an identity
+*  changes:
+*
+*    {"<serial>": {"version": "2.3.18.R", "channels": ["p_consume", ...]}}
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import json
+import threading
+from uftools import print_line
+from smaem_decoder import sma_units
+
+
+def device_identity(em_data):
+	#  identity of a device from one of its telegrams
+	return {
+		'version': em_data.get('speedwire_version', ''),
+		'channels': sorted(name for name in em_data if name in sma_units and name != 'speedwire_version'),
+	}
+
+def identity_data(serial, identity):
+	#  stand-in for a telegram with the channels of an identity, all values
+	#  are 0, to prepare the reports and the announcement of a device
+	em_data = dict.fromkeys(identity['channels'], 0)
+	em_data['serial'] = serial
+	em_data['speedwire_version'] = identity['version']
+	return em_data
+
+
+class DeviceCache:
+	"""
+	*  devices():                 {serial: identity} of all cached devices
+	*  update(serial, identity):  stores the identity of a device, returns
+	*                             True if it changed
+	"""
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._devices = self._load()
+
+	def _load(self):
+		if not os.path.exists(self.path):
+			return {}
+		try:
+			with open(self.path) as cache_file:
+				cache = json.load(cache_file)
+			return dict((int(serial), {'version': str(identity['version']), 'channels': list(identity['channels'])}) for (serial, identity) in cache.items())
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			print_line('* CACHE: ignoring device cache {}: {}'.format(self.path, e), warning=True)
+			return {}
+
+	def _save(self):
+		temporary = self.path + '.tmp'
+		try:
+			with open(temporary, 'w') as cache_file:
+				json.dump(dict((str(serial), identity) for (serial, identity) in self._devices.items()), cache_file)
+			os.replace(temporary, self.path)
+		except OSError as e:
+			print_line('* CACHE: could not write device cache {}: {}'.format(self.path, e), error=True)
+
+	def devices(self):
+		with self._lock:
+			return dict(self._devices)
+
+	def update(self, serial, identity):
+		with self._lock:
+			if self._devices.get(serial) == identity:
+				return False
+			self._devices[serial] = identity
+			self._save()
+		return True
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Record and replay of the raw udp telegrams of the SMA Energy Meter
+*
+*  Capture file format (little endian):
+*
+*    file header:  b'SMAEMCAP', uint16 version
+*    record:       float64 receive time (unix), uint16 length, telegram
+*
+*  record:     receives the telegrams from the multicast group and appends
+*              them to a capture file
+*  synthesize: builds valid telegrams from a values dictionary, with or
+*              without channel 14 (freq, firmware 2.xxxx and higher), to
+*              test firmware variants without a physical meter
+*  replay:     ReplaySource feeds a capture file into a SMAEMListener at
+*              real or accelerated speed instead of the multicast socket
+*
+*  usage:
+*    python3 smaem_capture.py record <file> [--seconds N] [--ipbind IP]
+*    python3 smaem_capture.py synth <file> [--count N] [--serial S] [--no-freq]
+*    python3 smaem_capture.py info <file>
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import sys
+import socket
+import struct
+import argparse
+import threading
+from time import time, monotonic
+from uftools import print_line
+from smaem_decoder import sma_channels, to_raw, decode_SMAEM
+from smaem_listener import open_multicast_socket, MCAST_BUFSIZE
+
+CAPTURE_MAGIC = b'SMAEMCAP'
+CAPTURE_VERSION = 1
+_file_header = struct.Struct('<8sH')
+_record_header = struct.Struct('<dH')
+
+
+class CaptureWriter:
+	"""
+	*  write(datagram, timestamp):  append one telegram to the capture file
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.count = 0
+		is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+		self._file = open(path, 'ab')
+		if is_new:
+			self._file.write(_file_header.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+		else:
+			_check_header(path)
+
+	def write(self, datagram, timestamp=None):
+		if timestamp is None:
+			timestamp = time()
+		self._file.write(_record_header.pack(timestamp, len(datagram)))
+		self._file.write(datagram)
+		self.count += 1
+
+	def close(self):
+		self._file.close()
+
+
+def _check_header(path):
+	with open(path, 'rb') as capture_file:
+		(magic, version) = _file_header.unpack(capture_file.read(_file_header.size))
+	if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+		raise ValueError('{} is not a capture file of version {}'.format(path, CAPTURE_VERSION))
+
+def read_capture(path):
+	#  yields (timestamp, datagram) of every telegram in a capture file
+	_check_header(path)
+	with open(path, 'rb') as capture_file:
+		capture_file.seek(_file_header.size)
+		while True:
+			header = capture_file.read(_record_header.size)
+			if len(header) < _record_header.size:
+				break
+			(timestamp, length) = _record_header.unpack(header)
+			datagram = capture_file.read(length)
+			if len(datagram) < length:
+				#  interrupted write at the end of the file
+				break
+			yield (timestamp, datagram)
+
+def record(path, ipbind='0.0.0.0', seconds=None, count=None):
+	#  append the telegrams of the multicast group to a capture file
+	sock = open_multicast_socket(ipbind)
+	sock.settimeout(1.0)
+	writer = CaptureWriter(path)
+	end = monotonic() + seconds if seconds else None
+	try:
+		while (end is None or monotonic() < end) and (count is None or writer.count < count):
+			try:
+				datagram = sock.recv(MCAST_BUFSIZE)
+			except socket.timeout:
+				continue
+			writer.write(datagram)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		writer.close()
+		sock.close()
+	return writer.count
+
+
+"""
+*  Telegram synthesizer
+*
+*  The OBIS blocks are written in the order of the meter: totals, phase 1,
+*  phase 2, phase 3 and the software version. Channels with a counter unit
+*  get an "actual" block (4 byte) followed by a "counter" block (8 byte).
+"""
+SYNTH_ORDER = [1, 2, 3, 4, 9, 10, 13, 14] + [phase + index for phase in (20, 40, 60) for index in (1, 2, 3, 4, 9, 10, 11, 12, 13)]
+SYNTH_SUSY_ID = 0x015D
+SYNTH_VERSION = (2, 3, 18, 'R')
+
+def synthesize_telegram(serial, ticks, values=None, freq=True, version=SYNTH_VERSION):
+	#  values: {<smaem_name>: <value>, ...} in the units of sma_units, missing
+	#  values are sent as zero
+	if values is None:
+		values = {}
+	body = []
+	for index in SYNTH_ORDER:
+		if index == 14 and not freq:
+			continue
+		channel = sma_channels[index]
+		body.append(struct.pack('>BBBBI', 0, index, 4, 0, to_raw(channel[0], values.get(channel[0], 0))))
+		if len(channel) > 2:
+			name = channel[0] + '_counter'
+			body.append(struct.pack('>BBBBQ', 0, index, 8, 0, to_raw(name, values.get(name, 0))))
+	body.append(struct.pack('>BBBBBBBB', 144, 0, 0, 0, version[0], version[1], version[2], ord(version[3])))
+	data = struct.pack('>HHII', 0x6069, SYNTH_SUSY_ID, serial, ticks & 0xffffffff) + b''.join(body)
+	return b'SMA\x00' + struct.pack('>HHI', 4, 0x02A0, 1) + struct.pack('>HH', len(data), 0x0010) + data + b'\x00\x00\x00\x00'
+
+def synthetic_values(n, freq=True):
+	#  plausible, slowly changing values for the n-th telegram
+	values = {}
+	for (phase, offset) in (('1', 0), ('2', 80), ('3', 160)):
+		power = 400.0 + offset + (n * 7 + offset) % 50
+		values['p{}_consume'.format(phase)] = power
+		values['s{}_consume'.format(phase)] = power + 20.0
+		values['q{}_consume'.format(phase)] = 15.0
+		values['u{}'.format(phase)] = 230.0 + ((n + offset) % 20) / 10
+		values['i{}'.format(phase)] = round(power / 230.0, 3)
+		values['cosphi{}'.format(phase)] = 0.95
+		values['p{}_consume_counter'.format(phase)] = 1000.0 + n * power / 3600000
+	values['p_consume'] = sum(values['p{}_consume'.format(phase)] for phase in '123')
+	values['s_consume'] = sum(values['s{}_consume'.format(phase)] for phase in '123')
+	values['q_consume'] = 45.0
+	values['cosphi'] = 0.95
+	values['p_consume_counter'] = sum(values['p{}_consume_counter'.format(phase)] for phase in '123')
+	if freq:
+		values['freq'] = 50.0 + (n % 10 - 5) / 1000
+	return values
+
+def synthesize(path, count=100, serials=(3004123456,), interval=1.0, freq=True, start=None):
+	#  write a capture file with count telegrams of every serial, interval seconds apart
+	if start is None:
+		start = time()
+	writer = CaptureWriter(path)
+	try:
+		for n in range(count):
+			for serial in serials:
+				writer.write(synthesize_telegram(serial, n * int(interval * 1000), synthetic_values(n, freq), freq), start + n * interval)
+	finally:
+		writer.close()
+	return writer.count
+
+
+class ReplaySource(threading.Thread):
+	"""
+	*  Replays a capture file into process(datagram), usually the process()
+	*  method of a SMAEMListener
+	*
+	*  speed:   1.0 replays at the recorded rate, 10.0 ten times faster, 0
+	*           as fast as possible
+	*  repeat:  restart at the beginning of the file after the last telegram
+	"""
+	def __init__(self, process, path, speed=1.0, repeat=False, opt_debug=False):
+		threading.Thread.__init__(self, name='smaem-replay', daemon=True)
+		self.process = process
+		self.path = path
+		self.speed = speed
+		self.repeat = repeat
+		self.opt_debug = opt_debug
+		self.count = 0
+		self._stop_event = threading.Event()
+		_check_header(path)
+
+	def run(self):
+		#  repeated rounds shift the ticks of the meter, otherwise the telegrams
+		#  would be dropped as reordered
+		shift = 0
+		while not self._stop_event.is_set():
+			start = None
+			for (timestamp, datagram) in read_capture(self.path):
+				if start is None:
+					start = (timestamp, monotonic())
+				if shift and len(datagram) >= 28:
+					datagram = bytearray(datagram)
+					datagram[24:28] = ((int.from_bytes(datagram[24:28], 'big') + shift) & 0xffffffff).to_bytes(4, 'big')
+				if self.speed > 0:
+					delay = (timestamp - start[0]) / self.speed - (monotonic() - start[1])
+					if delay > 0 and self._stop_event.wait(delay):
+						return
+				elif self._stop_event.is_set():
+					return
+				self.process(datagram)
+				self.count += 1
+			print_line('* REPLAY: {} telegrams replayed from {}'.format(self.count, self.path), debug=self.opt_debug)
+			if not self.repeat or start is None:
+				break
+			shift += int((timestamp - start[0]) * 1000) + 1000
+
+	def stop(self):
+		self._stop_event.set()
+
+
+def main(argv=None):
+	ap = argparse.ArgumentParser(description='Record, synthesize and inspect SMA Energy Meter capture files')
+	commands = ap.add_subparsers(dest='command', required=True)
+	ap_record = commands.add_parser('record', help='record the telegrams of the multicast group')
+	ap_record.add_argument('file')
+	ap_record.add_argument('--seconds', type=float, help='stop after this many seconds')
+	ap_record.add_argument('--count', type=int, help='stop after this many telegrams')
+	ap_record.add_argument('--ipbind', default='0.0.0.0', help='ip address of the interface to listen on')
+	ap_synth = commands.add_parser('synth', help='write synthetic telegrams')
+	ap_synth.add_argument('file')
+	ap_synth.add_argument('--count', type=int, default=100, help='telegrams per serial')
+	ap_synth.add_argument('--serial', type=int, action='append', help='serial number, may be repeated')
+	ap_synth.add_argument('--interval', type=float, default=1.0, help='seconds between telegrams')
+	ap_synth.add_argument('--no-freq', action='store_true', help='leave out channel 14 (firmware 1.xxxx)')
+	ap_info = commands.add_parser('info', help='summarize a capture file')
+	ap_info.add_argument('file')
+	args = ap.parse_args(argv)
+
+	if args.command == 'record':
+		count = record(args.file, args.ipbind, args.seconds, args.count)
+		print('{} telegrams recorded to {}'.format(count, args.file))
+	elif args.command == 'synth':
+		count = synthesize(args.file, args.count, args.serial or (3004123456,), args.interval, not args.no_freq)
+		print('{} telegrams written to {}'.format(count, args.file))
+	else:
+		devices = {}
+		(first, last, count) = (None, None, 0)
+		for (timestamp, datagram) in read_capture(args.file):
+			first = timestamp if first is None else first
+			last = timestamp
+			count += 1
+			em_data = decode_SMAEM(datagram)
+			if 'serial' in em_data:
+				devices.setdefault(em_data['serial'], [0, len(datagram), 'freq' in em_data])[0] += 1
+		print('{}: {} telegrams, {:.1f} seconds'.format(args.file, count, (last - first) if count else 0))
+		for (serial, (telegrams, length, freq)) in devices.items():
+			print('  serial {}: {} telegrams of {} bytes{}'.format(serial, telegrams, length, '' if freq else ', without freq'))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -20,8 +20,17 @@
 */
 """
 
+import struct
+from collections import namedtuple
+from operator import itemgetter, truediv
 from uftools import print_line
 
+#  optional, only needed by decode_batch()
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
 #  map of all SMA-EM measurement channels in the sma_channels dictionary
 #
 #  <index>:(<smaem_name>,<unit_actual_value>,<unit_counter_value>)
@@ -130,60 +139,433 @@ def decode_OBIS(obis):
 
 
 """
+*  Static unit metadata for every value produced by decode_SMAEM, e.g.
 *
+*  sma_units['p_consume'] = 'W'
+*  sma_units['p_consume_counter'] = 'kWh'
 """
-def decode_SMAEM(datagram, opt_debug=False):
-	em_data={}
-	print_line('*  Decode SMAEM', debug=opt_debug)
-
-	# process data only if SMA header is present
-	if datagram[0:3]==b'SMA':
-		# datagram length
-		datalength=int.from_bytes(datagram[12:14], byteorder='big') + 16
-		print_line('   length of datastring: {}'.format(datalength), debug=opt_debug)
-
-		if datalength != 54:
-			# serial number of engery meter
-			emID = int.from_bytes(datagram[20:24], byteorder='big')
-			print_line('   serial number: {}'.format(emID), debug=opt_debug)
-			em_data['serial'] = emID
-
-			# timestamp of em message
-			timestamp = int.from_bytes(datagram[24:28], byteorder='big')
-			print_line('   timestamp: {}'.format(timestamp), debug=opt_debug)
-			em_data['timestamp'] = timestamp
-
-			# starting with position 28, loop over remaining length of "datagram"
-			# and decode OBIS data blocks 
-			position = 28
-			while position < datalength:
-				# decode header
-				(obis_index, datatype) = decode_OBIS(datagram[position:position+4])
-				print_line('   SMA channel: {} - datatype: {}'.format(obis_index, datatype), debug=opt_debug)
-
-				if datatype == 'actual':
-					value = int.from_bytes(datagram[position+4:position+8], byteorder='big')
-					position += 8
-					if obis_index in sma_channels.keys():
-						em_data[sma_channels[obis_index][0]] = value / sma_scale[sma_channels[obis_index][1]]
-						em_data[sma_channels[obis_index][0]+'_unit'] = sma_channels[obis_index][1]
-
-				elif datatype == 'counter':
-					value = int.from_bytes(datagram[position+4:position+12], byteorder='big')
-					position += 12
-					if obis_index in sma_channels.keys():
-						em_data[sma_channels[obis_index][0]+'_counter'] = value / sma_scale[sma_channels[obis_index][2]]
-						em_data[sma_channels[obis_index][0]+'_counterunit'] = sma_channels[obis_index][2]
-
-				elif datatype == 'version':
-					if obis_index in sma_channels.keys():
-						byte3 = datagram[position+4]
-						byte2 = datagram[position+5]
-						byte1 = datagram[position+6]
-						byte0 = datagram[position+7]
-						version = str(byte3)+'.'+str(byte2).zfill(2)+'.'+str(byte1).zfill(2)+'.'+str(chr(byte0))
-						em_data[sma_channels[obis_index][0]] = version
-					position += 8
-				else:
-					position += 8
+sma_units = {}
+for (obis_index, channel) in sma_channels.items():
+	sma_units[channel[0]] = channel[1]
+	if len(channel) > 2:
+		sma_units[channel[0]+'_counter'] = channel[2]
+
+
+"""
+*  Scale of every value produced by decode_SMAEM, e.g. sma_value_scale['p_consume'] = 10
+*
+*  The raw integer value sent by the meter is recovered exactly from the
+*  decoded value with to_raw(), as long as it is below 2**52 (counters in Ws
+*  are far below that), since value = raw / scale is rounded correctly.
+"""
+sma_value_scale = dict((name, sma_scale[unit]) for (name, unit) in sma_units.items())
+
+def to_raw(name, value):
+	return int(round(value * sma_value_scale[name]))
+
+
+"""
+*  Telegram layout
+*
+*  The sequence of OBIS blocks only depends on the firmware of the meter, so
+*  it is walked once, compiled into a single struct format covering the whole
+*  telegram and cached by telegram length. Every OBIS block unpacks into
+*  exactly two items (header, value), which allows to verify the cached
+*  layout against the headers of each new telegram with one tuple compare.
+"""
+OBIS_VERSION = 0x90000000
+
+class SMAEMLayout:
+	__slots__ = ('struct', 'blocks', 'headers', 'names', 'scales', 'pick', 'version_index')
+
+	def __init__(self, blocks):
+		#  blocks: list of (obis_header, struct_char, name, scale)
+		self.blocks = tuple(blocks)
+		self.struct = struct.Struct('>20xII' + ''.join('I' + block[1] for block in blocks))
+		self.headers = tuple(block[0] for block in blocks)
+		selected = [n for (n, block) in enumerate(blocks) if block[3] is not None]
+		self.names = tuple(blocks[n][2] for n in selected)
+		self.scales = tuple(blocks[n][3] for n in selected)
+		if len(selected) > 1:
+			self.pick = itemgetter(*selected)
+		else:
+			self.pick = lambda values: tuple(values[n] for n in selected)
+		self.version_index = None
+		for (n, block) in enumerate(blocks):
+			if block[0] == OBIS_VERSION and block[2] is not None:
+				self.version_index = n
+
+def _build_layout(datagram, datalength):
+	blocks = []
+	position = 28
+	while position < datalength and position + 8 <= len(datagram):
+		(obis_index, datatype) = decode_OBIS(datagram[position:position+4])
+		header = int.from_bytes(datagram[position:position+4], byteorder='big')
+		channel = sma_channels.get(obis_index)
+		if datatype == 'counter':
+			if position + 12 > len(datagram):
+				break
+			if channel is not None and len(channel) > 2:
+				blocks.append((header, 'Q', channel[0]+'_counter', sma_scale[channel[2]]))
+			else:
+				blocks.append((header, 'Q', None, None))
+			position += 12
+		elif datatype == 'actual' and channel is not None:
+			blocks.append((header, 'I', channel[0], sma_scale[channel[1]]))
+			position += 8
+		elif datatype == 'version' and channel is not None:
+			blocks.append((header, 'I', channel[0], None))
+			position += 8
+		else:
+			blocks.append((header, 'I', None, None))
+			position += 8
+	if position < datalength:
+		# telegram is truncated
+		return None
+	return SMAEMLayout(blocks)
+
+#  cache of compiled layouts: datalength -> [SMAEMLayout, ...], a meter sends
+#  one or two layouts, the cap protects against a stream of odd telegrams
+MAX_LAYOUTS = 32
+_layouts = {}
+_layout_count = 0
+
+def _unpack(datagram, datalength):
+	#  returns (layout, values) using a cached layout if the OBIS headers match
+	for layout in _layouts.get(datalength, ()):
+		if layout.struct.size <= len(datagram):
+			values = layout.struct.unpack_from(datagram)
+			if values[2::2] == layout.headers:
+				return (layout, values)
+	global _layout_count
+	layout = _build_layout(datagram, datalength)
+	if layout is None:
+		return (None, None)
+	if _layout_count >= MAX_LAYOUTS:
+		#  drop the layouts of the data length cached first
+		_layout_count -= len(_layouts.pop(next(iter(_layouts))))
+	_layouts.setdefault(datalength, []).append(layout)
+	_layout_count += 1
+	return (layout, layout.struct.unpack_from(datagram))
+
+def decode_version(value):
+	#  software version is sent as 4 bytes: major, minor, build, revision (character)
+	return '{}.{:02d}.{:02d}.{}'.format(value >> 24, (value >> 16) & 0xff, (value >> 8) & 0xff, chr(value & 0xff))
+
+
+"""
+*  Validation of the telegram header
+*
+*  |--------|--------|--------|--------|
+*  | 'S'    | 'M'    | 'A'    | 0x00   |  0  SMA signature
+*  | 0x0004          | 0x02A0          |  4  tag length, group tag
+*  | 0x00000001                        |  8  group
+*  | data length     | 0x0010          | 12  data length, SMA Net 2 tag
+*  | 0x6069          | SUSy ID         | 16  protocol ID (energy meter)
+*  | serial number                     | 20
+*  | ticks (ms)                        | 24  timestamp of the meter
+*  | OBIS blocks ...                   | 28
+*  | 0x00000000                        | 16 + data length: end marker
+*  |--------|--------|--------|--------|
+*
+*  check_SMAEM() verifies all constant fields, the data length against the
+*  size of the datagram and the end marker with one struct unpack, and
+*  returns SMAEMCheck(status, serial, ticks, datalength); status is
+*  TELEGRAM_OK or the reason of the rejection, serial and ticks are None
+*  for rejected datagrams.
+*/
+"""
+SMAEMCheck = namedtuple('SMAEMCheck', ('status', 'serial', 'ticks', 'datalength'))
+
+TELEGRAM_OK = 'ok'
+TELEGRAM_SHORT = 'short'			# shorter than the header
+TELEGRAM_FOREIGN = 'foreign'		# no SMA signature or group tag
+TELEGRAM_PROTOCOL = 'protocol'		# other protocol, e.g. 0x6065 of inverters
+TELEGRAM_EMPTY = 'empty'			# no measurements
+TELEGRAM_CLIPPED = 'clipped'		# data length beyond the end of the datagram
+TELEGRAM_END = 'end'				# end marker missing
+TELEGRAM_TRUNCATED = 'truncated'	# OBIS blocks do not fill the data length
+
+SMA_SIGNATURE = b'SMA\x00'
+SMA_GROUP_TAG = 0x000402A0
+SMA_GROUP = 1
+SMA_NET2_TAG = 0x0010
+SMAEM_PROTOCOL = 0x6069
+SMA_END_MARKER = b'\x00\x00\x00\x00'
+HEADER_SIZE = 28
+
+_telegram_header = struct.Struct('>4sIIHHHxxII')
+
+def check_SMAEM(datagram):
+	if len(datagram) < HEADER_SIZE:
+		return SMAEMCheck(TELEGRAM_SHORT, None, None, None)
+	(signature, group_tag, group, length, net2_tag, protocol, serial, ticks) = _telegram_header.unpack_from(datagram)
+	if signature != SMA_SIGNATURE or group_tag != SMA_GROUP_TAG or group != SMA_GROUP or net2_tag != SMA_NET2_TAG:
+		return SMAEMCheck(TELEGRAM_FOREIGN, None, None, None)
+	if protocol != SMAEM_PROTOCOL:
+		return SMAEMCheck(TELEGRAM_PROTOCOL, None, None, None)
+	datalength = length + 16
+	if datalength <= HEADER_SIZE or datalength == 54:
+		# 54 byte telegrams do not contain measurements
+		return SMAEMCheck(TELEGRAM_EMPTY, None, None, datalength)
+	if datalength + 4 > len(datagram):
+		return SMAEMCheck(TELEGRAM_CLIPPED, None, None, datalength)
+	if datagram[datalength:datalength+4] != SMA_END_MARKER:
+		return SMAEMCheck(TELEGRAM_END, None, None, datalength)
+	return SMAEMCheck(TELEGRAM_OK, serial, ticks, datalength)
+
+
+"""
+*  Batches of telegrams sent by the udp relay (smaem_pipeline.py): several
+*  telegrams in one datagram, each one prefixed by its length
+*
+*    b'SMAR', uint8 version, uint8 count, count x (uint16 length, telegram)
+*
+*  A batch never starts with the SMA signature, so receivers tell batches
+*  and single telegrams apart by the first 4 bytes.
+*/
+"""
+RELAY_SIGNATURE = b'SMAR'
+RELAY_VERSION = 1
+RELAY_MAX_COUNT = 255
+
+_relay_header = struct.Struct('>4sBB')
+_relay_length = struct.Struct('>H')
+
+def pack_batch(telegrams):
+	parts = [_relay_header.pack(RELAY_SIGNATURE, RELAY_VERSION, len(telegrams))]
+	for telegram in telegrams:
+		parts.append(_relay_length.pack(len(telegram)))
+		parts.append(telegram)
+	return b''.join(parts)
+
+def unpack_batch(datagram):
+	#  list of the telegrams of a batch, a malformed batch ends at the first
+	#  incomplete telegram
+	if len(datagram) < _relay_header.size:
+		return []
+	(signature, version, count) = _relay_header.unpack_from(datagram)
+	if signature != RELAY_SIGNATURE or version != RELAY_VERSION:
+		return []
+	telegrams = []
+	offset = _relay_header.size
+	for index in range(count):
+		if offset + _relay_length.size > len(datagram):
+			break
+		(length,) = _relay_length.unpack_from(datagram, offset)
+		offset += _relay_length.size
+		if offset + length > len(datagram):
+			break
+		telegrams.append(datagram[offset:offset+length])
+		offset += length
+	return telegrams
+
+
+"""
+*  Sequence of the telegrams of one meter, based on the ticks (ms) of the
+*  meter, which wrap around after 2**32 ms (about 49.7 days)
+*
+*  update(ticks) returns
+*    SEQUENCE_NEXT       next telegram, or
+*    SEQUENCE_GAP        next telegram after missing ones (missed is updated)
+*    SEQUENCE_DUPLICATE  same ticks as the last telegram
+*    SEQUENCE_REORDERED  older than the last telegram
+*    SEQUENCE_RESTART    far older than the last telegram: meter restarted
+*
+*  The interval of the meter (1000 ms by default, configurable on newer
+*  firmware) is learned from the ticks; a gap is a step of more than 1.5
+*  intervals.
+*/
+"""
+SEQUENCE_NEXT = 'next'
+SEQUENCE_GAP = 'gap'
+SEQUENCE_DUPLICATE = 'duplicate'
+SEQUENCE_REORDERED = 'reordered'
+SEQUENCE_RESTART = 'restart'
+
+#  telegrams further back than this are taken as a restart of the meter
+MAX_REORDER_MS = 60000
+
+class TelegramSequence:
+	__slots__ = ('last', 'interval', 'gaps', 'missed', 'duplicates', 'reordered', 'restarts')
+
+	def __init__(self):
+		self.last = None
+		self.interval = None
+		self.gaps = 0
+		self.missed = 0
+		self.duplicates = 0
+		self.reordered = 0
+		self.restarts = 0
+
+	def update(self, ticks):
+		if self.last is None:
+			self.last = ticks
+			return SEQUENCE_NEXT
+		delta = (ticks - self.last) & 0xffffffff
+		if delta == 0:
+			self.duplicates += 1
+			return SEQUENCE_DUPLICATE
+		if delta >= 0x80000000:
+			if 0x100000000 - delta > MAX_REORDER_MS:
+				self.restarts += 1
+				self.last = ticks
+				self.interval = None
+				return SEQUENCE_RESTART
+			self.reordered += 1
+			return SEQUENCE_REORDERED
+		self.last = ticks
+		if self.interval is not None and delta > 1.5 * self.interval:
+			self.gaps += 1
+			self.missed += max(1, round(delta / self.interval) - 1)
+			return SEQUENCE_GAP
+		self.interval = delta if self.interval is None else self.interval + (delta - self.interval) / 8
+		return SEQUENCE_NEXT
+
+
+"""
+*  decode one telegram into a dictionary {<smaem_name>: <value>, ...}, units
+*  of the values are found in sma_units
+*
+*  decode_SMAEM() returns an empty dictionary for every datagram rejected by
+*  check_SMAEM() or with incomplete OBIS blocks, decode_checked() decodes a
+*  telegram that already passed check_SMAEM()
+*/
+"""
+def decode_checked(datagram, check, opt_debug=False):
+	em_data = {}
+	datalength = check.datalength
+	(layout, values) = _unpack(datagram, datalength)
+	if values is None:
+		return em_data
+
+	# serial number of energy meter, timestamp of em message
+	em_data['serial'] = values[0]
+	em_data['timestamp'] = values[1]
+	blockvalues = values[3::2]
+	em_data.update(zip(layout.names, map(truediv, layout.pick(blockvalues), layout.scales)))
+	if layout.version_index is not None:
+		em_data[sma_channels[0][0]] = decode_version(blockvalues[layout.version_index])
+
+	if opt_debug:
+		print_line('*  Decode SMAEM: length {} serial {} timestamp {} - {} values'.format(datalength, values[0], values[1], len(em_data) - 2), debug=True)
 	return em_data
+
+def decode_SMAEM(datagram, opt_debug=False):
+	check = check_SMAEM(datagram)
+	if check.status != TELEGRAM_OK:
+		return {}
+	return decode_checked(datagram, check, opt_debug)
+
+
+"""
+*  Batch decoding into a NumPy structured array, e.g. to re-decode the
+*  telegrams of months of captures (smaem_capture.py)
+*
+*  decode_batch() returns one row per accepted telegram, in the order of the
+*  input, with the columns
+*
+*    index                position of the telegram in the input
+*    serial, timestamp    serial number and ticks (ms) of the meter
+*    <smaem_name>         raw integer value (int64) of every name of
+*                         sma_units, BATCH_MISSING if not sent
+*
+*  Telegrams are grouped by length, all telegrams of a group are parsed at
+*  once with np.frombuffer() and a structured dtype compiled from the
+*  layout (see SMAEMLayout above), so the cost per telegram is a few array
+*  operations instead of a struct unpack and a dictionary. Telegrams are
+*  validated like check_SMAEM(), but not checked for their sequence.
+*
+*  scale_batch() returns the values as float64 in the units of sma_units,
+*  NaN for channels not sent.
+*/
+"""
+BATCH_MISSING = -1
+
+_batch_dtypes = {}
+
+def _batch_result_dtype():
+	return np.dtype([('index', '<u4'), ('serial', '<u4'), ('timestamp', '<u4')] + [(name, '<i8') for name in sma_units])
+
+def _batch_header_dtype(itemsize):
+	return np.dtype({
+		'names': ['signature', 'group_tag', 'group', 'length', 'net2_tag', 'protocol'],
+		'formats': ['S4', '>u4', '>u4', '>u2', '>u2', '>u2'],
+		'offsets': [0, 4, 8, 12, 14, 16],
+		'itemsize': itemsize})
+
+def _batch_layout_dtype(layout, itemsize):
+	#  structured dtype of a telegram of itemsize bytes with the given layout:
+	#  serial, timestamp, then header h<n> and value v<n> of every OBIS block
+	key = (layout.headers, itemsize)
+	dtype = _batch_dtypes.get(key)
+	if dtype is None:
+		if len(_batch_dtypes) >= MAX_LAYOUTS:
+			_batch_dtypes.clear()
+		(names, formats, offsets) = (['serial', 'timestamp'], ['>u4', '>u4'], [20, 24])
+		position = HEADER_SIZE
+		for (n, block) in enumerate(layout.blocks):
+			names += ['h{}'.format(n), 'v{}'.format(n)]
+			formats += ['>u4', '>u8' if block[1] == 'Q' else '>u4']
+			offsets += [position, position + 4]
+			position += 12 if block[1] == 'Q' else 8
+		dtype = _batch_dtypes[key] = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+	return dtype
+
+def decode_batch(telegrams):
+	if np is None:
+		raise ImportError('decode_batch() requires numpy')
+	telegrams = list(telegrams)
+	result = np.full(len(telegrams), BATCH_MISSING, dtype=_batch_result_dtype())
+	result['index'] = np.arange(len(telegrams))
+	accepted = np.zeros(len(telegrams), dtype=bool)
+	#  telegram length -> [input index, ...]
+	groups = {}
+	for (index, datagram) in enumerate(telegrams):
+		groups.setdefault(len(datagram), []).append(index)
+	for (itemsize, indices) in groups.items():
+		if itemsize < HEADER_SIZE:
+			continue
+		indices = np.array(indices)
+		buffer = b''.join(telegrams[index] for index in indices)
+		header = np.frombuffer(buffer, dtype=_batch_header_dtype(itemsize))
+		datalength = header['length'].astype(np.int64) + 16
+		valid = (header['signature'] == SMA_SIGNATURE) & (header['group_tag'] == SMA_GROUP_TAG) & (header['group'] == SMA_GROUP) \
+			& (header['net2_tag'] == SMA_NET2_TAG) & (header['protocol'] == SMAEM_PROTOCOL) \
+			& (datalength > HEADER_SIZE) & (datalength != 54) & (datalength + 4 <= itemsize)
+		rows = np.frombuffer(buffer, dtype=np.uint8).reshape(len(indices), itemsize)
+		for length in np.unique(datalength[valid]):
+			pending = np.flatnonzero(valid & (datalength == length))
+			pending = pending[(rows[pending, length:length+4] == 0).all(axis=1)]
+			#  one pass per layout, usually a single one per length
+			while len(pending):
+				first = telegrams[indices[pending[0]]]
+				(layout, values) = _unpack(first, int(length))
+				if layout is None:
+					#  truncated OBIS blocks
+					pending = pending[1:]
+					continue
+				blocks = np.frombuffer(buffer, dtype=_batch_layout_dtype(layout, itemsize))[pending]
+				match = np.ones(len(pending), dtype=bool)
+				for (n, header_value) in enumerate(layout.headers):
+					match &= blocks['h{}'.format(n)] == header_value
+				matched = indices[pending[match]]
+				blocks = blocks[match]
+				result['serial'][matched] = blocks['serial']
+				result['timestamp'][matched] = blocks['timestamp']
+				for (n, block) in enumerate(layout.blocks):
+					if block[2] is not None:
+						result[block[2]][matched] = blocks['v{}'.format(n)]
+				accepted[matched] = True
+				pending = pending[~match]
+	return result[accepted]
+
+def scale_batch(batch):
+	names = [name for name in sma_units if name != sma_channels[0][0]]
+	scaled = np.empty(len(batch), dtype=[('index', '<u4'), ('serial', '<u4'), ('timestamp', '<u4')] + [(name, '<f8') for name in names])
+	for name in ('index', 'serial', 'timestamp'):
+		scaled[name] = batch[name]
+	for name in names:
+		column = batch[name]
+		scaled[name] = np.where(column == BATCH_MISSING, np.nan, column / sma_value_scale[name])
+	return scaled
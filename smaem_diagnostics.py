@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Self-diagnostics of sma-em.py, published periodically to MQTT
+*
+*  collect() summarizes the internal metrics (smaem_metrics.py) over the time
+*  since the previous call:
+*
+*    meter:    gap between the telegrams of every meter and its jitter,
+*              time the listener waited for the next datagram, datagrams
+*              dropped by the kernel (receive buffer full)
+*    decoder:  mean and 95th percentile of the decode time
+*    broker:   mean and 95th percentile of the time from publish to the
+*              acknowledgement, messages in flight and in the offline queue
+*    process:  threads and resident memory
+*
+*  so a late report can be attributed to the meter, the decoder or the broker.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+from smaem_metrics import TELEGRAMS_RECEIVED, TELEGRAMS_DROPPED, DECODE_SECONDS, RECV_WAIT_SECONDS, \
+	PUBLISH_LATENCY_SECONDS, MQTT_INFLIGHT, MQTT_QUEUED, MQTT_RECONNECTS, TELEGRAM_GAP_SECONDS, \
+	TELEGRAM_JITTER_SECONDS, THREADS, RESIDENT_MEMORY_BYTES, SOCKET_DROPS
+
+#  sensors of the Home Assistant discovery: (key, title, unit, icon)
+DIAGNOSTIC_SENSORS = (
+	('telegrams', 'Telegrams', None, 'mdi:counter'),
+	('dropped', 'Dropped Telegrams', None, 'mdi:delete-alert'),
+	('socket_drops', 'Socket Drops', None, 'mdi:delete-alert'),
+	('recv_wait_ms', 'Receive Wait', 'ms', 'mdi:timer-sand'),
+	('decode_us', 'Decode Time', 'µs', 'mdi:timer-outline'),
+	('decode_p95_us', 'Decode Time P95', 'µs', 'mdi:timer-outline'),
+	('publish_latency_ms', 'Publish Latency', 'ms', 'mdi:timer-outline'),
+	('publish_latency_p95_ms', 'Publish Latency P95', 'ms', 'mdi:timer-outline'),
+	('inflight', 'Messages in Flight', None, 'mdi:email-fast-outline'),
+	('queued', 'Messages Queued', None, 'mdi:inbox-full-outline'),
+	('reconnects', 'MQTT Reconnects', None, 'mdi:lan-disconnect'),
+	('threads', 'Threads', None, 'mdi:cogs'),
+	('rss_mb', 'Resident Memory', 'MB', 'mdi:memory'),
+)
+
+#  sensors of every meter: (key, title, unit, icon)
+METER_DIAGNOSTIC_SENSORS = (
+	('gap_s', 'Telegram Gap', 's', 'mdi:timer-sand'),
+	('jitter_ms', 'Telegram Jitter', 'ms', 'mdi:chart-bell-curve'),
+)
+
+
+def _scaled(value, scale, digits):
+	return round(value * scale, digits) if value is not None else None
+
+
+class Diagnostics:
+	def __init__(self):
+		#  snapshots of the previous call: metric child -> snapshot or value
+		self._previous = {}
+
+	def _summary(self, child):
+		(count, mean, p95, snapshot) = child.summary(self._previous.get(id(child)))
+		self._previous[id(child)] = snapshot
+		return (count, mean, p95)
+
+	def _delta(self, key, value):
+		previous = self._previous.get(key, 0)
+		self._previous[key] = value
+		return value - previous
+
+	def collect(self):
+		(count, recv_wait, recv_wait_p95) = self._summary(RECV_WAIT_SECONDS.labels())
+		(count, decode, decode_p95) = self._summary(DECODE_SECONDS.labels())
+		(count, latency, latency_p95) = self._summary(PUBLISH_LATENCY_SECONDS.labels())
+		dropped = sum(sample[3] for sample in TELEGRAMS_DROPPED.samples())
+		diagnostics = {
+			'telegrams': self._delta('telegrams', TELEGRAMS_RECEIVED.get()),
+			'dropped': self._delta('dropped', dropped),
+			'socket_drops': self._delta('socket_drops', sum(sample[3] for sample in SOCKET_DROPS.samples())),
+			'recv_wait_ms': _scaled(recv_wait, 1000, 1),
+			'decode_us': _scaled(decode, 1000000, 1),
+			'decode_p95_us': _scaled(decode_p95, 1000000, 1),
+			'publish_latency_ms': _scaled(latency, 1000, 1),
+			'publish_latency_p95_ms': _scaled(latency_p95, 1000, 1),
+			'inflight': MQTT_INFLIGHT.get(),
+			'queued': MQTT_QUEUED.get(),
+			'reconnects': MQTT_RECONNECTS.get(),
+			'threads': THREADS.get(),
+			'rss_mb': round(RESIDENT_MEMORY_BYTES.get() / 1048576, 1),
+		}
+		meters = {}
+		for (labelvalues, child) in TELEGRAM_GAP_SECONDS.children():
+			(count, gap, gap_p95) = self._summary(child)
+			jitter = TELEGRAM_JITTER_SECONDS.labels(*labelvalues).get()
+			meters[str(labelvalues[0])] = {'gap_s': _scaled(gap, 1, 3), 'jitter_ms': _scaled(jitter, 1000, 1)}
+		diagnostics['meters'] = meters
+		return diagnostics
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  MQTT discovery of the sensors of sma-em.py in Home Assistant
+*
+*  The retained config payloads of all sensors are kept with a hash of the
+*  payload sent and a hash of the payload the broker holds. The manager
+*  subscribes to the config topics it publishes, so the broker reports its
+*  retained copy right after the subscription and every later change. Only
+*  configs missing on the broker or changed since are published, at most
+*  batch_size per flush(), to avoid a burst of retained messages with many
+*  meters and channels.
+*
+*  The configs held by the broker are checked again
+*    - after every connection to the broker, e.g. after a restart of a
+*      broker without persistence, and
+*    - when Home Assistant comes online (birth message "online" on
+*      homeassistant/status), e.g. after a restart of Home Assistant.
+*  Configs of sensors no longer sent by a device are removed with an empty
+*  retained payload, and so are the configs of stale topics, e.g. of the
+*  topic layout of an older version, whenever the broker holds one. The
+*  current configs are published again after such a removal, Home
+*  Assistant ignores a config with the unique_id of an existing entity.
+*
+*  update(key, configs):  desired {topic: payload} of a device (key)
+*  clear(topics):         stale config topics to remove from the broker
+*  connected():           from on_connect of the MQTT client
+*  on_message():          on_message callback of the MQTT client
+*  flush():               publishes pending configs, called periodically
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import hashlib
+import threading
+from time import monotonic
+from uftools import log
+
+DEFAULT_BIRTH_TOPIC = 'homeassistant/status'
+DEFAULT_BATCH_SIZE = 50
+#  time to wait for the retained configs of the broker after a subscription
+SETTLE_IN_SECONDS = 2.0
+
+
+def _hash(payload):
+	if not payload:
+		return None
+	if isinstance(payload, str):
+		payload = payload.encode('utf-8')
+	return hashlib.sha1(payload).digest()
+
+
+class DiscoveryConfig:
+	__slots__ = ('payload', 'sent', 'broker', 'not_before')
+
+	def __init__(self, payload, not_before):
+		self.payload = payload
+		#  hash of the payload to publish and of the retained payload of the broker
+		self.sent = _hash(payload)
+		self.broker = None
+		self.not_before = not_before
+
+
+class DiscoveryManager:
+	def __init__(self, client, publish, birth_topic=DEFAULT_BIRTH_TOPIC, batch_size=DEFAULT_BATCH_SIZE, on_online=None):
+		self.client = client
+		self.publish = publish
+		self.birth_topic = birth_topic
+		self.batch_size = batch_size
+		self.on_online = on_online
+		self._lock = threading.Lock()
+		self._connected = False
+		#  topic -> DiscoveryConfig
+		self._configs = {}
+		#  key -> topics of the configs of a device
+		self._keys = {}
+		#  topics of removed configs to clear on the broker
+		self._removed = []
+		#  topics of stale configs, cleared if the broker holds them
+		self._stale = set()
+
+	def _subscribe(self, topics):
+		if self._connected and topics:
+			self.client.subscribe([(topic, 0) for topic in topics])
+
+	def update(self, key, configs):
+		with self._lock:
+			now = monotonic()
+			subscribe = []
+			for (topic, payload) in configs.items():
+				config = self._configs.get(topic)
+				if config is None:
+					self._configs[topic] = DiscoveryConfig(payload, now + SETTLE_IN_SECONDS)
+					if topic in self._removed:
+						self._removed.remove(topic)
+					else:
+						subscribe.append(topic)
+				elif config.payload != payload:
+					config.payload = payload
+					config.sent = _hash(payload)
+			for topic in self._keys.get(key, set()).difference(configs):
+				del self._configs[topic]
+				self._removed.append(topic)
+			self._keys[key] = set(configs)
+			self._subscribe(subscribe)
+
+	def clear(self, topics):
+		with self._lock:
+			self._stale.update(topics)
+			self._subscribe(list(topics))
+
+	def verify(self):
+		#  forget the state of the broker and subscribe again, the broker sends
+		#  its retained configs again on every subscription
+		with self._lock:
+			not_before = monotonic() + SETTLE_IN_SECONDS
+			for config in self._configs.values():
+				config.broker = None
+				config.not_before = not_before
+			self._subscribe(list(self._configs) + list(self._stale))
+
+	def connected(self):
+		with self._lock:
+			self._connected = True
+			self.client.subscribe(self.birth_topic, 0)
+		self.verify()
+
+	def disconnected(self):
+		with self._lock:
+			self._connected = False
+
+	def on_message(self, client, userdata, message):
+		if message.topic == self.birth_topic:
+			if message.payload == b'online':
+				log.verbose('* DISCOVERY: Home Assistant online, checking {} configs', len(self._configs))
+				self.verify()
+				if self.on_online is not None:
+					self.on_online()
+			return
+		with self._lock:
+			if message.topic in self._stale:
+				if message.payload and message.topic not in self._removed:
+					log.verbose('* DISCOVERY: removing stale config {}', message.topic)
+					self._removed.append(message.topic)
+					for config in self._configs.values():
+						config.broker = None
+				return
+			config = self._configs.get(message.topic)
+			if config is not None:
+				config.broker = _hash(message.payload)
+
+	def pending(self):
+		with self._lock:
+			return len(self._removed) + sum(1 for config in self._configs.values() if config.sent != config.broker)
+
+	def flush(self):
+		#  publish at most batch_size missing or changed configs, returns the
+		#  number of configs published
+		with self._lock:
+			if not self._connected:
+				return 0
+			now = monotonic()
+			batch = [(topic, '') for topic in self._removed[:self.batch_size]]
+			del self._removed[:len(batch)]
+			for (topic, config) in self._configs.items():
+				if len(batch) >= self.batch_size:
+					break
+				if config.sent != config.broker and config.not_before <= now:
+					batch.append((topic, config.payload))
+					config.broker = config.sent
+			if not batch:
+				return 0
+			removed = [topic for (topic, payload) in batch if not payload]
+			if removed:
+				self.client.unsubscribe(removed)
+		for (topic, payload) in batch:
+			log.debug('* DISCOVERY: publishing {}', topic)
+			self.publish(topic, payload, 1, retain=True)
+		log.verbose('* DISCOVERY: {} configs published', len(batch))
+		return len(batch)
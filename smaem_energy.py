@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Energy and average power per reporting interval, derived from the
+*  counters of the SMA Energy Meter with integer arithmetic
+*
+*  The meter sends its counters as integer Ws (VArs, VAs). The raw integers
+*  are recovered from the decoded values (to_raw() in smaem_decoder.py) and
+*  all differences are computed on them, so no precision is lost however
+*  large the counters are. collect() returns per counter:
+*
+*    <counter>_energy   energy since the previous report in Wh (VArh, VAh)
+*    <counter>_power    average power since the previous report in W (VAr, VA)
+*
+*  A counter going backwards (meter replaced or reset) starts a new base
+*  without reporting a negative energy; the counters are 64 bit and do not
+*  wrap around in practice. The last counters of every meter are kept in a
+*  small state file, so the first report after a restart of the daemon
+*  covers the time it was not running. The state file is replaced
+*  atomically by every collect(): after a crash the daemon continues from
+*  the base of the last report and does not report any energy twice. A
+*  state file that could not be written is written again by save(), called
+*  at shutdown, or by the next collect().
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import json
+import threading
+from time import time
+from uftools import print_line, log
+from smaem_decoder import sma_units, to_raw
+
+#  raw counters are in Ws, energies are reported in Wh
+WS_PER_WH = 3600
+
+
+def energy_units(counter):
+	#  (energy unit, power unit) of a counter, e.g. ('Wh', 'W') for a kWh counter
+	unit = sma_units[counter]
+	return (unit[1:], unit[1:-1])
+
+
+class EnergyTracker:
+	"""
+	*  update(serial, em_data):  listener handler, keeps the latest counters
+	*  collect(serial):          energy and average power since the last call
+	*  save():                   writes the state file if it is not up to date
+	"""
+	def __init__(self, counters, state_path=None):
+		self.counters = tuple(counters)
+		self.state_path = state_path
+		self._lock = threading.Lock()
+		#  serial -> (em_data, time received) of the latest telegram
+		self._latest = {}
+		#  serial -> {'time': <unix time>, <counter>: <raw Ws>, ...} at the last report
+		self._base = self._load()
+		#  version of the base, and the version in the state file
+		self._version = 0
+		self._saved = 0
+		#  orders the writes of the state file
+		self._save_lock = threading.Lock()
+		self.resets = 0
+
+	def _load(self):
+		if not self.state_path or not os.path.exists(self.state_path):
+			return {}
+		try:
+			with open(self.state_path) as state_file:
+				state = json.load(state_file)
+			return dict((int(serial), base) for (serial, base) in state.items())
+		except (OSError, ValueError) as e:
+			print_line('* ENERGY: ignoring state file {}: {}'.format(self.state_path, e), warning=True)
+			return {}
+
+	def save(self):
+		if not self.state_path:
+			return
+		with self._save_lock:
+			with self._lock:
+				if self._saved == self._version:
+					return
+				version = self._version
+				state = dict((str(serial), base) for (serial, base) in self._base.items())
+			temporary = self.state_path + '.tmp'
+			try:
+				with open(temporary, 'w') as state_file:
+					json.dump(state, state_file)
+				os.replace(temporary, self.state_path)
+			except OSError as e:
+				print_line('* ENERGY: could not write state file {}: {}'.format(self.state_path, e), error=True)
+				return
+			self._saved = version
+
+	def update(self, serial, em_data):
+		self._latest[serial] = (em_data, time())
+
+	def collect(self, serial):
+		with self._lock:
+			latest = self._latest.get(serial)
+			if latest is None:
+				return {}
+			(em_data, now) = latest
+			counters = dict((counter, to_raw(counter, em_data[counter])) for counter in self.counters if counter in em_data)
+			base = self._base.get(serial)
+			self._base[serial] = dict(counters, time=now)
+			self._version += 1
+		self.save()
+		if base is None:
+			return {}
+		seconds = now - base['time']
+		result = {}
+		for (counter, raw) in counters.items():
+			if counter not in base:
+				continue
+			delta = raw - base[counter]
+			if delta < 0:
+				#  counter reset, e.g. meter replaced: new base, nothing to report
+				self.resets += 1
+				print_line('* ENERGY: counter {} of meter {} went back from {} to {} Ws, starting a new base'.format(counter, serial, base[counter], raw), warning=True)
+				continue
+			#  int / int is rounded once, the result is exact to the last digit of the float
+			result[counter + '_energy'] = round(delta / WS_PER_WH, 4)
+			if seconds > 0:
+				result[counter + '_power'] = round(delta / seconds, 2)
+		log.debug('* ENERGY: meter {}: {:.1f} s, {}', serial, seconds, result)
+		return result
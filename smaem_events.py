@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Edge-triggered events on the live values of the SMA Energy Meter
+*
+*  Every rule is checked on every telegram, an event is raised only when the
+*  state of a rule changes, e.g. when the power crosses a threshold, and not
+*  again before it crossed back. Kinds of rules:
+*
+*    threshold:    a channel above (or below) a level
+*    sign:         net power p_consume - p_supply changed from consuming
+*                  from the grid to supplying to the grid or back
+*    overcurrent:  the current of a phase (i1, i2, i3) above a limit, one
+*                  state per phase
+*    frequency:    the grid frequency deviates from the nominal frequency
+*                  by more than a limit
+*
+*  With a hysteresis, a rule that fired is only released once the value is
+*  back by the hysteresis beyond its level, so a value oscillating around
+*  the level does not raise an event per telegram.
+*
+*  The rules are compiled once into conditions, each a value getter and a
+*  comparison closure, and bound per device to the channels its firmware
+*  sends (no freq with firmware 1.xxxx). A check is a dictionary lookup
+*  and a comparison per condition. The first telegram of a device sets the
+*  initial states without raising events.
+*
+*  Rules are configured in [Event:<name>] sections of config.ini, see
+*  rule_from_config().
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+from operator import itemgetter
+from uftools import log
+from smaem_decoder import sma_units
+from smaem_metrics import EVENTS_RAISED
+
+DEFAULT_NOMINAL_FREQUENCY = 50.0
+
+
+def _split(value):
+	return value.replace(',', ' ').split()
+
+def _compare(level, hysteresis, below):
+	#  new state of a condition from a value and its current state
+	if below:
+		release = level + hysteresis
+		return lambda value, active: value < release if active else value < level
+	release = level - hysteresis
+	return lambda value, active: value > release if active else value > level
+
+
+class Condition:
+	"""
+	*  One compiled condition of a rule
+	*
+	*  value(em_data):          value checked, from the channels of the telegram
+	*  compare(value, active):  new state
+	*  states:                  names of the (released, fired) states
+	"""
+	__slots__ = ('rule', 'phase', 'channels', 'value', 'compare', 'states')
+
+	def __init__(self, rule, channels, value, compare, states=('off', 'on'), phase=None):
+		self.rule = rule
+		self.phase = phase
+		self.channels = tuple(channels)
+		self.value = value
+		self.compare = compare
+		self.states = states
+
+	def event(self, active, value, em_data):
+		event = {'event': self.rule, 'state': self.states[active], 'value': round(value, 4), 'timestamp': em_data['timestamp']}
+		if self.phase is not None:
+			event['phase'] = self.phase
+		return event
+
+
+def threshold_rule(name, channel, level, hysteresis=0.0, below=False):
+	return [Condition(name, (channel,), itemgetter(channel), _compare(level, hysteresis, below))]
+
+def sign_rule(name, hysteresis=0.0):
+	#  fired while supplying, the net power has to pass zero by half the
+	#  hysteresis in both directions
+	net_power = lambda em_data: em_data['p_consume'] - em_data['p_supply']
+	return [Condition(name, ('p_consume', 'p_supply'), net_power, _compare(-hysteresis / 2, hysteresis, True), ('consume', 'supply'))]
+
+def overcurrent_rule(name, limit, hysteresis=0.0, phases=(1, 2, 3)):
+	return [Condition(name, ('i{}'.format(phase),), itemgetter('i{}'.format(phase)), _compare(limit, hysteresis, False), phase=phase)
+		for phase in phases]
+
+def frequency_rule(name, deviation, hysteresis=0.0, nominal=DEFAULT_NOMINAL_FREQUENCY):
+	#  the value of the event is the deviation, signed
+	return [Condition(name, ('freq',), lambda em_data: em_data['freq'] - nominal,
+		lambda value, active, check=_compare(deviation, hysteresis, False): check(abs(value), active))]
+
+
+class EventEngine:
+	"""
+	*  update(serial, em_data):  listener handler, checks all conditions and
+	*                            calls on_event(serial, em_data, event) for
+	*                            every state that changed
+	*  states(serial):           {rule or rule_l<phase>: state} of a device
+	"""
+	def __init__(self, conditions, on_event):
+		self.conditions = tuple(conditions)
+		self.on_event = on_event
+		#  serial -> [[condition, active], ...] for the channels sent by the device
+		self._devices = {}
+
+	def _add_device(self, serial, em_data):
+		bound = []
+		for condition in self.conditions:
+			if all(channel in em_data for channel in condition.channels):
+				bound.append([condition, condition.compare(condition.value(em_data), False)])
+			else:
+				log.verbose('* EVENTS: rule {} skipped for meter {}, channels {} not sent', condition.rule, serial, ', '.join(condition.channels))
+		self._devices[serial] = bound
+
+	def update(self, serial, em_data):
+		bound = self._devices.get(serial)
+		if bound is None:
+			self._add_device(serial, em_data)
+			return
+		for entry in bound:
+			condition = entry[0]
+			value = condition.value(em_data)
+			active = condition.compare(value, entry[1])
+			if active != entry[1]:
+				entry[1] = active
+				EVENTS_RAISED.labels(condition.rule).inc()
+				self.on_event(serial, em_data, condition.event(active, value, em_data))
+
+	def states(self, serial):
+		states = {}
+		for (condition, active) in self._devices.get(serial, ()):
+			key = condition.rule if condition.phase is None else '{}_l{}'.format(condition.rule, condition.phase)
+			states[key] = condition.states[active]
+		return states
+
+
+def rule_from_config(name, options):
+	#  conditions of an [Event:<name>] section of config.ini, raises
+	#  ValueError if the section is invalid
+	kind = options.get('type', '').lower()
+	hysteresis = options.getfloat('hysteresis', 0.0)
+	if hysteresis < 0:
+		raise ValueError('"hysteresis" must not be negative')
+	if kind == 'threshold':
+		channel = options.get('channel', '')
+		if channel not in sma_units or channel == 'speedwire_version':
+			raise ValueError('invalid channel "{}"'.format(channel))
+		if options.get('above') is not None and options.get('below') is None:
+			return threshold_rule(name, channel, options.getfloat('above'), hysteresis)
+		if options.get('below') is not None and options.get('above') is None:
+			return threshold_rule(name, channel, options.getfloat('below'), hysteresis, below=True)
+		raise ValueError('either "above" or "below" is required')
+	if kind == 'sign':
+		return sign_rule(name, hysteresis)
+	if kind == 'overcurrent':
+		if options.get('limit') is None:
+			raise ValueError('missing "limit"')
+		phases = [int(phase) for phase in _split(options.get('phases', '1, 2, 3'))]
+		if not phases or any(phase not in (1, 2, 3) for phase in phases):
+			raise ValueError('"phases" must be 1, 2 and/or 3')
+		return overcurrent_rule(name, options.getfloat('limit'), hysteresis, phases)
+	if kind == 'frequency':
+		if options.get('deviation') is None:
+			raise ValueError('missing "deviation"')
+		return frequency_rule(name, options.getfloat('deviation'), hysteresis, options.getfloat('nominal', DEFAULT_NOMINAL_FREQUENCY))
+	raise ValueError('"type" must be "threshold", "sign", "overcurrent" or "frequency"')
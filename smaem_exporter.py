@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Prometheus/OpenMetrics endpoint of sma-em.py
+*
+*  GET /metrics returns the latest values of all meters, labeled by serial
+*  and phase, and the internal metrics of the daemon (smaem_metrics.py).
+*
+*  The listener hands every decoded telegram to update(), which only keeps
+*  a reference to it. The body is rendered from these snapshots on the first
+*  scrape after a new telegram and cached, so scrapes never decode anything
+*  and repeated scrapes between two telegrams return the cached body.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from uftools import print_line, log
+from smaem_decoder import sma_channels
+from smaem_metrics import REGISTRY, format_value
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_quantities = {
+	'p': ('active_power', 'Active power'),
+	'q': ('reactive_power', 'Reactive power'),
+	's': ('apparent_power', 'Apparent power'),
+}
+_unit_names = {
+	'W': 'watts', 'VA': 'voltamperes', 'VAr': 'voltamperes_reactive',
+	'kWh': 'kilowatthours', 'kVAh': 'kilovoltamperehours', 'kVArh': 'kilovoltamperehours_reactive',
+	'A': 'amperes', 'V': 'volts', 'Hz': 'hertz', '': 'ratio',
+}
+
+
+def _channel_metrics():
+	#  <value name> -> (metric name, type, help, phase or None)
+	metrics = {}
+	for (index, channel) in sma_channels.items():
+		name = channel[0]
+		match = re.match(r'^([pqs])([123]?)_(consume|supply)$', name)
+		if match:
+			(quantity, phase, direction) = match.groups()
+			(base, text) = _quantities[quantity]
+			metrics[name] = ('smaem_{}_{}_{}'.format(base, direction, _unit_names[channel[1]]), 'gauge', '{}, {}'.format(text, direction), phase or None)
+			metrics[name + '_counter'] = ('smaem_{}_{}_{}_total'.format(base.replace('power', 'energy'), direction, _unit_names[channel[2]]), 'counter', '{} counter, {}'.format(text.replace('power', 'energy'), direction), phase or None)
+			continue
+		match = re.match(r'^(i|u|cosphi)([123]?)$', name)
+		if match:
+			(quantity, phase) = match.groups()
+			(base, text) = {'i': ('current', 'Current'), 'u': ('voltage', 'Voltage'), 'cosphi': ('power_factor', 'Power factor')}[quantity]
+			metrics[name] = ('smaem_{}_{}'.format(base, _unit_names[channel[1]]), 'gauge', text, phase or None)
+		elif name == 'freq':
+			metrics[name] = ('smaem_frequency_hertz', 'gauge', 'Grid frequency', None)
+	return metrics
+
+channel_metrics = _channel_metrics()
+
+
+def render_values(snapshots):
+	#  snapshots: {serial: em_data}, one metric family per metric name
+	families = {}
+	for (serial, em_data) in sorted(snapshots.items()):
+		for (name, value) in em_data.items():
+			metric = channel_metrics.get(name)
+			if metric is None:
+				continue
+			(metric_name, kind, help, phase) = metric
+			family = families.get(metric_name)
+			if family is None:
+				family = families[metric_name] = ['# HELP {} {}'.format(metric_name, help), '# TYPE {} {}'.format(metric_name, kind)]
+			if phase is None:
+				family.append('{}{{serial="{}"}} {}'.format(metric_name, serial, format_value(value)))
+			else:
+				family.append('{}{{serial="{}",phase="L{}"}} {}'.format(metric_name, serial, phase, format_value(value)))
+	lines = [line for family in families.values() for line in family]
+	versions = [(serial, em_data['speedwire_version']) for (serial, em_data) in sorted(snapshots.items()) if 'speedwire_version' in em_data]
+	if versions:
+		lines.append('# HELP smaem_meter_info Software version of the meter')
+		lines.append('# TYPE smaem_meter_info gauge')
+		lines.extend('smaem_meter_info{{serial="{}",version="{}"}} 1'.format(serial, version) for (serial, version) in versions)
+	return '\n'.join(lines) + '\n' if lines else ''
+
+
+class MetricsExporter:
+	"""
+	*  update(serial, em_data):  listener handler, keeps the latest telegram
+	*  body():                   cached /metrics body
+	*  start(), stop():          HTTP server thread
+	"""
+	def __init__(self, address='0.0.0.0', port=9523, registry=REGISTRY, opt_debug=False):
+		self.address = address
+		self.port = port
+		self.registry = registry
+		self.opt_debug = opt_debug
+		self.server = None
+		self._lock = threading.Lock()
+		self._snapshots = {}
+		self._version = 0
+		#  (version, rendered meter values)
+		self._cached = (-1, '')
+
+	def update(self, serial, em_data):
+		#  em_data is not modified after decoding, keeping the reference is enough
+		self._snapshots[serial] = em_data
+		self._version += 1
+
+	def body(self):
+		with self._lock:
+			version = self._version
+			if self._cached[0] != version:
+				self._cached = (version, render_values(dict(self._snapshots)))
+			values = self._cached[1]
+		#  internal metrics change between telegrams (e.g. publish latency)
+		return values + self.registry.render()
+
+	def start(self):
+		exporter = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ('/metrics', '/'):
+					self.send_error(404)
+					return
+				body = exporter.body().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', CONTENT_TYPE)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				log.debug('* EXPORTER: {} {}', self.address_string(), format % args)
+
+		self.server = ThreadingHTTPServer((self.address, self.port), MetricsHandler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, name='smaem-exporter', daemon=True).start()
+		print_line('Serving metrics on http://{}:{}/metrics'.format(self.address, self.port), info=True)
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
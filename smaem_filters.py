@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Deadband and rate limit filters for streaming the live values of the
+*  SMA Energy Meter at the rate of its telegrams (about once per second)
+*
+*  A channel passes the filter only if
+*    - its value changed by at least "deadband" since it was last passed, and
+*    - at least 1/"max_rate" seconds have passed since it was last passed,
+*  or if it has not been passed for "heartbeat" seconds.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+
+class ChannelFilter:
+	__slots__ = ('deadband', 'min_interval', 'heartbeat', 'last_value', 'last_time')
+
+	def __init__(self, deadband=0.0, max_rate=0.0, heartbeat=0.0):
+		self.deadband = deadband
+		self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+		self.heartbeat = heartbeat
+		self.last_value = None
+		self.last_time = float('-inf')
+
+	def check(self, value, now):
+		elapsed = now - self.last_time
+		if elapsed < self.min_interval:
+			return False
+		if self.last_value is not None and abs(value - self.last_value) < self.deadband:
+			if self.heartbeat <= 0 or elapsed < self.heartbeat:
+				return False
+		self.last_value = value
+		self.last_time = now
+		return True
+
+
+class StreamFilter:
+	"""
+	*  Set of channel filters per device (serial)
+	*
+	*  update(serial, em_data, now) returns a dictionary of all channels that
+	*  passed their filter, which is empty if nothing needs to be published
+	"""
+	def __init__(self, channels, deadband=0.0, max_rate=0.0, heartbeat=0.0, deadbands=None, max_rates=None):
+		self.channels = tuple(channels)
+		self.deadband = deadband
+		self.max_rate = max_rate
+		self.heartbeat = heartbeat
+		self.deadbands = deadbands or {}
+		self.max_rates = max_rates or {}
+		#  serial -> ((channel, ChannelFilter), ...)
+		self._devices = {}
+
+	def _add_device(self, serial):
+		filters = tuple((channel, ChannelFilter(
+				self.deadbands.get(channel, self.deadband),
+				self.max_rates.get(channel, self.max_rate),
+				self.heartbeat))
+			for channel in self.channels)
+		self._devices[serial] = filters
+		return filters
+
+	def update(self, serial, em_data, now):
+		filters = self._devices.get(serial)
+		if filters is None:
+			filters = self._add_device(serial)
+		changed = {}
+		for (channel, channel_filter) in filters:
+			value = em_data.get(channel)
+			if value is not None and channel_filter.check(value, now):
+				changed[channel] = value
+		return changed
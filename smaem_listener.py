@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Long-lived listener for the udp telegram messages sent out by the
+*  SMA Energy Meter on port 9522 of the multicast group 239.12.255.254
+*
+*  The listener joins the multicast group once, keeps receiving telegrams in
+*  a background thread and holds the latest decoded snapshot of every device
+*  (Energy Meter or Sunny Home Manager), demultiplexed by serial number, so
+*  that the reporting path never has to wait for the next datagram.
+*
+*  On hosts with several interfaces the group is joined on every configured
+*  interface with a socket of its own; copies of a telegram received on
+*  more than one interface are dropped. The kernel drops of every socket
+*  (receive buffer full) are read from /proc/net/udp.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import sys
+import socket
+import struct
+import selectors
+import threading
+from collections import deque
+from time import time, perf_counter, monotonic
+from uftools import print_line
+from smaem_decoder import check_SMAEM, decode_checked, unpack_batch, TelegramSequence, RELAY_SIGNATURE, TELEGRAM_OK, TELEGRAM_TRUNCATED, \
+	SEQUENCE_NEXT, SEQUENCE_GAP, SEQUENCE_RESTART
+from smaem_metrics import TELEGRAMS_RECEIVED, TELEGRAMS_DECODED, TELEGRAMS_DROPPED, DECODE_SECONDS, RECV_WAIT_SECONDS, TELEGRAM_GAP_SECONDS, TELEGRAM_JITTER_SECONDS, \
+	TELEGRAM_GAPS, TELEGRAMS_MISSED, METER_RESTARTS, SOCKET_DROPS, SOCKET_RECEIVE_QUEUE_BYTES, SOCKET_RECEIVE_BUFFER_BYTES
+
+#  multicast group and port used by the SMA Energy Meter
+MCAST_GRP = '239.12.255.254'
+MCAST_PORT = 9522
+MCAST_BUFSIZE = 1024
+
+#  batches of the udp relay are larger than a single telegram
+RECV_BUFSIZE = 65535
+
+#  dropped datagrams by reason: serial filter, copy received on another interface,
+#  rejected by check_SMAEM() or the sequence
+_dropped_serial = TELEGRAMS_DROPPED.labels('serial')
+_dropped_path = TELEGRAMS_DROPPED.labels('path')
+
+#  timeout of a single select() call, defines how fast the listener reacts to stop()
+RECV_TIMEOUT_IN_SECONDS = 1.0
+
+#  receive buffer of every socket, the default of the kernel overflows with bursts of telegrams
+DEFAULT_RCVBUF = 262144
+
+#  datagrams remembered to drop copies received on more than one interface
+DEDUP_WINDOW = 32
+
+#  Linux: with 0, a socket only receives the groups it joined on the interfaces it joined them
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+
+def _membership(group, interface):
+	#  ip_mreq for the address of an interface, ip_mreqn for its name (Linux)
+	try:
+		return struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface))
+	except OSError:
+		return struct.pack("4s4si", socket.inet_aton(group), socket.inet_aton('0.0.0.0'), socket.if_nametoindex(interface))
+
+def open_multicast_socket(ipbind='0.0.0.0', group=MCAST_GRP, port=MCAST_PORT, exclusive=False):
+	#  --------------------------------------------------------------------
+	#  create socket to listen to UDP broadcasting on MCAST_GRP, MCAST_PORT,
+	#  ipbind is the address or the name of the interface to join the group on
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if exclusive:
+		try:
+			sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+		except OSError:
+			#  not Linux, copies are dropped by the listener
+			pass
+	sock.bind(('', port))
+	sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _membership(group, ipbind))
+	return sock
+
+def open_unicast_socket(ipbind='0.0.0.0', port=MCAST_PORT):
+	#  telegrams relayed to this host by another instance (see smaem_pipeline.py)
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((ipbind, port))
+	return sock
+
+def set_receive_buffer(sock, size):
+	#  size of the receive buffer granted by the kernel, Linux caps it at
+	#  net.core.rmem_max and reports twice the size for its bookkeeping
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+	granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+	return granted // 2 if sys.platform.startswith('linux') else granted
+
+def udp_socket_stats(sock):
+	#  (drops, bytes waiting in the receive queue) of a udp socket from
+	#  /proc/net/udp, (0, 0) where not available
+	try:
+		inode = str(os.fstat(sock.fileno()).st_ino)
+		with open('/proc/net/udp') as udp:
+			next(udp)
+			for line in udp:
+				fields = line.split()
+				if fields[9] == inode:
+					return (int(fields[-1]), int(fields[4].split(':')[1], 16))
+	except (OSError, ValueError, IndexError, StopIteration):
+		pass
+	return (0, 0)
+
+
+class SMAEMListener(threading.Thread):
+	"""
+	*  Receiver thread for SMA Energy Meter telegrams
+	*
+	*  latest():   returns the most recent decoded telegram (em_data dictionary)
+	*              of a device
+	*  serials():  returns the serial numbers of all devices seen so far
+	*  wait():     blocks until the first telegram has been decoded
+	*
+	*  on_new_device(serial, em_data) is called from the listener thread when
+	*  a device is seen for the first time, and again with the next telegram
+	*  if it raised an exception, every handler registered with
+	*  add_handler() is called as handler(serial, em_data) for every telegram. If serials is given, telegrams of
+	*  all other devices are dropped before they are decoded. Every handler registered with add_raw_handler()
+	*  is called as handler(serial, datagram) with the raw telegram before it is decoded.
+	*
+	*  The group is joined on every interface (address or name) of interfaces, with a socket of
+	*  its own. With group None the listener receives relayed telegrams on the unicast addresses
+	*  in interfaces instead. With decode False telegrams are only checked and handed to the raw
+	*  handlers (relay only). dedup drops copies of a datagram received on more than one socket,
+	*  by default if there are several interfaces.
+	"""
+	def __init__(self, interfaces=('0.0.0.0',), group=MCAST_GRP, port=MCAST_PORT, serials=None, opt_debug=False, decode=True,
+			rcvbuf=DEFAULT_RCVBUF, dedup=None):
+		threading.Thread.__init__(self, name='smaem-listener', daemon=True)
+		self.interfaces = [interfaces] if isinstance(interfaces, str) else list(interfaces)
+		self.group = group
+		self.port = port
+		self.rcvbuf = rcvbuf
+		self.dedup = len(self.interfaces) > 1 if dedup is None else dedup
+		self.serials_filter = frozenset(serials) if serials else None
+		self.opt_debug = opt_debug
+		self.decode = decode
+		self.on_new_device = None
+		self.handlers = []
+		self.raw_handlers = []
+		self.sockets = []
+		self._lock = threading.Lock()
+		self._first_telegram = threading.Event()
+		self._running = False
+		#  serial -> (em_data, time received)
+		self._devices = {}
+		#  serials passed to on_new_device() without an error
+		self._announced = set()
+		#  serial -> [monotonic time received, gap to the previous telegram, jitter]
+		self._timing = {}
+		#  serial -> TelegramSequence
+		self._sequences = {}
+		#  latest datagrams, to drop copies received on another interface
+		self._recent = deque(maxlen=DEDUP_WINDOW)
+		self._recent_set = set()
+
+	def open(self):
+		#  one non-blocking socket per interface, received by run() or by the
+		#  asyncio receiver in smaem_async.py
+		for interface in self.interfaces:
+			if self.group:
+				sock = open_multicast_socket(interface, self.group, self.port, exclusive=len(self.interfaces) > 1)
+			else:
+				sock = open_unicast_socket(interface, self.port)
+			sock.setblocking(False)
+			self.sockets.append(sock)
+			if self.rcvbuf:
+				granted = set_receive_buffer(sock, self.rcvbuf)
+				if granted < self.rcvbuf:
+					print_line('* SOCKET: receive buffer on {} limited to {} of {} bytes, raise net.core.rmem_max'.format(interface, granted, self.rcvbuf), warning=True)
+				SOCKET_RECEIVE_BUFFER_BYTES.labels(interface).set(granted)
+			SOCKET_DROPS.labels(interface).set_function(lambda sock=sock: udp_socket_stats(sock)[0])
+			SOCKET_RECEIVE_QUEUE_BYTES.labels(interface).set_function(lambda sock=sock: udp_socket_stats(sock)[1])
+			if self.group:
+				print_line('Successfully connected to multicast group on {}'.format(interface), info=True)
+			else:
+				print_line('Listening for relayed telegrams on {}:{}'.format(interface, self.port), info=True)
+
+	def run(self):
+		self._running = True
+		selector = selectors.DefaultSelector()
+		for sock in self.sockets:
+			selector.register(sock, selectors.EVENT_READ)
+		waiting = perf_counter()
+		while self._running:
+			try:
+				events = selector.select(RECV_TIMEOUT_IN_SECONDS)
+				for (key, mask) in events:
+					try:
+						datagram = key.fileobj.recv(RECV_BUFSIZE)
+					except BlockingIOError:
+						continue
+					RECV_WAIT_SECONDS.observe(perf_counter() - waiting)
+					try:
+						self.receive(datagram)
+					except Exception as e:
+						#  only socket errors end the listener
+						print_line('* LISTENER: telegram of {} bytes failed: {}'.format(len(datagram), e), error=True)
+					waiting = perf_counter()
+			except (OSError, ValueError) as e:
+				if self._running:
+					print_line('* SOCKET: receive error: {}'.format(e), error=True)
+				break
+		selector.close()
+
+	def socket_stats(self):
+		#  [(interface, drops, bytes in the receive queue), ...] of all sockets
+		return [(interface,) + udp_socket_stats(sock) for (interface, sock) in zip(self.interfaces, self.sockets)]
+
+	def receive(self, datagram):
+		if self.dedup:
+			if datagram in self._recent_set:
+				_dropped_path.inc()
+				return
+			if len(self._recent) == DEDUP_WINDOW:
+				self._recent_set.discard(self._recent[0])
+			self._recent.append(datagram)
+			self._recent_set.add(datagram)
+		#  a datagram of the relay may carry several telegrams
+		if datagram[:4] == RELAY_SIGNATURE:
+			for telegram in unpack_batch(datagram):
+				self.process(telegram)
+		else:
+			self.process(datagram)
+
+	def process(self, datagram):
+		#  decode one telegram and store it as latest snapshot of its device
+		TELEGRAMS_RECEIVED.inc()
+		start = perf_counter()
+		check = check_SMAEM(datagram)
+		if check.status != TELEGRAM_OK:
+			#  foreign, clipped or malformed datagram, or without measurements
+			TELEGRAMS_DROPPED.labels(check.status).inc()
+			return None
+		serial = check.serial
+		if self.serials_filter is not None and serial not in self.serials_filter:
+			_dropped_serial.inc()
+			return None
+		if not self._in_sequence(serial, check.ticks):
+			return None
+		for handler in self.raw_handlers:
+			try:
+				handler(serial, datagram)
+			except Exception as e:
+				print_line('* LISTENER: handler {} failed: {}'.format(handler.__name__, e), error=True)
+		if not self.decode:
+			return None
+		em_data = decode_checked(datagram, check, self.opt_debug)
+		DECODE_SECONDS.observe(perf_counter() - start)
+		if not em_data:
+			TELEGRAMS_DROPPED.labels(TELEGRAM_TRUNCATED).inc()
+			return None
+		TELEGRAMS_DECODED.inc()
+		self._observe_timing(serial)
+		with self._lock:
+			is_new = serial not in self._devices
+			self._devices[serial] = (em_data, time())
+		self._first_telegram.set()
+		if is_new:
+			print_line('* new device on multicast group: serial {}'.format(serial), info=True)
+		if self.on_new_device is not None and serial not in self._announced:
+			#  runs on the receive thread: a failure must not stop the reception,
+			#  the device is announced again with its next telegram
+			try:
+				self.on_new_device(serial, em_data)
+				self._announced.add(serial)
+			except Exception as e:
+				print_line('* LISTENER: announcing device {} failed: {}'.format(serial, e), error=True)
+		for handler in self.handlers:
+			try:
+				handler(serial, em_data)
+			except Exception as e:
+				print_line('* LISTENER: handler {} failed: {}'.format(handler.__name__, e), error=True)
+		return em_data
+
+	def _in_sequence(self, serial, ticks):
+		#  duplicated and reordered telegrams would replace a newer snapshot
+		sequence = self._sequences.get(serial)
+		if sequence is None:
+			sequence = self._sequences[serial] = TelegramSequence()
+		missed = sequence.missed
+		result = sequence.update(ticks)
+		if result is SEQUENCE_NEXT:
+			return True
+		if result is SEQUENCE_GAP:
+			TELEGRAM_GAPS.labels(serial).inc()
+			TELEGRAMS_MISSED.labels(serial).inc(sequence.missed - missed)
+			return True
+		if result is SEQUENCE_RESTART:
+			print_line('* meter {} restarted (ticks {})'.format(serial, ticks), warning=True)
+			METER_RESTARTS.labels(serial).inc()
+			return True
+		TELEGRAMS_DROPPED.labels(result).inc()
+		return False
+
+	def sequence(self, serial):
+		#  TelegramSequence of a device (counters of gaps, duplicates, ...)
+		return self._sequences.get(serial)
+
+	def _observe_timing(self, serial):
+		#  gap between the telegrams of a meter and its jitter, smoothed as in RFC 3550
+		now = monotonic()
+		timing = self._timing.get(serial)
+		if timing is None:
+			self._timing[serial] = [now, None, 0.0]
+			return
+		gap = now - timing[0]
+		if timing[1] is not None:
+			timing[2] += (abs(gap - timing[1]) - timing[2]) / 16
+		timing[0] = now
+		timing[1] = gap
+		TELEGRAM_GAP_SECONDS.labels(serial).observe(gap)
+		TELEGRAM_JITTER_SECONDS.labels(serial).set(timing[2])
+
+	def add_handler(self, handler):
+		self.handlers.append(handler)
+
+	def add_raw_handler(self, handler):
+		self.raw_handlers.append(handler)
+
+	def wait(self, timeout=None):
+		return self._first_telegram.wait(timeout)
+
+	def serials(self):
+		with self._lock:
+			return list(self._devices)
+
+	def latest(self, serial=None, max_age=None):
+		#  return latest snapshot of a device (default: first device seen), or an
+		#  empty dictionary if it is unknown or older than max_age seconds
+		with self._lock:
+			if serial is None:
+				serial = next(iter(self._devices), None)
+			(em_data, received) = self._devices.get(serial, ({}, 0.0))
+		if max_age is not None and time() - received > max_age:
+			return {}
+		return em_data
+
+	def snapshot(self, serial, max_age=None):
+		#  (em_data, time received) of the latest telegram of a device, or
+		#  ({}, None) if it is unknown or older than max_age seconds
+		with self._lock:
+			(em_data, received) = self._devices.get(serial, ({}, None))
+		if received is None or (max_age is not None and time() - received > max_age):
+			return ({}, None)
+		return (em_data, received)
+
+	def stop(self):
+		self._running = False
+		for (interface, sock) in zip(self.interfaces, self.sockets):
+			if self.group:
+				try:
+					sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, _membership(self.group, interface))
+				except OSError:
+					pass
+			sock.close()
+		self.sockets = []
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Internal metrics of sma-em.py (counters, gauges and histograms)
+*
+*  All metrics are registered in the module level registry and rendered in
+*  the Prometheus text exposition format by render(). Updating a metric is
+*  a float addition (a few bisect steps for histograms), so they can be
+*  used on the hot path of every telegram.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+#  default buckets in seconds
+DECODE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+GAP_BUCKETS = (0.5, 0.9, 0.95, 0.99, 1.01, 1.05, 1.1, 1.5, 2.0, 5.0, 10.0)
+
+#  acknowledgements kept for messages whose publish() did not return yet
+MAX_EARLY_ACKS = 1000
+
+
+def _labels(labelnames, labelvalues, extra=''):
+	members = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (name, value) in zip(labelnames, labelvalues)]
+	if extra:
+		members.append(extra)
+	return '{{{}}}'.format(','.join(members)) if members else ''
+
+def format_value(value):
+	if value != value:
+		return 'NaN'
+	if value in (float('inf'), float('-inf')):
+		return '+Inf' if value > 0 else '-Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+	"""
+	*  Metric family, labels(*values) returns the child of a set of label values,
+	*  metrics without labels are updated directly
+	"""
+	kind = 'untyped'
+
+	def __init__(self, name, help, labelnames=(), registry=None):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._children = {}
+		self._lock = threading.Lock()
+		if not self.labelnames:
+			self._children[()] = self._new_child()
+		(registry if registry is not None else REGISTRY).register(self)
+
+	def labels(self, *labelvalues):
+		child = self._children.get(labelvalues)
+		if child is None:
+			with self._lock:
+				child = self._children.setdefault(labelvalues, self._new_child())
+		return child
+
+	def remove(self, *labelvalues):
+		with self._lock:
+			self._children.pop(labelvalues, None)
+
+	def __getattr__(self, name):
+		#  inc(), set(), observe() ... of a metric without labels
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return getattr(self._children[()], name)
+
+	def children(self):
+		#  [(labelvalues, child), ...]
+		with self._lock:
+			return list(self._children.items())
+
+	def samples(self):
+		#  [(suffix, labelvalues, extra label, value), ...]
+		return [sample for (labelvalues, child) in self.children() for sample in child.samples(labelvalues)]
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+		for (suffix, labelvalues, extra, value) in self.samples():
+			lines.append('{}{}{} {}'.format(self.name, suffix, _labels(self.labelnames, labelvalues, extra), format_value(value)))
+		return '\n'.join(lines)
+
+
+class _Value:
+	__slots__ = ('value', 'function')
+
+	def __init__(self):
+		self.value = 0
+		self.function = None
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def dec(self, amount=1):
+		self.value -= amount
+
+	def set(self, value):
+		self.value = value
+
+	def set_function(self, function):
+		#  value is read from function() when the metric is rendered
+		self.function = function
+
+	def get(self):
+		return self.function() if self.function is not None else self.value
+
+	def samples(self, labelvalues):
+		return [('', labelvalues, '', self.get())]
+
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def __init__(self, name, help, labelnames=(), registry=None):
+		#  family and samples are named <name>_total
+		Metric.__init__(self, name if name.endswith('_total') else name + '_total', help, labelnames, registry)
+
+	def _new_child(self):
+		return _Value()
+
+
+class Gauge(Metric):
+	kind = 'gauge'
+
+	def _new_child(self):
+		return _Value()
+
+
+class _HistogramValue:
+	__slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		n = bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[n] += 1
+			self.sum += value
+			self.count += 1
+
+	def snapshot(self):
+		with self.lock:
+			return (list(self.counts), self.sum, self.count)
+
+	def summary(self, previous=None):
+		#  (count, mean, upper bound of the 95th percentile) of all values
+		#  observed since the snapshot previous, plus the new snapshot
+		(counts, total, count) = snapshot = self.snapshot()
+		if previous is not None:
+			counts = [a - b for (a, b) in zip(counts, previous[0])]
+			total -= previous[1]
+			count -= previous[2]
+		if count <= 0:
+			return (0, None, None, snapshot)
+		cumulative = 0
+		p95 = self.buckets[-1]
+		for (bound, bucket_count) in zip(self.buckets, counts):
+			cumulative += bucket_count
+			if cumulative >= 0.95 * count:
+				p95 = bound
+				break
+		return (count, total / count, p95, snapshot)
+
+	def samples(self, labelvalues):
+		(counts, total, count) = self.snapshot()
+		samples = []
+		cumulative = 0
+		for (bound, bucket_count) in zip(self.buckets + (float('inf'),), counts):
+			cumulative += bucket_count
+			samples.append(('_bucket', labelvalues, 'le="{}"'.format(format_value(float(bound))), cumulative))
+		samples.append(('_sum', labelvalues, '', total))
+		samples.append(('_count', labelvalues, '', count))
+		return samples
+
+
+class Histogram(Metric):
+	kind = 'histogram'
+
+	def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+		self.buckets = tuple(sorted(buckets))
+		Metric.__init__(self, name, help, labelnames, registry)
+
+	def _new_child(self):
+		return _HistogramValue(self.buckets)
+
+
+class Registry:
+	def __init__(self):
+		self._metrics = []
+		self._lock = threading.Lock()
+
+	def register(self, metric):
+		with self._lock:
+			self._metrics.append(metric)
+
+	def metrics(self):
+		with self._lock:
+			return list(self._metrics)
+
+	def render(self):
+		return '\n'.join(metric.render() for metric in self.metrics()) + '\n'
+
+REGISTRY = Registry()
+
+
+class PublishTracker:
+	"""
+	*  Latency from publish() to the acknowledgement of the broker (on_publish)
+	*
+	*  paho may call on_publish before publish() returned the message id, both
+	*  orders are handled.
+	"""
+	def __init__(self, histogram):
+		self.histogram = histogram
+		self._lock = threading.Lock()
+		#  mid -> time publish() was called, or time on_publish was called first
+		self._started = {}
+		self._acked = {}
+
+	def published(self, mid, started):
+		with self._lock:
+			acked = self._acked.pop(mid, None)
+			if acked is None:
+				self._started[mid] = started
+				return
+		self.histogram.observe(acked - started)
+
+	def acknowledged(self, mid):
+		now = perf_counter()
+		with self._lock:
+			started = self._started.pop(mid, None)
+			if started is None:
+				#  messages not published through published() are never picked up
+				if len(self._acked) >= MAX_EARLY_ACKS:
+					self._acked.clear()
+				self._acked[mid] = now
+				return
+		self.histogram.observe(now - started)
+
+	def pending(self):
+		#  messages published, but not yet acknowledged
+		return len(self._started)
+
+	def reset(self):
+		#  after a reconnect paho resends or drops the messages in flight
+		with self._lock:
+			self._started.clear()
+			self._acked.clear()
+
+
+def resident_memory_bytes():
+	#  resident set size of the process, 0 if /proc is not available
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, IndexError):
+		return 0
+
+
+#  metrics of the daemon
+TELEGRAMS_RECEIVED = Counter('smaem_telegrams_received', 'Datagrams received on the multicast group')
+TELEGRAMS_DECODED = Counter('smaem_telegrams_decoded', 'Telegrams decoded into measurements')
+TELEGRAMS_DROPPED = Counter('smaem_telegrams_dropped', 'Datagrams dropped before or after decoding', ('reason',))
+DECODE_SECONDS = Histogram('smaem_decode_seconds', 'Time to decode one telegram', buckets=DECODE_BUCKETS)
+PUBLISH_LATENCY_SECONDS = Histogram('smaem_publish_latency_seconds', 'Time from publish to the acknowledgement of the MQTT broker')
+MQTT_INFLIGHT = Gauge('smaem_mqtt_inflight_messages', 'Messages published, but not yet acknowledged by the MQTT broker')
+MQTT_QUEUED = Gauge('smaem_mqtt_offline_queue_messages', 'Messages stored in the offline queue')
+MQTT_CONNECTED = Gauge('smaem_mqtt_connected', 'Connection state of the MQTT client (1 = connected)')
+MQTT_RECONNECTS = Counter('smaem_mqtt_reconnects', 'Connections to the MQTT broker after the first one')
+RECV_WAIT_SECONDS = Histogram('smaem_recv_wait_seconds', 'Time the listener waited in recv() for the next datagram', buckets=GAP_BUCKETS)
+TELEGRAM_GAP_SECONDS = Histogram('smaem_telegram_gap_seconds', 'Time between two telegrams of a meter', ('serial',), buckets=GAP_BUCKETS)
+TELEGRAM_JITTER_SECONDS = Gauge('smaem_telegram_jitter_seconds', 'Smoothed variation of the time between two telegrams of a meter (RFC 3550)', ('serial',))
+THREADS = Gauge('smaem_threads', 'Threads of the daemon')
+RESIDENT_MEMORY_BYTES = Gauge('smaem_resident_memory_bytes', 'Resident memory of the daemon')
+THREADS.set_function(threading.active_count)
+RESIDENT_MEMORY_BYTES.set_function(resident_memory_bytes)
+TELEGRAM_GAPS = Counter('smaem_telegram_gaps', 'Gaps in the sequence of telegrams of a meter', ('serial',))
+TELEGRAMS_MISSED = Counter('smaem_telegrams_missed', 'Telegrams of a meter missed in gaps of the sequence', ('serial',))
+METER_RESTARTS = Counter('smaem_meter_restarts', 'Restarts of a meter detected from its ticks', ('serial',))
+SINK_QUEUED = Gauge('smaem_sink_queued_items', 'Items waiting in the queue of an output of the pipeline', ('sink',))
+SINK_WRITTEN = Counter('smaem_sink_written', 'Items written by an output of the pipeline', ('sink',))
+SINK_DROPPED = Counter('smaem_sink_dropped', 'Items dropped because the queue of an output was full', ('sink',))
+SINK_ERRORS = Counter('smaem_sink_errors', 'Items an output of the pipeline failed to write', ('sink',))
+SOCKET_DROPS = Counter('smaem_socket_drops', 'Datagrams dropped by the kernel on a socket of the listener, e.g. receive buffer full', ('interface',))
+SOCKET_RECEIVE_QUEUE_BYTES = Gauge('smaem_socket_receive_queue_bytes', 'Bytes waiting in the receive queue of a socket of the listener', ('interface',))
+SOCKET_RECEIVE_BUFFER_BYTES = Gauge('smaem_socket_receive_buffer_bytes', 'Receive buffer of a socket of the listener granted by the kernel', ('interface',))
+EVENTS_RAISED = Counter('smaem_events_raised', 'Events raised by a rule of the event engine', ('rule',))
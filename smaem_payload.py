@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Pre-serialized JSON payloads for the values published by sma-em.py
+*
+*  The structure and keys of a report only change if the set of reported
+*  channels changes, so the static part of the JSON document is serialized
+*  once into a %-format template. Rendering a report then only formats the
+*  values. All fragments are serialized without blanks (SEPARATORS), the
+*  same way as the payloads built by json.dumps() in sma-em.py.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import json
+
+#  compact JSON, as in json.dumps(value, separators=SEPARATORS)
+SEPARATORS = (',', ':')
+
+class PayloadTemplate:
+	"""
+	*  JSON document {"<name>": {"<key>": <value>, ...}} with a fixed set of keys
+	*
+	*  render(values, extra) formats the values in the order of keys, numbers by
+	*  their repr() and the values of string_keys JSON encoded, and appends the
+	*  members of the optional dictionary extra
+	"""
+	__slots__ = ('keys', 'template', 'strings')
+
+	def __init__(self, keys, name='info', string_keys=()):
+		self.keys = tuple(keys)
+		self.strings = tuple(n for (n, key) in enumerate(self.keys) if key in string_keys)
+		members = ','.join('{}:{}'.format(_quote(key), '%s' if n in self.strings else '%r') for (n, key) in enumerate(self.keys))
+		self.template = '{{{}:{{{}%s}}}}'.format(_quote(name), members)
+
+	def render(self, values, extra=None):
+		if self.strings:
+			values = list(values)
+			for n in self.strings:
+				values[n] = json.dumps(values[n])
+			values = tuple(values)
+		if extra:
+			members = json.dumps(extra, separators=SEPARATORS)[1:-1]
+			return self.template % (values + ((',' + members) if self.keys else members,))
+		return self.template % (values + ('',))
+
+def _quote(key):
+	return json.dumps(key).replace('%', '%%')
@@ -0,0 +1,543 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Output pipeline of sma-em.py: fan-out of the telegrams of the SMA Energy
+*  Meter to several outputs at once
+*
+*  Every output is a chain of stages and a sink. The stages run in the
+*  listener thread on every decoded snapshot (em_data), each one returns a
+*  new snapshot or None to drop it:
+*
+*    SerialFilter:    only the telegrams of some meters
+*    Downsample:      first telegram of every interval of the meter clock
+*    Aggregate:       min/max/mean/last and counter deltas of every interval
+*                     (smaem_aggregator.py) instead of the telegrams
+*    SelectChannels:  only some channels
+*
+*  Every sink has its own bounded queue and thread, so a slow or unreachable
+*  output only drops its own oldest items and never stalls the listener or
+*  the other outputs:
+*
+*    MQTTSink:        an additional MQTT broker, own paho client
+*    UDPSink:         relay of the raw telegrams to unicast addresses or to a
+*                     multicast group, optionally batched, for networks
+*                     without multicast routing
+*    JSONLinesSink:   one JSON document per line in a local file
+*    UnixSocketSink:  one JSON document per line to every client connected
+*                     to a unix stream socket
+*
+*  Outputs are configured in [Output:<name>] sections of config.ini, see
+*  output_from_config().
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import ssl
+import stat
+import json
+import socket
+import ipaddress
+import threading
+from time import monotonic
+from collections import deque
+import paho.mqtt.client as mqtt
+from uftools import print_line, log
+from smaem_decoder import sma_units, pack_batch, RELAY_MAX_COUNT
+from smaem_listener import MCAST_PORT
+from smaem_aggregator import WindowAggregator
+from smaem_metrics import SINK_QUEUED, SINK_WRITTEN, SINK_DROPPED, SINK_ERRORS
+
+#  sources of an output: decoded snapshots, raw telegrams or the reports of sma-em.py
+SOURCE_TELEGRAMS = 'telegrams'
+SOURCE_RAW = 'raw'
+SOURCE_REPORTS = 'reports'
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_TOPIC = 'smaem/{serial}'
+
+#  a batch of the udp relay fits into one ethernet frame by default
+DEFAULT_BATCH_BYTES = 1400
+
+#  a unix socket client not reading for this long is disconnected
+CLIENT_TIMEOUT_IN_SECONDS = 1.0
+
+
+def _serialize(data):
+	#  reports are already serialized, snapshots are sent as compact JSON
+	return data if isinstance(data, str) else json.dumps(data, separators=(',', ':'))
+
+def _split(value):
+	return value.replace(',', ' ').split()
+
+
+"""
+*  Stages
+"""
+class SerialFilter:
+	def __init__(self, serials):
+		self.serials = frozenset(serials)
+
+	def __call__(self, serial, data):
+		return data if serial in self.serials else None
+
+
+class SelectChannels:
+	def __init__(self, channels):
+		#  the serial and the timestamp of the meter are always kept
+		self.keys = ('serial', 'timestamp') + tuple(channels)
+
+	def __call__(self, serial, data):
+		return dict((key, data[key]) for key in self.keys if key in data)
+
+
+class Downsample:
+	def __init__(self, interval_in_seconds):
+		self.interval_ms = int(round(interval_in_seconds * 1000))
+		#  serial -> interval of the meter clock of the last telegram
+		self._slots = {}
+
+	def __call__(self, serial, data):
+		slot = data['timestamp'] // self.interval_ms
+		previous = self._slots.get(serial)
+		self._slots[serial] = slot
+		return data if slot != previous else None
+
+
+class Aggregate:
+	def __init__(self, channels, counters, interval_in_seconds):
+		self.aggregator = WindowAggregator(channels, counters)
+		self.interval_ms = int(round(interval_in_seconds * 1000))
+		self._slots = {}
+
+	def __call__(self, serial, data):
+		#  the first telegram of an interval closes the window of the previous one
+		slot = data['timestamp'] // self.interval_ms
+		previous = self._slots.get(serial)
+		self._slots[serial] = slot
+		result = None
+		if previous is not None and slot != previous:
+			result = dict(serial=serial, timestamp=data['timestamp'])
+			result.update(self.aggregator.collect(serial))
+		self.aggregator.update(serial, data)
+		return result
+
+
+"""
+*  Sinks
+"""
+class Sink(threading.Thread):
+	"""
+	*  Output with its own bounded queue and thread
+	*
+	*  put(serial, data):  never blocks, drops the oldest item if the queue is full
+	*  open(), write(serial, data), flush() and close() are implemented by the
+	*  sinks, all but open() run in the thread of the sink. flush() is called
+	*  whenever the queue is empty and after timeout() seconds without items.
+	*
+	*  data is a snapshot (dict), a report (str) or, for sinks with raw = True,
+	*  a raw telegram (bytes)
+	"""
+	raw = False
+
+	def __init__(self, name, queue_size=DEFAULT_QUEUE_SIZE):
+		threading.Thread.__init__(self, name='smaem-sink-{}'.format(name), daemon=True)
+		self.sink_name = name
+		self._queue = deque(maxlen=queue_size)
+		self._wakeup = threading.Event()
+		self._running = True
+		self._failing = False
+		self._written = SINK_WRITTEN.labels(name)
+		self._dropped = SINK_DROPPED.labels(name)
+		self._errors = SINK_ERRORS.labels(name)
+		SINK_QUEUED.labels(name).set_function(self.queued)
+
+	def queued(self):
+		return len(self._queue)
+
+	def put(self, serial, data):
+		if len(self._queue) == self._queue.maxlen:
+			self._dropped.inc()
+		self._queue.append((serial, data))
+		self._wakeup.set()
+
+	def run(self):
+		while self._running:
+			self._wakeup.wait(self.timeout())
+			self._wakeup.clear()
+			self._drain()
+		self._drain()
+		self.close()
+
+	def _drain(self):
+		queue = self._queue
+		while queue:
+			(serial, data) = queue.popleft()
+			try:
+				self.write(serial, data)
+			except Exception as e:
+				self._errors.inc()
+				if not self._failing:
+					#  reported once, not for every telegram
+					print_line('* OUTPUT {}: write failed: {}'.format(self.sink_name, e), warning=True)
+					self._failing = True
+				continue
+			self._written.inc()
+			if self._failing:
+				print_line('* OUTPUT {}: writing again'.format(self.sink_name), info=True)
+				self._failing = False
+		try:
+			self.flush()
+		except Exception as e:
+			self._errors.inc()
+			log.debug('* OUTPUT {}: flush failed: {}', self.sink_name, e)
+
+	def stop(self, timeout=2.0):
+		self._running = False
+		self._wakeup.set()
+		if self.is_alive():
+			self.join(timeout)
+
+	def open(self):
+		pass
+
+	def timeout(self):
+		#  seconds until flush() has something to do without new items
+		return None
+
+	def write(self, serial, data):
+		raise NotImplementedError
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+
+class MQTTSink(Sink):
+	"""
+	*  Publishes every item to topic (may contain {serial}) of an additional
+	*  broker, paho reconnects by itself while the broker is unreachable
+	"""
+	def __init__(self, name, hostname, port=1883, topic=DEFAULT_TOPIC, qos=0, retain=False,
+			username=None, password=None, tls=None, keepalive=60, queue_size=DEFAULT_QUEUE_SIZE):
+		Sink.__init__(self, name, queue_size)
+		self.hostname = hostname
+		self.port = port
+		self.topic = topic
+		self.qos = qos
+		self.retain = retain
+		self.keepalive = keepalive
+		self.client = mqtt.Client()
+		if username:
+			self.client.username_pw_set(username, password)
+		if tls is not None:
+			self.client.tls_set(tls_version=ssl.PROTOCOL_SSLv23, **tls)
+
+	def open(self):
+		self.client.connect_async(self.hostname, self.port, self.keepalive)
+		self.client.loop_start()
+
+	def write(self, serial, data):
+		info = self.client.publish(self.topic.format(serial=serial), _serialize(data), self.qos, retain=self.retain)
+		if info.rc != mqtt.MQTT_ERR_SUCCESS:
+			raise OSError('publish to {}:{} failed: {}'.format(self.hostname, self.port, mqtt.error_string(info.rc)))
+
+	def close(self):
+		self.client.disconnect()
+		self.client.loop_stop()
+
+
+class UDPSink(Sink):
+	"""
+	*  Relays the raw telegrams to one or more targets (address, port), unicast
+	*  or multicast, for networks without multicast routing
+	*
+	*  With batch_delay 0 every telegram is sent unchanged and can be received
+	*  by any program reading the telegrams of the meter. Otherwise telegrams
+	*  are held up to batch_delay seconds and sent together in one datagram of
+	*  at most batch_bytes (pack_batch() in smaem_decoder.py), which only
+	*  sma-em.py receiving on a unicast port understands.
+	"""
+	raw = True
+
+	def __init__(self, name, targets, ttl=1, interface=None, batch_delay=0.0, batch_bytes=DEFAULT_BATCH_BYTES, queue_size=DEFAULT_QUEUE_SIZE):
+		Sink.__init__(self, name, queue_size)
+		self.targets = list(targets)
+		self.ttl = ttl
+		self.interface = interface
+		self.batch_delay = batch_delay
+		self.batch_bytes = batch_bytes
+		self.sock = None
+		self._batch = []
+		self._batch_size = 0
+		self._deadline = None
+
+	def open(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+		for (address, port) in self.targets:
+			try:
+				multicast = ipaddress.ip_address(address).is_multicast
+			except ValueError:
+				#  host name
+				multicast = False
+			if multicast:
+				sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+				if self.interface:
+					sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+				break
+		self.sock = sock
+
+	def _send(self, datagram):
+		for target in self.targets:
+			self.sock.sendto(datagram, target)
+
+	def _send_batch(self):
+		batch = self._batch
+		self._batch = []
+		self._batch_size = 0
+		self._deadline = None
+		#  a single telegram is sent unchanged
+		self._send(batch[0] if len(batch) == 1 else pack_batch(batch))
+
+	def write(self, serial, datagram):
+		if self.batch_delay <= 0:
+			self._send(datagram)
+			return
+		size = 2 + len(datagram)
+		if self._batch and (self._batch_size + size > self.batch_bytes or len(self._batch) == RELAY_MAX_COUNT):
+			self._send_batch()
+		if not self._batch:
+			self._deadline = monotonic() + self.batch_delay
+			self._batch_size = 6
+		self._batch.append(datagram)
+		self._batch_size += size
+
+	def timeout(self):
+		if self._deadline is None:
+			return None
+		return max(0.0, self._deadline - monotonic())
+
+	def flush(self):
+		if self._batch and monotonic() >= self._deadline:
+			self._send_batch()
+
+	def close(self):
+		if self.sock is not None:
+			if self._batch:
+				self._send_batch()
+			self.sock.close()
+			self.sock = None
+
+
+class JSONLinesSink(Sink):
+	def __init__(self, name, path, queue_size=DEFAULT_QUEUE_SIZE):
+		Sink.__init__(self, name, queue_size)
+		self.path = path
+		self._file = None
+
+	def open(self):
+		self._file = open(self.path, 'a', buffering=65536)
+
+	def write(self, serial, data):
+		self._file.write(_serialize(data) + '\n')
+
+	def flush(self):
+		#  once the queue is empty, not for every line
+		self._file.flush()
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+class UnixSocketSink(Sink):
+	"""
+	*  Serves the items on a unix stream socket, clients connect at any time
+	*  and get every item from then on; a client that does not read is
+	*  disconnected after CLIENT_TIMEOUT_IN_SECONDS
+	"""
+	def __init__(self, name, path, queue_size=DEFAULT_QUEUE_SIZE):
+		Sink.__init__(self, name, queue_size)
+		self.path = path
+		self.server = None
+		self.clients = []
+
+	def open(self):
+		if os.path.exists(self.path):
+			if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+				raise OSError('{} exists and is not a socket'.format(self.path))
+			#  left over by a previous run
+			os.unlink(self.path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.path)
+		server.listen(8)
+		server.setblocking(False)
+		self.server = server
+
+	def _accept(self):
+		while True:
+			try:
+				(client, address) = self.server.accept()
+			except (BlockingIOError, InterruptedError):
+				return
+			client.settimeout(CLIENT_TIMEOUT_IN_SECONDS)
+			self.clients.append(client)
+			log.debug('* OUTPUT {}: client connected, {} clients', self.sink_name, len(self.clients))
+
+	def write(self, serial, data):
+		self._accept()
+		line = (_serialize(data) + '\n').encode('utf-8')
+		for client in list(self.clients):
+			try:
+				client.sendall(line)
+			except OSError:
+				client.close()
+				self.clients.remove(client)
+				log.debug('* OUTPUT {}: client disconnected, {} clients', self.sink_name, len(self.clients))
+
+	def close(self):
+		for client in self.clients:
+			client.close()
+		self.clients = []
+		if self.server is not None:
+			self.server.close()
+			self.server = None
+			try:
+				os.unlink(self.path)
+			except OSError:
+				pass
+
+
+"""
+*  Pipeline
+"""
+class Pipeline:
+	"""
+	*  add(sink, stages, source):  output fed by the snapshots, raw telegrams or
+	*                              reports, through its stages
+	*  attach(listener):           registers the handlers needed by the outputs
+	*  report(serial, payload):    hands a report of sma-em.py to the outputs
+	*  start(), stop():            opens and closes all sinks
+	"""
+	def __init__(self):
+		#  source -> [(stages, sink), ...]
+		self.routes = {SOURCE_TELEGRAMS: [], SOURCE_RAW: [], SOURCE_REPORTS: []}
+
+	def add(self, sink, stages=(), source=SOURCE_TELEGRAMS):
+		if sink.raw:
+			source = SOURCE_RAW
+		self.routes[source].append((tuple(stages), sink))
+
+	def sinks(self):
+		return [sink for routes in self.routes.values() for (stages, sink) in routes]
+
+	def attach(self, listener):
+		if self.routes[SOURCE_TELEGRAMS]:
+			listener.add_handler(self.process)
+		if self.routes[SOURCE_RAW]:
+			listener.add_raw_handler(self.relay)
+
+	def _route(self, source, serial, data):
+		for (stages, sink) in self.routes[source]:
+			item = data
+			for stage in stages:
+				item = stage(serial, item)
+				if item is None:
+					break
+			else:
+				sink.put(serial, item)
+
+	def process(self, serial, em_data):
+		#  em_data is shared with the other handlers, stages return new dictionaries
+		self._route(SOURCE_TELEGRAMS, serial, em_data)
+
+	def relay(self, serial, datagram):
+		self._route(SOURCE_RAW, serial, datagram)
+
+	def report(self, serial, payload):
+		if self.routes[SOURCE_REPORTS]:
+			self._route(SOURCE_REPORTS, serial, payload)
+
+	def start(self):
+		for sink in self.sinks():
+			sink.open()
+			sink.start()
+			print_line('Output {}: {}'.format(sink.sink_name, type(sink).__name__), info=True)
+
+	def stop(self):
+		for sink in self.sinks():
+			sink.stop()
+
+
+def output_from_config(name, options):
+	#  (sink, stages, source) of an [Output:<name>] section of config.ini,
+	#  raises ValueError if the section is invalid
+	kind = options.get('type', '').lower()
+	source = options.get('source', SOURCE_TELEGRAMS).lower()
+	queue_size = options.getint('queue_size', DEFAULT_QUEUE_SIZE)
+	if queue_size < 1:
+		raise ValueError('queue_size must be at least 1')
+	if kind == 'mqtt':
+		tls = None
+		if options.getboolean('tls', False):
+			tls = dict(ca_certs=options.get('tls_ca_cert', None), keyfile=options.get('tls_keyfile', None), certfile=options.get('tls_certfile', None))
+		sink = MQTTSink(name, options.get('hostname', 'localhost'), options.getint('port', 1883), options.get('topic', DEFAULT_TOPIC),
+			options.getint('qos', 0), options.getboolean('retain', False), options.get('username', None), options.get('password', None),
+			tls, options.getint('keepalive', 60), queue_size)
+	elif kind == 'udp':
+		port = options.getint('port', MCAST_PORT)
+		targets = []
+		for target in _split(options.get('address', '')):
+			#  <address> or <address>:<port>
+			(address, separator, target_port) = target.partition(':')
+			targets.append((address, int(target_port) if separator else port))
+		if not targets:
+			raise ValueError('missing "address"')
+		batch_delay = options.getfloat('batch_delay_in_ms', 0.0) / 1000
+		batch_bytes = options.getint('batch_size_in_bytes', DEFAULT_BATCH_BYTES)
+		if batch_bytes < 1024 or batch_bytes > 65000:
+			raise ValueError('"batch_size_in_bytes" must be between [1024 - 65000]')
+		sink = UDPSink(name, targets, options.getint('ttl', 1), options.get('interface', None), batch_delay, batch_bytes, queue_size)
+		source = SOURCE_RAW
+	elif kind in ('file', 'unix'):
+		if not options.get('path'):
+			raise ValueError('missing "path"')
+		sink = (JSONLinesSink if kind == 'file' else UnixSocketSink)(name, options.get('path'), queue_size)
+	else:
+		raise ValueError('"type" must be "mqtt", "udp", "file" or "unix"')
+	if source not in (SOURCE_TELEGRAMS, SOURCE_REPORTS, SOURCE_RAW) or (source == SOURCE_RAW and kind != 'udp'):
+		raise ValueError('"source" must be "telegrams" or "reports"')
+
+	stages = []
+	serials = [int(serial) for serial in _split(options.get('serials', ''))]
+	if serials:
+		stages.append(SerialFilter(serials))
+	if source != SOURCE_TELEGRAMS:
+		return (sink, stages, source)
+	interval = options.getfloat('interval_in_seconds', 0.0)
+	channels = _split(options.get('channels', ''))
+	aggregate_channels = _split(options.get('aggregate_channels', ''))
+	aggregate_counters = _split(options.get('aggregate_counters', ''))
+	for channel in channels + aggregate_channels + aggregate_counters:
+		if channel not in sma_units:
+			raise ValueError('invalid channel "{}"'.format(channel))
+	if interval < 0:
+		raise ValueError('"interval_in_seconds" must not be negative')
+	if aggregate_channels or aggregate_counters:
+		if interval <= 0:
+			raise ValueError('aggregation requires "interval_in_seconds"')
+		stages.append(Aggregate(aggregate_channels, aggregate_counters, interval))
+	else:
+		if interval > 0:
+			stages.append(Downsample(interval))
+		if channels:
+			stages.append(SelectChannels(channels))
+	return (sink, stages, source)
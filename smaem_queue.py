@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Offline store-and-forward queue for MQTT publishes
+*
+*  Reports that can not be published while the broker is down or the client
+*  is reconnecting are persisted in a bounded ring buffer in a SQLite file.
+*  Once the connection is back they are read back in batches in the order
+*  they were stored, and deleted when the broker acknowledged them.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import sqlite3
+import threading
+from uftools import print_line
+
+
+class OfflineQueue:
+	"""
+	*  put(topic, payload, qos, retain):  store a message, dropping the oldest
+	*                                     one if the queue is full
+	*  peek(count, after):                up to count messages with a row id
+	*                                     larger than after, oldest first
+	*  delete(rowids):                    remove acknowledged messages
+	"""
+	def __init__(self, path, max_messages=100000):
+		self.path = path
+		self.max_messages = max_messages
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB, qos INTEGER, retain INTEGER)')
+		self.count = self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+		self.dropped = 0
+		if self.count:
+			print_line('* QUEUE: {} unsent messages in {}'.format(self.count, path), info=True)
+
+	def put(self, topic, payload, qos=1, retain=False):
+		with self._lock:
+			self._db.execute('INSERT INTO messages (topic, payload, qos, retain) VALUES (?, ?, ?, ?)', (topic, payload, qos, int(retain)))
+			self.count += 1
+			if self.count > self.max_messages:
+				#  ring buffer: drop the oldest messages
+				excess = self.count - self.max_messages
+				self._db.execute('DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)', (excess,))
+				self.count -= excess
+				self.dropped += excess
+
+	def peek(self, count, after=0):
+		with self._lock:
+			return self._db.execute('SELECT id, topic, payload, qos, retain FROM messages WHERE id > ? ORDER BY id LIMIT ?', (after, count)).fetchall()
+
+	def delete(self, rowids):
+		if not rowids:
+			return
+		with self._lock:
+			cursor = self._db.execute('DELETE FROM messages WHERE id IN ({})'.format(','.join('?' * len(rowids))), tuple(rowids))
+			self.count -= cursor.rowcount
+
+	def close(self):
+		with self._lock:
+			self._db.close()
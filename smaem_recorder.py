@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Local time-series recorder for the decoded SMA Energy Meter telegrams
+*
+*  Values are stored column by column, one file per channel, each a packed
+*  array of fixed-width items in native byte order, so every column can be
+*  memory-mapped and read without parsing. A new directory is started every
+*  day:
+*
+*    <path>/<serial>/<YYYY-MM-DD>/meta.json     columns, type codes, scales
+*    <path>/<serial>/<YYYY-MM-DD>/time.d        receive time (unix, float64)
+*    <path>/<serial>/<YYYY-MM-DD>/<channel>.<t> one value per record
+*
+*  Telegrams are stored with the raw integer values of the meter (uint32 for
+*  actual values, uint64 for counters), about 340 bytes per telegram with all
+*  channels. A channel not sent in a telegram is stored as RAW_MISSING (all
+*  bits set, never sent by a meter), query() returns it as NaN. Aggregates
+*  (floats) are stored as float64, NaN if missing.
+*
+*  The columns of a day are declared when the day is started, from the
+*  configured channels (telegrams) or value names (aggregates), and not from
+*  the first record, which may lack some of them.
+*
+*  query() reads a range of records by timestamp.
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import json
+import mmap
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from uftools import print_line
+from smaem_decoder import sma_value_scale
+
+TIME_COLUMN = 'time'
+META_FILE = 'meta.json'
+#  raw value of a channel missing in a telegram, per type code
+RAW_MISSING = {'I': 0xffffffff, 'Q': 0xffffffffffffffff}
+_NAN = float('nan')
+
+
+def telegram_columns(channels):
+	#  (name, typecode, scale) of the columns storing raw telegram values
+	return [(channel, 'Q' if channel.endswith('_counter') else 'I', sma_value_scale[channel]) for channel in channels]
+
+
+class DayFile:
+	"""
+	*  Columns of one device and one day, opened for appending
+	"""
+	def __init__(self, directory, columns):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		meta_path = os.path.join(directory, META_FILE)
+		if os.path.exists(meta_path):
+			with open(meta_path) as meta_file:
+				columns = [tuple(column) for column in json.load(meta_file)['columns']]
+		else:
+			with open(meta_path, 'w') as meta_file:
+				json.dump({'columns': columns}, meta_file)
+		self.columns = [(TIME_COLUMN, 'd', 1)] + [column for column in columns if column[0] != TIME_COLUMN]
+		self.names = tuple(name for (name, typecode, scale) in self.columns[1:])
+		self.scales = tuple(scale for (name, typecode, scale) in self.columns[1:])
+		self.missing = tuple(RAW_MISSING.get(typecode, _NAN) for (name, typecode, scale) in self.columns[1:])
+		self.buffers = [array(typecode) for (name, typecode, scale) in self.columns]
+		self._repair()
+
+	def path(self, name, typecode):
+		return os.path.join(self.directory, '{}.{}'.format(name, typecode))
+
+	def _repair(self):
+		#  truncate all columns to the same number of records after an interrupted write
+		counts = []
+		for (name, typecode, scale) in self.columns:
+			path = self.path(name, typecode)
+			size = os.path.getsize(path) if os.path.exists(path) else 0
+			counts.append(size // array(typecode).itemsize)
+		records = min(counts)
+		if records != max(counts):
+			print_line('* RECORDER: truncating {} to {} records'.format(self.directory, records), warning=True)
+			for (name, typecode, scale) in self.columns:
+				path = self.path(name, typecode)
+				if os.path.exists(path):
+					os.truncate(path, records * array(typecode).itemsize)
+
+	def append(self, timestamp, values):
+		#  values in the order of the columns (without time)
+		self.buffers[0].append(timestamp)
+		for (buffer, value) in zip(self.buffers[1:], values):
+			buffer.append(value)
+
+	def flush(self):
+		if not self.buffers[0]:
+			return
+		for ((name, typecode, scale), buffer) in zip(self.columns, self.buffers):
+			with open(self.path(name, typecode), 'ab') as column_file:
+				buffer.tofile(column_file)
+		self.buffers = [array(typecode) for (name, typecode, scale) in self.columns]
+
+
+class Recorder:
+	"""
+	*  record_telegram(serial, em_data):       listener handler, raw values of channels
+	*  record(serial, timestamp, values):      values dictionary (e.g. aggregates) of names
+	*  flush():                                write buffered records to disk
+	"""
+	def __init__(self, path, channels, names=(), opt_debug=False):
+		self.path = path
+		self.channels = tuple(channels)
+		self.names = tuple(names)
+		self.opt_debug = opt_debug
+		self._lock = threading.Lock()
+		#  serial -> (day, DayFile)
+		self._files = {}
+
+	def _dayfile(self, serial, timestamp, make_columns):
+		day = date.fromtimestamp(timestamp)
+		entry = self._files.get(serial)
+		if entry is None or entry[0] != day:
+			if entry is not None:
+				entry[1].flush()
+			directory = os.path.join(self.path, str(serial), day.isoformat())
+			entry = (day, DayFile(directory, make_columns()))
+			self._files[serial] = entry
+		return entry[1]
+
+	def record_telegram(self, serial, em_data, timestamp=None):
+		if timestamp is None:
+			timestamp = datetime.now().timestamp()
+		with self._lock:
+			dayfile = self._dayfile(serial, timestamp, lambda: telegram_columns(self.channels))
+			#  raw values of the meter, see to_raw() in smaem_decoder.py
+			dayfile.append(timestamp, [round(em_data[name] * scale) if name in em_data else missing
+				for (name, scale, missing) in zip(dayfile.names, dayfile.scales, dayfile.missing)])
+
+	def record(self, serial, timestamp, values):
+		with self._lock:
+			dayfile = self._dayfile(serial, timestamp, lambda: [(name, 'd', 1) for name in self.names])
+			dayfile.append(timestamp, [float(values.get(name, _NAN)) for name in dayfile.names])
+
+	def flush(self):
+		with self._lock:
+			for (day, dayfile) in self._files.values():
+				try:
+					dayfile.flush()
+				except OSError as e:
+					print_line('* RECORDER: could not write {}: {}'.format(dayfile.directory, e), error=True)
+		print_line('* RECORDER: flushed', debug=self.opt_debug)
+
+
+def _map_column(path, typecode):
+	#  memory-mapped, read-only view of a column, None if empty
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return None
+	with open(path, 'rb') as column_file:
+		mapped = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+	size = len(mapped) - len(mapped) % array(typecode).itemsize
+	return memoryview(mapped)[:size].cast(typecode)
+
+def query(path, serial, start, end, channels=None, scaled=True):
+	"""
+	*  read all records of a device with start <= time < end (unix timestamps)
+	*
+	*  returns {'time': [...], <channel>: [...], ...} with the values scaled to
+	*  the units in sma_units (or raw if scaled is False), NaN for values
+	*  missing in a telegram and for days without the column, so every list
+	*  has the length of the time list
+	"""
+	result = {TIME_COLUMN: []}
+	if channels is not None:
+		result.update((name, []) for name in channels)
+	day = date.fromtimestamp(start)
+	last_day = date.fromtimestamp(end)
+	while day <= last_day:
+		directory = os.path.join(path, str(serial), day.isoformat())
+		day += timedelta(days=1)
+		meta_path = os.path.join(directory, META_FILE)
+		if not os.path.exists(meta_path):
+			continue
+		with open(meta_path) as meta_file:
+			columns = [tuple(column) for column in json.load(meta_file)['columns']]
+		times = _map_column(os.path.join(directory, TIME_COLUMN + '.d'), 'd')
+		if times is None:
+			continue
+		first = bisect_left(times, start)
+		last = bisect_left(times, end)
+		#  records before this day
+		records = len(result[TIME_COLUMN])
+		result[TIME_COLUMN].extend(times[first:last])
+		for (name, typecode, scale) in columns:
+			if channels is not None and name not in channels:
+				continue
+			column = _map_column(os.path.join(directory, '{}.{}'.format(name, typecode)), typecode)
+			values = column[first:last] if column is not None else []
+			missing = RAW_MISSING.get(typecode)
+			if scaled and scale != 1:
+				values = [value / scale if value != missing else _NAN for value in values]
+			elif missing is not None:
+				values = [value if value != missing else _NAN for value in values]
+			else:
+				values = list(values)
+			#  a column first recorded on this day, or shorter than the time column
+			result.setdefault(name, [_NAN] * records).extend(values)
+		for values in result.values():
+			values.extend([_NAN] * (len(result[TIME_COLUMN]) - len(values)))
+	return result
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Scheduler for the periodic jobs of sma-em.py (period reports, alive pings)
+*  and for one-shot tasks (publishes)
+*
+*  One timer thread keeps all periodic jobs in a heap of deadlines and hands
+*  due jobs to a fixed, small set of worker threads via a bounded queue.
+*  One-shot tasks have workers and a bounded queue of their own, so a burst
+*  of tasks never makes a periodic job skip a tick.
+*
+*  - ticks are drift-free: the next deadline is computed from the previous
+*    deadline, not from the end of the previous run
+*  - ticks are aligned to the wall clock, e.g. a 60 s job runs at hh:mm:00
+*  - overlap protection: a tick of a job that is still running is skipped
+*    ("skip") or run once right after the running one finished ("coalesce")
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import heapq
+import math
+import queue
+import threading
+from time import time
+from uftools import print_line
+
+OVERLAP_SKIP = 'skip'
+OVERLAP_COALESCE = 'coalesce'
+
+
+def first_deadline(interval, align=True, run_now=False, now=None):
+	#  wall clock time of the first run of a job
+	if now is None:
+		now = time()
+	if run_now:
+		return now
+	if align:
+		return math.floor(now / interval + 1) * interval
+	return now + interval
+
+def next_deadline(job, now=None):
+	#  next deadline on the grid of the job, skipping ticks already missed
+	if now is None:
+		now = time()
+	deadline = job.deadline + job.interval
+	if deadline <= now:
+		deadline += math.floor((now - deadline) / job.interval + 1) * job.interval
+	return deadline
+
+
+class Job:
+	__slots__ = ('name', 'interval', 'func', 'args', 'overlap', 'deadline', 'scheduled', 'running', 'pending', 'cancelled', 'skipped')
+
+	def __init__(self, name, interval, func, args, overlap):
+		self.name = name
+		self.interval = interval
+		self.func = func
+		self.args = args
+		self.overlap = overlap
+		#  scheduled wall clock time of the current (or next) run
+		self.deadline = 0.0
+		#  scheduled wall clock time of the latest dispatched run
+		self.scheduled = 0.0
+		self.running = False
+		self.pending = False
+		self.cancelled = False
+		#  number of ticks skipped because the previous run was still running
+		self.skipped = 0
+
+	def cancel(self):
+		#  also drops a coalesced run still pending
+		self.cancelled = True
+		self.pending = False
+
+	def __lt__(self, other):
+		return self.deadline < other.deadline
+
+
+class Scheduler:
+	"""
+	*  every(interval, func, *args):  run func(*args) every interval seconds
+	*  submit(func, *args):           run func(*args) once on a task worker
+	"""
+	def __init__(self, workers=2, queue_size=32, task_workers=1, task_queue_size=32, opt_debug=False):
+		self.workers = workers
+		self.task_workers = task_workers
+		self.opt_debug = opt_debug
+		self._heap = []
+		self._cond = threading.Condition()
+		#  runs of periodic jobs, and one-shot tasks
+		self._queue = queue.Queue(queue_size)
+		self._tasks = queue.Queue(task_queue_size)
+		self._threads = []
+		self._running = False
+
+	def every(self, interval, func, *args, name=None, align=True, overlap=OVERLAP_SKIP, run_now=False):
+		job = Job(name or func.__name__, interval, func, args, overlap)
+		job.deadline = first_deadline(interval, align, run_now)
+		with self._cond:
+			heapq.heappush(self._heap, job)
+			self._cond.notify()
+		print_line('- scheduled job {} - every {} seconds'.format(job.name, interval), debug=self.opt_debug)
+		return job
+
+	def submit(self, func, *args):
+		try:
+			self._tasks.put_nowait((None, func, args))
+			return True
+		except queue.Full:
+			print_line('* SCHEDULER: all task workers busy, dropped task {}'.format(func.__name__), warning=True)
+			return False
+
+	def start(self):
+		self._running = True
+		self._threads = [threading.Thread(target=self._timer, name='smaem-timer', daemon=True)]
+		for n in range(self.workers):
+			self._threads.append(threading.Thread(target=self._worker, args=(self._queue,), name='smaem-worker-{}'.format(n), daemon=True))
+		for n in range(self.task_workers):
+			self._threads.append(threading.Thread(target=self._worker, args=(self._tasks,), name='smaem-task-{}'.format(n), daemon=True))
+		for thread in self._threads:
+			thread.start()
+
+	def stop(self):
+		self._running = False
+		with self._cond:
+			self._cond.notify()
+		for (tasks, workers) in ((self._queue, self.workers), (self._tasks, self.task_workers)):
+			for n in range(workers):
+				try:
+					tasks.put_nowait(None)
+				except queue.Full:
+					pass
+
+	def _timer(self):
+		with self._cond:
+			while self._running:
+				if not self._heap:
+					self._cond.wait()
+					continue
+				job = self._heap[0]
+				delay = job.deadline - time()
+				if delay > 0:
+					self._cond.wait(delay)
+					continue
+				heapq.heappop(self._heap)
+				if job.cancelled:
+					continue
+				self._dispatch(job)
+				job.deadline = next_deadline(job)
+				heapq.heappush(self._heap, job)
+
+	def _dispatch(self, job):
+		if job.running:
+			job.skipped += 1
+			if job.overlap == OVERLAP_COALESCE:
+				job.scheduled = job.deadline
+				job.pending = True
+			else:
+				print_line('* SCHEDULER: job {} still running, skipped tick'.format(job.name), warning=True)
+			return
+		job.running = True
+		job.scheduled = job.deadline
+		try:
+			self._queue.put_nowait((job, job.func, job.args))
+		except queue.Full:
+			job.running = False
+			job.skipped += 1
+			print_line('* SCHEDULER: all workers busy, skipped tick of job {}'.format(job.name), warning=True)
+
+	def _worker(self, tasks):
+		while True:
+			task = tasks.get()
+			if task is None or not self._running:
+				break
+			(job, func, args) = task
+			while True:
+				try:
+					func(*args)
+				except Exception as e:
+					print_line('* SCHEDULER: {} failed: {}'.format(func.__name__, e), error=True)
+				if job is None:
+					break
+				with self._cond:
+					if not job.pending or job.cancelled:
+						job.running = False
+						job.pending = False
+						break
+					job.pending = False
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+"""
+*
+*  ----------------------------------------------------------------------------
+*  Latest values of every SMA Energy Meter in shared memory, for local
+*  processes reading them at a high rate (e.g. an EMS controller, a
+*  display) without a broker, a multicast socket or a decoder of their own
+*
+*  The daemon writes the latest decoded telegram of every meter into a
+*  memory mapped file (by default in /dev/shm). Readers map the file once,
+*  a read is a few struct.unpack_from() calls on the mapping, without any
+*  system call.
+*
+*  File layout (little endian):
+*
+*    header, 64 bytes:  b'SMAEMSHM', uint16 version, uint16 slots,
+*                       uint16 channels, uint16 slot size, uint32 crc32 of
+*                       the channel names
+*    slot per meter:    uint32 sequence, uint32 serial (0: free slot),
+*                       uint32 timestamp of the meter (ms), uint32 unused,
+*                       float64 receive time (unix), float64 value per
+*                       channel (NaN if not sent), padded to 64 bytes
+*
+*  The channels are the names of sma_units in the order of sma_channels,
+*  without speedwire_version. Every slot is protected by a seqlock: the
+*  writer makes the sequence odd, writes the slot and makes it even again,
+*  a reader retries until it read the same even sequence before and after
+*  the values. Python does not issue memory barriers, on CPUs with weak
+*  memory ordering a reader relies on the unpack_from() calls being far
+*  apart compared to the time a write takes to become visible.
+*
+*  usage:
+*    python3 smaem_shm.py [--path FILE] [--interval SECONDS]
+*
+*  2021-May-03
+*
+*  ----------------------------------------------------------------------------
+*/
+"""
+
+#  load necessary libraries
+import os
+import sys
+import mmap
+import zlib
+import struct
+import argparse
+from time import time, sleep
+from smaem_decoder import sma_units
+
+SHM_MAGIC = b'SMAEMSHM'
+SHM_VERSION = 1
+DEFAULT_PATH = '/dev/shm/sma-em'
+DEFAULT_SLOTS = 8
+HEADER_SIZE = 64
+#  a slot still written after this many retries is left by a writer that died
+MAX_RETRIES = 1000
+
+SHM_CHANNELS = tuple(name for name in sma_units if name != 'speedwire_version')
+LAYOUT_CRC = zlib.crc32(','.join(SHM_CHANNELS).encode('ascii'))
+
+_header = struct.Struct('<8sHHHHI')
+_sequence = struct.Struct('<I')
+_slot = struct.Struct('<IIIId{}d'.format(len(SHM_CHANNELS)))
+#  slots aligned to cache lines
+SLOT_SIZE = (_slot.size + 63) // 64 * 64
+#  offset of the value of a channel in a slot
+_offsets = dict((name, _slot.size - 8 * len(SHM_CHANNELS) + 8 * n) for (n, name) in enumerate(SHM_CHANNELS))
+_value = struct.Struct('<d')
+_NAN = float('nan')
+
+
+def shm_size(slots):
+	return HEADER_SIZE + slots * SLOT_SIZE
+
+
+class SnapshotWriter:
+	"""
+	*  update(serial, em_data):  listener handler, writes the telegram into
+	*                            the slot of the meter
+	*
+	*  An existing file of the same size is reused, so readers started
+	*  before the daemon keep their mapping.
+	"""
+	def __init__(self, path=DEFAULT_PATH, slots=DEFAULT_SLOTS):
+		self.path = path
+		self.slots = slots
+		#  serial -> offset of its slot
+		self._slot_offsets = {}
+		#  sequence of every slot, only written by this writer
+		self._sequences = {}
+		size = shm_size(slots)
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			if os.fstat(fd).st_size != size:
+				os.ftruncate(fd, size)
+			self._map = mmap.mmap(fd, size)
+		finally:
+			os.close(fd)
+		self._map[:] = bytes(size)
+		_header.pack_into(self._map, 0, SHM_MAGIC, SHM_VERSION, slots, len(SHM_CHANNELS), SLOT_SIZE, LAYOUT_CRC)
+
+	def _add_device(self, serial):
+		if len(self._slot_offsets) >= self.slots:
+			return None
+		offset = HEADER_SIZE + len(self._slot_offsets) * SLOT_SIZE
+		self._slot_offsets[serial] = offset
+		self._sequences[offset] = 0
+		return offset
+
+	def update(self, serial, em_data):
+		offset = self._slot_offsets.get(serial)
+		if offset is None:
+			offset = self._add_device(serial)
+			if offset is None:
+				#  more meters than slots
+				return
+		values = [em_data.get(name, _NAN) for name in SHM_CHANNELS]
+		sequence = self._sequences[offset] + 1
+		_sequence.pack_into(self._map, offset, sequence & 0xffffffff)
+		_slot.pack_into(self._map, offset, sequence & 0xffffffff, serial, em_data['timestamp'], 0, time(), *values)
+		sequence += 1
+		_sequence.pack_into(self._map, offset, sequence & 0xffffffff)
+		self._sequences[offset] = sequence
+
+	def close(self):
+		self._map.close()
+
+
+class SnapshotReader:
+	"""
+	*  serials():               serial numbers of the meters in the file
+	*  read(serial):            {'serial', 'timestamp', 'received', <channel>:
+	*                           <value>, ...} of the latest telegram, None
+	*                           if the meter is not in the file
+	*  value(serial, channel):  latest value of one channel, NaN if not sent
+	"""
+	def __init__(self, path=DEFAULT_PATH):
+		with open(path, 'rb') as shm_file:
+			self._map = mmap.mmap(shm_file.fileno(), 0, access=mmap.ACCESS_READ)
+		if len(self._map) < HEADER_SIZE:
+			raise ValueError('{} is not a snapshot file'.format(path))
+		(magic, version, self.slots, channels, slot_size, crc) = _header.unpack_from(self._map, 0)
+		if magic != SHM_MAGIC or version != SHM_VERSION:
+			raise ValueError('{} is not a snapshot file of version {}'.format(path, SHM_VERSION))
+		if channels != len(SHM_CHANNELS) or slot_size != SLOT_SIZE or crc != LAYOUT_CRC:
+			raise ValueError('{} was written with other channels than the ones of this reader'.format(path))
+		#  serial -> offset of its slot
+		self._slot_offsets = {}
+
+	def _read(self, offset, unpacker, position):
+		#  unpacks at position within the slot at offset, under its seqlock
+		for n in range(MAX_RETRIES):
+			before = _sequence.unpack_from(self._map, offset)[0]
+			if not before & 1:
+				values = unpacker.unpack_from(self._map, position)
+				if _sequence.unpack_from(self._map, offset)[0] == before:
+					return values
+			#  the writer is busy with the slot, only then a system call
+			sleep(0)
+		raise TimeoutError('snapshot slot at offset {} is locked by its writer'.format(offset))
+
+	def _find(self, serial):
+		offset = self._slot_offsets.get(serial)
+		if offset is not None and struct.unpack_from('<I', self._map, offset + 4)[0] == serial:
+			return offset
+		self._slot_offsets = dict((slot_serial, offset) for (slot_serial, offset) in self._slots())
+		return self._slot_offsets.get(serial)
+
+	def _slots(self):
+		for n in range(self.slots):
+			offset = HEADER_SIZE + n * SLOT_SIZE
+			serial = struct.unpack_from('<I', self._map, offset + 4)[0]
+			if serial:
+				yield (serial, offset)
+
+	def serials(self):
+		return [serial for (serial, offset) in self._slots()]
+
+	def read(self, serial):
+		offset = self._find(serial)
+		if offset is None:
+			return None
+		values = self._read(offset, _slot, offset)
+		snapshot = {'serial': values[1], 'timestamp': values[2], 'received': values[4]}
+		snapshot.update((name, value) for (name, value) in zip(SHM_CHANNELS, values[5:]) if value == value)
+		return snapshot
+
+	def value(self, serial, channel):
+		offset = self._find(serial)
+		if offset is None:
+			return _NAN
+		return self._read(offset, _value, offset + _offsets[channel])[0]
+
+	def close(self):
+		self._map.close()
+
+
+def main(argv=None):
+	ap = argparse.ArgumentParser(description='Print the latest values of the SMA Energy Meters from the shared memory of sma-em.py')
+	ap.add_argument('--path', default=DEFAULT_PATH, help='snapshot file (default {})'.format(DEFAULT_PATH))
+	ap.add_argument('--interval', type=float, default=0, help='print again every INTERVAL seconds')
+	args = ap.parse_args(argv)
+	try:
+		reader = SnapshotReader(args.path)
+	except (OSError, ValueError) as e:
+		print('{}'.format(e), file=sys.stderr)
+		return 1
+	while True:
+		for serial in reader.serials():
+			snapshot = reader.read(serial)
+			print('serial {}: {:.1f} s old, p_consume {} W, p_supply {} W'.format(serial, time() - snapshot['received'],
+				snapshot.get('p_consume'), snapshot.get('p_supply')))
+		if args.interval <= 0:
+			return 0
+		sleep(args.interval)
+
+if __name__ == '__main__':
+	sys.exit(main())
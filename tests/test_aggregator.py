@@ -0,0 +1,57 @@
+#  tests of smaem_aggregator.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_aggregator import WindowAggregator
+
+
+def test_window_statistics():
+	aggregator = WindowAggregator(['p_consume', 'freq'], ['p_consume_counter'])
+	for (power, freq, counter) in ((100.0, 50.0, 10.0), (300.0, 49.9, 10.25), (200.0, 50.1, 10.5)):
+		aggregator.update(1, {'p_consume': power, 'freq': freq, 'p_consume_counter': counter})
+	assert aggregator.collect(1) == {
+		'p_consume_min': 100.0, 'p_consume_max': 300.0, 'p_consume_mean': 200.0, 'p_consume_last': 200.0,
+		'freq_min': 49.9, 'freq_max': 50.1, 'freq_mean': 50.0, 'freq_last': 50.1,
+		'p_consume_counter_delta': 0.5, 'samples': 3}
+
+def test_windows_follow_each_other():
+	aggregator = WindowAggregator(['p_consume'], ['p_consume_counter'])
+	aggregator.update(1, {'p_consume': 100.0, 'p_consume_counter': 10.0})
+	aggregator.update(1, {'p_consume': 100.0, 'p_consume_counter': 10.5})
+	assert aggregator.collect(1)['p_consume_counter_delta'] == 0.5
+	#  the next window starts at the last counter of the previous one
+	aggregator.update(1, {'p_consume': 50.0, 'p_consume_counter': 10.75})
+	assert aggregator.collect(1) == {'p_consume_min': 50.0, 'p_consume_max': 50.0, 'p_consume_mean': 50.0, 'p_consume_last': 50.0,
+		'p_consume_counter_delta': 0.25, 'samples': 1}
+	#  empty window: no statistics, the counter did not move
+	assert aggregator.collect(1) == {'p_consume_counter_delta': 0.0, 'samples': 0}
+
+def test_devices_and_missing_channels():
+	aggregator = WindowAggregator(['p_consume', 'freq'], ['p_consume_counter'])
+	assert aggregator.collect(1) == {}
+	aggregator.update(1, {'p_consume': 100.0})
+	aggregator.update(2, {'p_consume': 200.0, 'freq': 50.0})
+	assert aggregator.collect(1) == {'p_consume_min': 100.0, 'p_consume_max': 100.0, 'p_consume_mean': 100.0, 'p_consume_last': 100.0, 'samples': 1}
+	assert aggregator.collect(2)['freq_mean'] == 50.0
+
+def test_concurrent_updates():
+	aggregator = WindowAggregator(['p_consume'], [])
+	def update():
+		for n in range(1000):
+			aggregator.update(1, {'p_consume': float(n)})
+	threads = [threading.Thread(target=update) for n in range(4)]
+	for thread in threads:
+		thread.start()
+	collected = 0
+	while any(thread.is_alive() for thread in threads):
+		collected += aggregator.collect(1).get('samples', 0)
+	for thread in threads:
+		thread.join()
+	collected += aggregator.collect(1).get('samples', 0)
+	assert collected == 4000
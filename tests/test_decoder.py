@@ -0,0 +1,153 @@
+#  tests of smaem_decoder.py on telegrams of the synthesizer of smaem_capture.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import math
+import struct
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_decoder import decode_SMAEM, check_SMAEM, TELEGRAM_CLIPPED, HEADER_SIZE, TelegramSequence, \
+	SEQUENCE_NEXT, SEQUENCE_GAP, SEQUENCE_DUPLICATE, SEQUENCE_REORDERED, SEQUENCE_RESTART
+from smaem_capture import synthesize_telegram, synthetic_values
+
+SERIAL = 1900123456
+TICKS = 123456789
+
+VALUES = {
+	'p_consume': 1234.5, 'p_consume_counter': 1000.25,
+	'p_supply': 0.0, 'p_supply_counter': 250.5,
+	'q_consume': 45.0, 's_consume': 1300.1,
+	'cosphi': 0.95, 'freq': 50.012,
+	'p1_consume': 400.1, 'u1': 230.123, 'i1': 1.739, 'cosphi1': 0.982,
+	'p2_consume': 410.2, 'u2': 229.5, 'i2': 1.787, 'cosphi2': 0.951,
+	'p3_consume': 424.2, 'u3': 231.0, 'i3': 1.836, 'cosphi3': 0.9,
+}
+
+
+def _set_length(datagram, datalength):
+	#  data length field of the header, counted from byte 16
+	return datagram[:12] + struct.pack('>H', datalength - 16) + datagram[14:]
+
+def _datalength(telegram):
+	return struct.unpack_from('>H', telegram, 12)[0] + 16
+
+
+def test_decode_with_freq():
+	em_data = decode_SMAEM(synthesize_telegram(SERIAL, TICKS, VALUES))
+	assert em_data['serial'] == SERIAL
+	assert em_data['timestamp'] == TICKS
+	assert em_data['speedwire_version'] == '2.03.18.R'
+	for (name, value) in VALUES.items():
+		assert em_data[name] == pytest.approx(value), name
+	#  channels not given are sent as zero
+	assert em_data['p1_supply'] == 0.0
+	assert em_data['s3_supply_counter'] == 0.0
+
+def test_decode_without_freq():
+	with_freq = decode_SMAEM(synthesize_telegram(SERIAL, TICKS, VALUES))
+	em_data = decode_SMAEM(synthesize_telegram(SERIAL, TICKS, VALUES, freq=False))
+	assert 'freq' not in em_data
+	del with_freq['freq']
+	assert em_data == with_freq
+
+def test_decode_clipped():
+	telegram = synthesize_telegram(SERIAL, TICKS, VALUES)
+	#  data length beyond the end of the datagram
+	clipped = telegram[:len(telegram) - 12]
+	assert check_SMAEM(clipped).status == TELEGRAM_CLIPPED
+	assert decode_SMAEM(clipped) == {}
+
+def test_decode_truncated():
+	telegram = synthesize_telegram(SERIAL, TICKS, VALUES)
+	datalength = _datalength(telegram)
+	#  header of a counter block (8 byte value) as the last 4 bytes of the data
+	truncated = _set_length(telegram[:datalength] + b'\x00\x01\x08\x00' + b'\x00\x00\x00\x00', datalength + 4)
+	assert check_SMAEM(truncated).status != TELEGRAM_CLIPPED
+	assert decode_SMAEM(truncated) == {}
+	#  the layout cached for a complete telegram of the same length must not be used either
+	assert decode_SMAEM(telegram)
+	assert decode_SMAEM(truncated) == {}
+
+def test_decode_short():
+	assert decode_SMAEM(b'') == {}
+	assert decode_SMAEM(synthesize_telegram(SERIAL, TICKS, VALUES)[:HEADER_SIZE - 1]) == {}
+
+def test_layout_cache_is_capped():
+	import smaem_decoder
+	telegram = synthesize_telegram(SERIAL, TICKS, VALUES)
+	datalength = _datalength(telegram)
+	for n in range(smaem_decoder.MAX_LAYOUTS * 2):
+		#  n unknown OBIS blocks (actual values) before the end marker, a new layout per length
+		extended = telegram[:datalength] + b'\x00\xc8\x04\x00\x00\x00\x00\x01' * n + b'\x00\x00\x00\x00'
+		assert decode_SMAEM(_set_length(extended, datalength + 8 * n))['p_consume'] == pytest.approx(VALUES['p_consume'])
+		assert sum(len(layouts) for layouts in smaem_decoder._layouts.values()) <= smaem_decoder.MAX_LAYOUTS
+	assert decode_SMAEM(telegram)['serial'] == SERIAL
+
+
+def test_decode_batch():
+	pytest.importorskip('numpy')
+	from smaem_decoder import decode_batch, scale_batch, BATCH_MISSING
+	telegrams = []
+	for n in range(40):
+		freq = n % 3 != 0
+		telegrams.append(synthesize_telegram(SERIAL + n % 2, TICKS + n * 1000, synthetic_values(n, freq), freq=freq))
+	telegram = telegrams[5]
+	#  rejected telegrams: foreign, clipped and truncated
+	telegrams.insert(7, b'XYZ\x00' + telegram[4:])
+	telegrams.insert(11, telegram[:len(telegram) - 12])
+	telegrams.insert(13, _set_length(telegram[:_datalength(telegram)] + b'\x00\x01\x08\x00' + b'\x00\x00\x00\x00', _datalength(telegram) + 4))
+
+	expected = [(index, decode_SMAEM(telegram)) for (index, telegram) in enumerate(telegrams)]
+	expected = [(index, em_data) for (index, em_data) in expected if em_data]
+	assert len(expected) == 40
+	batch = decode_batch(telegrams)
+	scaled = scale_batch(batch)
+	assert [int(index) for index in batch['index']] == [index for (index, em_data) in expected]
+	assert len(scaled) == len(expected)
+	for (row, (index, em_data)) in zip(scaled, expected):
+		assert row['serial'] == em_data['serial']
+		assert row['timestamp'] == em_data['timestamp']
+		for name in scaled.dtype.names[3:]:
+			if name in em_data:
+				assert row[name] == pytest.approx(em_data[name]), name
+			else:
+				assert math.isnan(row[name]), name
+	#  the version is kept raw
+	assert (batch['speedwire_version'] != BATCH_MISSING).all()
+
+def test_decode_batch_empty():
+	pytest.importorskip('numpy')
+	from smaem_decoder import decode_batch
+	assert len(decode_batch([])) == 0
+	assert len(decode_batch([b'', b'SMA\x00'])) == 0
+
+
+def test_sequence_gaps():
+	sequence = TelegramSequence()
+	results = [sequence.update(ticks) for ticks in (1000, 2000, 3000, 4400, 5400, 8400, 9400)]
+	#  1.4 intervals is jitter, 3 intervals a gap of 2 telegrams
+	assert results == [SEQUENCE_NEXT] * 5 + [SEQUENCE_GAP, SEQUENCE_NEXT]
+	assert (sequence.gaps, sequence.missed) == (1, 2)
+
+def test_sequence_duplicates_and_reordered():
+	sequence = TelegramSequence()
+	assert [sequence.update(ticks) for ticks in (1000, 2000, 2000, 1000, 3000)] == \
+		[SEQUENCE_NEXT, SEQUENCE_NEXT, SEQUENCE_DUPLICATE, SEQUENCE_REORDERED, SEQUENCE_NEXT]
+	assert (sequence.duplicates, sequence.reordered, sequence.last) == (1, 1, 3000)
+
+def test_sequence_wraparound_and_restart():
+	sequence = TelegramSequence()
+	#  the ticks wrap around after 2**32 ms
+	assert [sequence.update(ticks) for ticks in (0xffffff00 - 1000, 0xffffff00, 0xffffff00 + 1000 - 0x100000000)] == [SEQUENCE_NEXT] * 3
+	assert sequence.gaps == 0
+	#  back by more than a minute: the meter restarted, the interval is learned again
+	sequence = TelegramSequence()
+	sequence.update(1000000)
+	sequence.update(1001000)
+	assert sequence.update(5000) == SEQUENCE_RESTART
+	assert [sequence.update(ticks) for ticks in (6000, 9000)] == [SEQUENCE_NEXT, SEQUENCE_GAP]
+	assert (sequence.restarts, sequence.reordered) == (1, 0)
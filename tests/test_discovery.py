@@ -0,0 +1,196 @@
+#  tests of smaem_discovery.py, with a stand-in of the MQTT client
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smaem_discovery
+from smaem_discovery import DiscoveryManager, SETTLE_IN_SECONDS
+
+PREFIX = 'homeassistant/sensor/smaem_1900123456'
+
+
+class Client:
+	#  records subscriptions and publishes
+	def __init__(self):
+		self.subscribed = []
+		self.unsubscribed = []
+		self.published = []
+
+	def subscribe(self, topics, qos=0):
+		self.subscribed.extend([topics] if isinstance(topics, str) else [topic for (topic, qos) in topics])
+
+	def unsubscribe(self, topics):
+		self.unsubscribed.extend(topics)
+
+	def publish(self, topic, payload, qos, retain):
+		assert qos == 1 and retain
+		self.published.append((topic, payload))
+
+	def take(self):
+		(published, self.published) = (self.published, [])
+		return published
+
+
+class Message:
+	def __init__(self, topic, payload):
+		self.topic = topic
+		self.payload = payload.encode() if isinstance(payload, str) else payload
+
+
+class Clock:
+	def __init__(self, now=1000.0):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_discovery, 'monotonic', clock)
+	return clock
+
+@pytest.fixture
+def client():
+	return Client()
+
+def _manager(client, **options):
+	manager = DiscoveryManager(client, client.publish, **options)
+	manager.connected()
+	return manager
+
+def _configs(*names, version=1):
+	return dict(('{}/{}/config'.format(PREFIX, name), '{{"name":"{}","v":{}}}'.format(name, version)) for name in names)
+
+
+def test_configs_wait_for_the_broker(client, clock):
+	manager = _manager(client)
+	assert client.subscribed == ['homeassistant/status']
+	configs = _configs('p_consume', 'p_supply')
+	manager.update(1, configs)
+	assert client.subscribed[1:] == list(configs)
+	#  the retained configs of the broker are awaited before publishing
+	assert manager.flush() == 0
+	clock.now += SETTLE_IN_SECONDS
+	assert manager.flush() == 2
+	assert client.take() == list(configs.items())
+	assert manager.pending() == 0
+	assert manager.flush() == 0
+
+def test_configs_held_by_the_broker_are_skipped(client, clock):
+	manager = _manager(client)
+	configs = _configs('p_consume', 'p_supply')
+	manager.update(1, configs)
+	(topic, payload) = list(configs.items())[0]
+	manager.on_message(client, None, Message(topic, payload))
+	other = list(configs)[1]
+	manager.on_message(client, None, Message(other, '{"name":"old"}'))
+	clock.now += SETTLE_IN_SECONDS
+	#  only the changed one
+	assert manager.flush() == 1
+	assert client.take() == [(other, configs[other])]
+
+def test_batches(client, clock):
+	manager = _manager(client, batch_size=3)
+	manager.update(1, _configs(*['c{}'.format(n) for n in range(7)]))
+	clock.now += SETTLE_IN_SECONDS
+	assert [manager.flush() for n in range(4)] == [3, 3, 1, 0]
+	assert len(client.take()) == 7
+
+def test_changed_and_removed_configs(client, clock):
+	manager = _manager(client)
+	manager.update(1, _configs('p_consume', 'freq'))
+	clock.now += SETTLE_IN_SECONDS
+	manager.flush()
+	client.take()
+	#  freq no longer sent, p_consume changed
+	manager.update(1, _configs('p_consume', version=2))
+	assert manager.pending() == 2
+	assert manager.flush() == 2
+	freq = '{}/freq/config'.format(PREFIX)
+	#  removals first
+	assert client.take() == [(freq, ''), ('{}/p_consume/config'.format(PREFIX), '{"name":"p_consume","v":2}')]
+	assert client.unsubscribed == [freq]
+	assert manager.flush() == 0
+
+def test_removed_config_added_again(client, clock):
+	manager = _manager(client)
+	configs = _configs('p_consume', 'freq')
+	manager.update(1, configs)
+	manager.update(1, _configs('p_consume'))
+	manager.update(1, configs)
+	#  subscribed once, the removal is dropped
+	assert client.subscribed[1:] == list(configs)
+	clock.now += SETTLE_IN_SECONDS
+	assert manager.flush() == 2
+	assert sorted(client.take()) == sorted(configs.items())
+
+def test_verify_after_reconnect(client, clock):
+	manager = _manager(client)
+	configs = _configs('p_consume')
+	manager.update(1, configs)
+	clock.now += SETTLE_IN_SECONDS
+	manager.flush()
+	client.take()
+	#  broker restarted without persistence: nothing retained
+	manager.disconnected()
+	assert manager.flush() == 0
+	client.subscribed = []
+	manager.connected()
+	assert client.subscribed == ['homeassistant/status'] + list(configs)
+	assert manager.flush() == 0
+	clock.now += SETTLE_IN_SECONDS
+	assert manager.flush() == 1
+	#  broker kept the config: nothing published
+	manager.verify()
+	manager.on_message(client, None, Message(*list(configs.items())[0]))
+	clock.now += SETTLE_IN_SECONDS
+	assert manager.flush() == 0
+
+def test_birth_message(client, clock):
+	online = []
+	manager = _manager(client, on_online=lambda: online.append(True))
+	manager.update(1, _configs('p_consume'))
+	clock.now += SETTLE_IN_SECONDS
+	manager.flush()
+	client.take()
+	manager.on_message(client, None, Message('homeassistant/status', 'offline'))
+	assert online == []
+	manager.on_message(client, None, Message('homeassistant/status', 'online'))
+	assert online == [True]
+	clock.now += SETTLE_IN_SECONDS
+	#  no retained config reported by the broker after the subscription
+	assert manager.flush() == 1
+
+def test_stale_configs_cleared(client, clock):
+	manager = _manager(client)
+	configs = _configs('p_consume')
+	manager.update(1, configs)
+	stale = 'homeassistant/sensor/sma_energy_meter/monitor/config'
+	manager.clear([stale])
+	assert stale in client.subscribed
+	clock.now += SETTLE_IN_SECONDS
+	manager.flush()
+	client.take()
+	#  the broker holds the config of the old layout: removed, the current configs published again
+	manager.on_message(client, None, Message(stale, '{"name":"old"}'))
+	assert manager.flush() == 2
+	assert client.take() == [(stale, '')] + list(configs.items())
+	assert client.unsubscribed == [stale]
+	#  the empty retained payload is not removed again
+	manager.on_message(client, None, Message(stale, ''))
+	assert manager.flush() == 0
+
+def test_stale_configs_not_on_the_broker(client, clock):
+	manager = _manager(client)
+	manager.clear(['homeassistant/sensor/sma_energy_meter/monitor/config'])
+	clock.now += SETTLE_IN_SECONDS
+	assert manager.flush() == 0
+	assert client.take() == []
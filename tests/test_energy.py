@@ -0,0 +1,128 @@
+#  tests of smaem_energy.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smaem_energy
+from smaem_energy import EnergyTracker, energy_units
+
+SERIAL = 1900123456
+COUNTERS = ['p_consume_counter', 'p_supply_counter']
+
+
+class Clock:
+	def __init__(self, now=1000000.0):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+
+def _telegram(tracker, clock, seconds, consume, supply=0.0):
+	#  counters in kWh, as decoded
+	clock.now += seconds
+	tracker.update(SERIAL, {'p_consume_counter': consume, 'p_supply_counter': supply})
+
+
+def test_energy_units():
+	assert energy_units('p_consume_counter') == ('Wh', 'W')
+	assert energy_units('q_supply_counter') == ('VArh', 'VAr')
+
+
+def test_energy_and_power(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_energy, 'time', clock)
+	tracker = EnergyTracker(COUNTERS)
+	assert tracker.collect(SERIAL) == {}
+	_telegram(tracker, clock, 0, 1000.0)
+	#  first report: base only
+	assert tracker.collect(SERIAL) == {}
+	#  0.5 kWh in 600 s: 500 Wh, 3000 W
+	_telegram(tracker, clock, 600, 1000.5, 0.0001)
+	result = tracker.collect(SERIAL)
+	assert result == {'p_consume_counter_energy': 500.0, 'p_consume_counter_power': 3000.0,
+		'p_supply_counter_energy': 0.1, 'p_supply_counter_power': 0.6}
+	#  no new telegram: nothing more, the report comes from the same telegram
+	result = tracker.collect(SERIAL)
+	assert result['p_consume_counter_energy'] == 0.0
+
+def test_counter_exact_with_large_values(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_energy, 'time', clock)
+	tracker = EnergyTracker(['p_consume_counter'])
+	_telegram(tracker, clock, 0, 9999999.9999)
+	tracker.collect(SERIAL)
+	#  1 Ws on top of a counter near the 10 GWh range
+	_telegram(tracker, clock, 1, 9999999.9999 + 1 / 3600000)
+	assert tracker.collect(SERIAL) == {'p_consume_counter_energy': round(1 / 3600, 4), 'p_consume_counter_power': 1.0}
+
+def test_counter_reset(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_energy, 'time', clock)
+	tracker = EnergyTracker(COUNTERS)
+	_telegram(tracker, clock, 0, 1000.0, 20.0)
+	tracker.collect(SERIAL)
+	#  meter replaced: the consume counter starts again, the supply counter goes on
+	_telegram(tracker, clock, 60, 0.01, 20.001)
+	result = tracker.collect(SERIAL)
+	assert 'p_consume_counter_energy' not in result
+	assert result['p_supply_counter_energy'] == 1.0
+	assert tracker.resets == 1
+	#  the new counter is the base of the next report
+	_telegram(tracker, clock, 60, 0.02, 20.001)
+	assert tracker.collect(SERIAL)['p_consume_counter_energy'] == 10.0
+	assert tracker.resets == 1
+
+
+def test_state_file_restore(tmp_path, monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_energy, 'time', clock)
+	state_path = str(tmp_path / 'energy.json')
+	tracker = EnergyTracker(COUNTERS, state_path)
+	_telegram(tracker, clock, 0, 1000.0)
+	tracker.collect(SERIAL)
+	_telegram(tracker, clock, 60, 1000.1)
+	assert tracker.collect(SERIAL)['p_consume_counter_energy'] == 100.0
+	#  the base of the last report is in the state file without a save()
+	with open(state_path) as state_file:
+		state = json.load(state_file)
+	assert state[str(SERIAL)]['p_consume_counter'] == 1000.1 * 3600000
+	assert not os.path.exists(state_path + '.tmp')
+
+	#  killed and restarted 300 s later: the first report covers the time not running, once
+	restarted = EnergyTracker(COUNTERS, state_path)
+	_telegram(restarted, clock, 300, 1000.6)
+	result = restarted.collect(SERIAL)
+	assert result['p_consume_counter_energy'] == 500.0
+	assert result['p_consume_counter_power'] == 500.0 * 3600 / 300
+
+def test_state_file_invalid(tmp_path):
+	state_path = str(tmp_path / 'energy.json')
+	with open(state_path, 'w') as state_file:
+		state_file.write('{not json')
+	tracker = EnergyTracker(COUNTERS, state_path)
+	tracker.update(SERIAL, {'p_consume_counter': 1000.0})
+	assert tracker.collect(SERIAL) == {}
+
+def test_state_file_written_again_after_error(tmp_path, monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(smaem_energy, 'time', clock)
+	state_path = str(tmp_path / 'missing' / 'energy.json')
+	tracker = EnergyTracker(COUNTERS, state_path)
+	_telegram(tracker, clock, 0, 1000.0)
+	tracker.collect(SERIAL)
+	assert not os.path.exists(state_path)
+	#  the directory is back, save() at shutdown writes the base that failed before
+	os.makedirs(os.path.dirname(state_path))
+	tracker.save()
+	with open(state_path) as state_file:
+		assert str(SERIAL) in json.load(state_file)
+	#  up to date: no write
+	os.remove(state_path)
+	tracker.save()
+	assert not os.path.exists(state_path)
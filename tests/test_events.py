@@ -0,0 +1,128 @@
+#  tests of smaem_events.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+from configparser import ConfigParser
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_events import EventEngine, threshold_rule, sign_rule, overcurrent_rule, frequency_rule, rule_from_config
+
+SERIAL = 1900123456
+
+
+class Events:
+	def __init__(self, conditions):
+		self.events = []
+		self.engine = EventEngine(conditions, lambda serial, em_data, event: self.events.append(event))
+		self.timestamp = 0
+
+	def update(self, **em_data):
+		self.timestamp += 1000
+		em_data['timestamp'] = self.timestamp
+		self.engine.update(SERIAL, em_data)
+		return [(event['state'], event.get('phase')) if 'phase' in event else event['state'] for event in self._take()]
+
+	def _take(self):
+		(events, self.events) = (self.events, [])
+		return events
+
+
+def _options(**options):
+	config = ConfigParser()
+	config.read_dict({'Event:test': options})
+	return config['Event:test']
+
+
+def test_first_telegram_sets_state_silently():
+	events = Events(threshold_rule('high', 'p_consume', 1000.0))
+	assert events.update(p_consume=2000.0) == []
+	assert events.engine.states(SERIAL) == {'high': 'on'}
+	assert events.update(p_consume=500.0) == ['off']
+
+def test_threshold_hysteresis():
+	events = Events(threshold_rule('high', 'p_consume', 1000.0, hysteresis=100.0))
+	events.update(p_consume=0.0)
+	assert events.update(p_consume=1000.0) == []
+	assert events.update(p_consume=1000.1) == ['on']
+	#  released only 100 W below the level
+	assert events.update(p_consume=950.0) == []
+	assert events.update(p_consume=1000.5) == []
+	assert events.update(p_consume=899.0) == ['off']
+	assert events.update(p_consume=950.0) == []
+	assert events.engine.states(SERIAL) == {'high': 'off'}
+
+def test_threshold_below():
+	events = Events(threshold_rule('low', 'u1', 207.0, hysteresis=3.0, below=True))
+	events.update(u1=230.0)
+	assert events.update(u1=206.0) == ['on']
+	assert events.update(u1=209.0) == []
+	assert events.update(u1=210.5) == ['off']
+
+def test_event_payload():
+	events = Events(threshold_rule('high', 'p_consume', 1000.0))
+	events.update(p_consume=0.0)
+	events.engine.update(SERIAL, {'p_consume': 1234.56789, 'timestamp': 5000})
+	assert events.events == [{'event': 'high', 'state': 'on', 'value': 1234.5679, 'timestamp': 5000}]
+
+def test_sign():
+	events = Events(sign_rule('grid', hysteresis=20.0))
+	assert events.update(p_consume=100.0, p_supply=0.0) == []
+	assert events.engine.states(SERIAL) == {'grid': 'consume'}
+	#  net power has to pass zero by 10 W
+	assert events.update(p_consume=0.0, p_supply=5.0) == []
+	assert events.update(p_consume=0.0, p_supply=11.0) == ['supply']
+	assert events.update(p_consume=5.0, p_supply=0.0) == []
+	assert events.update(p_consume=11.0, p_supply=0.0) == ['consume']
+
+def test_overcurrent_per_phase():
+	events = Events(overcurrent_rule('overcurrent', 16.0, hysteresis=1.0))
+	assert events.update(i1=10.0, i2=10.0, i3=20.0) == []
+	assert events.engine.states(SERIAL) == {'overcurrent_l1': 'off', 'overcurrent_l2': 'off', 'overcurrent_l3': 'on'}
+	assert events.update(i1=17.0, i2=10.0, i3=15.5) == [('on', 1)]
+	assert events.update(i1=17.0, i2=16.5, i3=14.9) == [('on', 2), ('off', 3)]
+
+def test_frequency_deviation():
+	events = Events(frequency_rule('frequency', 0.2, hysteresis=0.05))
+	events.update(freq=50.0)
+	assert events.update(freq=49.75) == ['on']
+	events.engine.update(SERIAL, {'freq': 50.3, 'timestamp': 0})
+	#  still active, the other side of the nominal frequency
+	assert events.events == []
+	events.engine.update(SERIAL, {'freq': 50.1, 'timestamp': 0})
+	assert events.events == [{'event': 'frequency', 'state': 'off', 'value': 0.1, 'timestamp': 0}]
+
+def test_rule_skipped_without_channel():
+	#  no freq with firmware 1.x
+	events = Events(frequency_rule('frequency', 0.2) + threshold_rule('high', 'p_consume', 1000.0))
+	events.update(p_consume=0.0)
+	assert events.update(p_consume=2000.0) == ['on']
+	assert events.engine.states(SERIAL) == {'high': 'on'}
+
+
+def test_rule_from_config():
+	conditions = rule_from_config('high', _options(type='Threshold', channel='p_consume', above='3000', hysteresis='200'))
+	assert [(condition.rule, condition.channels) for condition in conditions] == [('high', ('p_consume',))]
+	conditions = rule_from_config('overcurrent', _options(type='overcurrent', limit='16', phases='1, 3'))
+	assert [condition.phase for condition in conditions] == [1, 3]
+	assert len(rule_from_config('grid', _options(type='sign'))) == 1
+	assert len(rule_from_config('frequency', _options(type='frequency', deviation='0.2', nominal='60'))) == 1
+
+@pytest.mark.parametrize('options, message', [
+	(dict(type='threshold', channel='p_consume'), 'either "above" or "below"'),
+	(dict(type='threshold', channel='p_consume', above='1', below='0'), 'either "above" or "below"'),
+	(dict(type='threshold', channel='speedwire_version', above='1'), 'invalid channel'),
+	(dict(type='threshold', channel='power', above='1'), 'invalid channel'),
+	(dict(type='sign', hysteresis='-1'), 'must not be negative'),
+	(dict(type='overcurrent'), 'missing "limit"'),
+	(dict(type='overcurrent', limit='16', phases='1, 4'), '"phases"'),
+	(dict(type='frequency'), 'missing "deviation"'),
+	(dict(type='voltage'), '"type" must be'),
+])
+def test_rule_from_config_errors(options, message):
+	with pytest.raises(ValueError, match=message):
+		rule_from_config('test', _options(**options))
@@ -0,0 +1,54 @@
+#  tests of smaem_filters.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_filters import ChannelFilter, StreamFilter
+
+
+def test_first_value_passes():
+	assert ChannelFilter(deadband=100.0, max_rate=0.1).check(5.0, 0.0)
+
+def test_deadband():
+	channel_filter = ChannelFilter(deadband=10.0)
+	assert channel_filter.check(100.0, 0.0)
+	assert not channel_filter.check(109.9, 1.0)
+	#  the deadband is measured from the value last passed, not from the last value
+	assert not channel_filter.check(91.0, 2.0)
+	assert channel_filter.check(110.0, 3.0)
+	assert not channel_filter.check(101.0, 4.0)
+	assert channel_filter.check(100.0, 5.0)
+
+def test_rate_limit():
+	channel_filter = ChannelFilter(max_rate=0.5)
+	assert channel_filter.check(1.0, 0.0)
+	assert not channel_filter.check(2.0, 1.0)
+	assert not channel_filter.check(3.0, 1.999)
+	assert channel_filter.check(4.0, 2.0)
+	assert channel_filter.last_value == 4.0
+
+def test_heartbeat():
+	channel_filter = ChannelFilter(deadband=10.0, heartbeat=5.0)
+	assert channel_filter.check(100.0, 0.0)
+	assert [channel_filter.check(100.0, now) for now in range(1, 11)] == [False] * 4 + [True] + [False] * 4 + [True]
+
+
+def test_stream_filter_per_device_and_channel():
+	stream_filter = StreamFilter(['p_consume', 'p_supply', 'freq'], deadband=5.0, deadbands={'freq': 0.01}, max_rates={'p_supply': 0.5})
+	em_data = {'p_consume': 100.0, 'p_supply': 0.0, 'freq': 50.0, 'u1': 230.0}
+	assert stream_filter.update(1, em_data, 0.0) == {'p_consume': 100.0, 'p_supply': 0.0, 'freq': 50.0}
+	#  other device, own filters
+	assert stream_filter.update(2, em_data, 0.0) == {'p_consume': 100.0, 'p_supply': 0.0, 'freq': 50.0}
+	assert stream_filter.update(1, {'p_consume': 104.0, 'p_supply': 10.0, 'freq': 50.02}, 1.0) == {'freq': 50.02}
+	assert stream_filter.update(1, {'p_consume': 106.0, 'p_supply': 10.0, 'freq': 50.02}, 2.0) == {'p_consume': 106.0, 'p_supply': 10.0}
+	assert stream_filter.update(2, em_data, 2.0) == {}
+
+def test_stream_filter_missing_channel():
+	#  no freq with firmware 1.x
+	stream_filter = StreamFilter(['p_consume', 'freq'])
+	assert stream_filter.update(1, {'p_consume': 100.0}, 0.0) == {'p_consume': 100.0}
+	assert stream_filter.update(1, {'p_consume': 100.0, 'freq': 50.0}, 1.0) == {'p_consume': 100.0, 'freq': 50.0}
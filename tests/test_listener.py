@@ -0,0 +1,85 @@
+#  tests of smaem_listener.py, telegrams are passed to receive() without sockets
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_listener import SMAEMListener, DEDUP_WINDOW
+from smaem_capture import synthesize_telegram, synthetic_values
+
+SERIAL = 1900123456
+
+
+def _telegrams(n, serial=SERIAL, start=0):
+	return [synthesize_telegram(serial, 1000 * (start + index + 1), synthetic_values(start + index)) for index in range(n)]
+
+
+def test_new_device_failure_keeps_receiving():
+	listener = SMAEMListener()
+	calls = []
+	received = []
+	def on_new_device(serial, em_data):
+		calls.append(serial)
+		if len(calls) == 1:
+			raise RuntimeError('broker gone')
+	listener.on_new_device = on_new_device
+	listener.add_handler(lambda serial, em_data: received.append(em_data['timestamp']))
+	for telegram in _telegrams(3):
+		listener.receive(telegram)
+	#  announced again with the second telegram, then no more
+	assert calls == [SERIAL, SERIAL]
+	assert received == [1000, 2000, 3000]
+	assert listener.serials() == [SERIAL]
+
+def test_handler_failure_keeps_other_handlers():
+	listener = SMAEMListener()
+	received = []
+	def failing(serial, em_data):
+		raise ValueError('bad payload')
+	listener.add_handler(failing)
+	listener.add_handler(lambda serial, em_data: received.append(serial))
+	for telegram in _telegrams(2):
+		listener.receive(telegram)
+	assert received == [SERIAL, SERIAL]
+	assert listener.latest(SERIAL)['timestamp'] == 2000
+
+def test_stale_telegrams_dropped():
+	listener = SMAEMListener()
+	received = []
+	listener.add_handler(lambda serial, em_data: received.append(em_data['timestamp']))
+	(first, second, third) = _telegrams(3)
+	for telegram in (first, second, second, first, third):
+		listener.receive(telegram)
+	#  a duplicate or an older telegram never replaces the newer snapshot
+	assert received == [1000, 2000, 3000]
+	sequence = listener.sequence(SERIAL)
+	assert (sequence.duplicates, sequence.reordered) == (1, 1)
+
+def test_copies_from_other_interfaces_dropped():
+	listener = SMAEMListener(interfaces=('192.168.1.10', '192.168.2.10'))
+	assert listener.dedup
+	received = []
+	listener.add_handler(lambda serial, em_data: received.append((serial, em_data['timestamp'])))
+	#  every telegram of two meters received on both interfaces, the copies interleaved
+	telegrams = [telegram for pair in zip(_telegrams(DEDUP_WINDOW), _telegrams(DEDUP_WINDOW, serial=SERIAL + 1)) for telegram in pair]
+	for (telegram, copy) in zip(telegrams, telegrams[2:] + telegrams[:2]):
+		listener.receive(telegram)
+		listener.receive(copy)
+	assert len(received) == 2 * DEDUP_WINDOW
+	assert sorted(received) == sorted(set(received))
+	assert listener.sequence(SERIAL).duplicates == 0
+
+def test_single_interface_without_dedup():
+	listener = SMAEMListener()
+	assert not listener.dedup
+	received = []
+	listener.add_handler(lambda serial, em_data: received.append(em_data['timestamp']))
+	telegram = _telegrams(1)[0]
+	listener.receive(telegram)
+	listener.receive(telegram)
+	#  dropped by the sequence check instead
+	assert received == [1000]
+	assert listener.sequence(SERIAL).duplicates == 1
@@ -0,0 +1,73 @@
+#  tests of smaem_metrics.py and the exposition text of smaem_exporter.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_metrics import Registry, Counter, Gauge, Histogram, TELEGRAMS_MISSED, TELEGRAM_GAPS
+from smaem_exporter import render_values
+from smaem_listener import SMAEMListener
+from smaem_capture import synthesize_telegram, synthetic_values
+
+SERIAL = 1900123456
+
+
+def _families(text):
+	#  {family: TYPE} and the names of the samples
+	types = {}
+	samples = []
+	for line in text.splitlines():
+		if line.startswith('# TYPE '):
+			(name, kind) = line[7:].split()
+			types[name] = kind
+		elif line and not line.startswith('#'):
+			samples.append(line.split('{')[0].split()[0])
+	return (types, samples)
+
+
+def test_counter_family_named_total():
+	registry = Registry()
+	counter = Counter('test_received', 'Received', registry=registry)
+	Counter('test_sent_total', 'Sent', registry=registry)
+	counter.inc()
+	counter.inc(2)
+	assert registry.render() == '# HELP test_received_total Received\n# TYPE test_received_total counter\ntest_received_total 3\n' \
+		'# HELP test_sent_total Sent\n# TYPE test_sent_total counter\ntest_sent_total 0\n'
+
+def test_samples_belong_to_their_family():
+	registry = Registry()
+	Counter('test_dropped', 'Dropped', ('reason',), registry=registry).labels('checksum').inc()
+	Gauge('test_queued', 'Queued', registry=registry).set(4)
+	Histogram('test_seconds', 'Seconds', buckets=(0.1, 1.0), registry=registry).observe(0.5)
+	(types, samples) = _families(registry.render())
+	assert types == {'test_dropped_total': 'counter', 'test_queued': 'gauge', 'test_seconds': 'histogram'}
+	for sample in samples:
+		assert sample in types or (sample.rsplit('_', 1)[0] in types and types[sample.rsplit('_', 1)[0]] == 'histogram')
+
+def test_label_values_escaped():
+	registry = Registry()
+	Gauge('test_info', 'Info', ('name',), registry=registry).labels('a"b\\c\nd').set(1)
+	assert 'test_info{name="a\\"b\\\\c\\nd"} 1' in registry.render()
+
+def test_meter_counters_named_total():
+	text = render_values({SERIAL: {'p_consume': 100.0, 'p_consume_counter': 1234.5}})
+	(types, samples) = _families(text)
+	assert types == {'smaem_active_power_consume_watts': 'gauge', 'smaem_active_energy_consume_kilowatthours_total': 'counter'}
+	assert sorted(samples) == sorted(types)
+	assert 'smaem_active_energy_consume_kilowatthours_total{serial="1900123456"} 1234.5' in text
+
+
+def test_telegrams_missed_counted_up():
+	listener = SMAEMListener()
+	missed = TELEGRAMS_MISSED.labels(SERIAL)
+	gaps = TELEGRAM_GAPS.labels(SERIAL)
+	(missed_before, gaps_before) = (missed.get(), gaps.get())
+	#  ticks in ms: 2 telegrams missed, then 1
+	for ticks in (1000, 2000, 3000, 6000, 7000, 9000):
+		listener.receive(synthesize_telegram(SERIAL, ticks, synthetic_values(ticks // 1000)))
+	assert gaps.get() - gaps_before == 2
+	assert missed.get() - missed_before == 3
+	assert listener.sequence(SERIAL).missed == 3
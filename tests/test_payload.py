@@ -0,0 +1,45 @@
+#  tests of smaem_payload.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_payload import PayloadTemplate, SEPARATORS
+
+
+def _expected(name, keys, values, extra=None):
+	document = dict(zip(keys, values))
+	document.update(extra or {})
+	return json.dumps({name: document}, separators=SEPARATORS)
+
+
+def test_render_compact():
+	keys = ['timestamp', 'serial', 'p_consume', 'freq']
+	values = ('2021-05-03T12:00:00+02:00', 1900123456, 1234.5, 49.98)
+	template = PayloadTemplate(keys, string_keys=('timestamp',))
+	assert template.render(values) == _expected('info', keys, values)
+	assert ' ' not in template.render(values).replace('12:00:00+02:00', '')
+
+def test_render_extra():
+	keys = ['serial', 'p_consume']
+	values = (1900123456, 0.0)
+	extra = {'p_consume_mean': 12.5, 'samples': 60, 'p_consume_min': None}
+	template = PayloadTemplate(keys, name='monitor')
+	assert template.render(values, extra) == _expected('monitor', keys, values, extra)
+
+def test_render_no_keys():
+	template = PayloadTemplate([])
+	assert template.render((), {'samples': 0}) == '{"info":{"samples":0}}'
+	assert template.render(()) == '{"info":{}}'
+
+def test_quoting():
+	#  % in keys and JSON escapes in string values
+	keys = ['100%', 'name']
+	values = (1, 'a "b"\n')
+	template = PayloadTemplate(keys, string_keys=('name',))
+	assert json.loads(template.render(values)) == {'info': {'100%': 1, 'name': 'a "b"\n'}}
+	assert template.render(values) == _expected('info', keys, values)
@@ -0,0 +1,173 @@
+#  tests of smaem_pipeline.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import threading
+from configparser import ConfigParser
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_pipeline import Pipeline, Sink, JSONLinesSink, UDPSink, SerialFilter, SelectChannels, Downsample, Aggregate, \
+	output_from_config, SOURCE_REPORTS, SOURCE_RAW
+
+SERIAL = 1900123456
+
+
+class ListSink(Sink):
+	#  items written, write() blocks while blocked is cleared
+	def __init__(self, name, queue_size=100, fail=False):
+		Sink.__init__(self, name, queue_size)
+		self.items = []
+		self.fail = fail
+		self.blocked = threading.Event()
+		self.blocked.set()
+
+	def write(self, serial, data):
+		self.blocked.wait()
+		if self.fail:
+			raise OSError('disk full')
+		self.items.append((serial, data))
+
+
+def _options(**options):
+	config = ConfigParser()
+	config.read_dict({'Output:test': options})
+	return config['Output:test']
+
+def _em_data(timestamp, **values):
+	values.update(serial=SERIAL, timestamp=timestamp)
+	return values
+
+
+def test_stages():
+	assert SerialFilter([1, 2])(1, {}) == {}
+	assert SerialFilter([1, 2])(3, {}) is None
+	em_data = _em_data(1000, p_consume=1.0, u1=230.0)
+	assert SelectChannels(['u1', 'freq'])(SERIAL, em_data) == {'serial': SERIAL, 'timestamp': 1000, 'u1': 230.0}
+	downsample = Downsample(5)
+	#  first telegram of every 5 s of the meter clock
+	assert [downsample(SERIAL, _em_data(ticks)) is not None for ticks in (4000, 5000, 6000, 9999, 10000, 21000)] == \
+		[True, True, False, False, True, True]
+
+def test_aggregate_stage():
+	aggregate = Aggregate(['p_consume'], ['p_consume_counter'], 2)
+	results = [aggregate(SERIAL, _em_data(ticks, p_consume=power, p_consume_counter=counter))
+		for (ticks, power, counter) in ((2000, 100.0, 10.0), (3000, 200.0, 10.1), (4000, 300.0, 10.2), (5000, 0.0, 10.3), (6000, 0.0, 10.3))]
+	#  the first telegram of an interval closes the window of the previous one
+	assert [result is not None for result in results] == [False, False, True, False, True]
+	assert results[2] == {'serial': SERIAL, 'timestamp': 4000, 'p_consume_min': 100.0, 'p_consume_max': 200.0,
+		'p_consume_mean': 150.0, 'p_consume_last': 200.0, 'p_consume_counter_delta': pytest.approx(0.1), 'samples': 2}
+	#  the next window starts at the last counter of the previous one
+	assert results[4]['p_consume_counter_delta'] == pytest.approx(0.2)
+	assert results[4]['p_consume_mean'] == 150.0
+
+
+def test_full_queue_drops_oldest():
+	sink = ListSink('test_full', queue_size=3)
+	for n in range(5):
+		sink.put(SERIAL, n)
+	assert sink.queued() == 3
+	sink.start()
+	sink.stop()
+	assert [data for (serial, data) in sink.items] == [2, 3, 4]
+	assert sink._dropped.get() == 2
+	assert sink._written.get() == 3
+
+def test_failing_sink():
+	sink = ListSink('test_failing', fail=True)
+	sink.start()
+	for n in range(3):
+		sink.put(SERIAL, n)
+	sink.stop()
+	assert sink._errors.get() == 3
+	assert not sink.is_alive()
+
+def test_slow_sink_does_not_block_the_others():
+	(slow, fast) = (ListSink('test_slow', queue_size=2), ListSink('test_fast'))
+	slow.blocked.clear()
+	pipeline = Pipeline()
+	pipeline.add(slow)
+	pipeline.add(fast)
+	pipeline.start()
+	try:
+		pipeline.process(SERIAL, _em_data(0))
+		#  the slow sink is busy with the first one
+		for n in range(100):
+			if slow.queued() == 0:
+				break
+			threading.Event().wait(0.01)
+		for n in range(1, 10):
+			pipeline.process(SERIAL, _em_data(n * 1000))
+		for n in range(100):
+			if len(fast.items) == 10:
+				break
+			threading.Event().wait(0.01)
+		assert len(fast.items) == 10
+		assert slow.items == []
+	finally:
+		slow.blocked.set()
+		pipeline.stop()
+	#  the one taken before blocking and the latest two
+	assert [data['timestamp'] for (serial, data) in slow.items] == [0, 8000, 9000]
+
+def test_routes():
+	(telegrams, reports, raw) = (ListSink('test_telegrams'), ListSink('test_reports'), ListSink('test_raw'))
+	raw.raw = True
+	pipeline = Pipeline()
+	pipeline.add(telegrams, [SerialFilter([SERIAL]), SelectChannels(['p_consume'])])
+	pipeline.add(reports, source=SOURCE_REPORTS)
+	pipeline.add(raw)
+	assert pipeline.routes[SOURCE_RAW] == [((), raw)]
+	em_data = _em_data(1000, p_consume=1.0, u1=230.0)
+	pipeline.process(SERIAL, em_data)
+	pipeline.process(SERIAL + 1, em_data)
+	pipeline.report(SERIAL, '{"info":{}}')
+	pipeline.relay(SERIAL, b'SMA\0')
+	assert [data for (serial, data) in telegrams._queue] == [{'serial': SERIAL, 'timestamp': 1000, 'p_consume': 1.0}]
+	#  the snapshot shared with the other handlers is not changed
+	assert 'u1' in em_data
+	assert list(reports._queue) == [(SERIAL, '{"info":{}}')]
+	assert list(raw._queue) == [(SERIAL, b'SMA\0')]
+
+def test_json_lines_sink(tmp_path):
+	path = str(tmp_path / 'out.jsonl')
+	sink = JSONLinesSink('test_file', path)
+	sink.open()
+	sink.start()
+	sink.put(SERIAL, {'serial': SERIAL, 'p_consume': 1.5})
+	sink.put(SERIAL, '{"info":{}}')
+	sink.stop()
+	with open(path) as out:
+		assert out.read() == '{"serial":1900123456,"p_consume":1.5}\n{"info":{}}\n'
+
+
+def test_output_from_config():
+	(sink, stages, source) = output_from_config('log', _options(type='file', path='/tmp/out.jsonl', serials='1, 2', interval_in_seconds='10', channels='p_consume'))
+	assert isinstance(sink, JSONLinesSink)
+	assert [type(stage) for stage in stages] == [SerialFilter, Downsample, SelectChannels]
+	(sink, stages, source) = output_from_config('aggregates', _options(type='file', path='/tmp/out.jsonl', interval_in_seconds='60', aggregate_channels='p_consume'))
+	assert [type(stage) for stage in stages] == [Aggregate]
+	(sink, stages, source) = output_from_config('relay', _options(type='udp', address='10.0.0.2, 10.0.0.3:9600'))
+	assert isinstance(sink, UDPSink) and source == SOURCE_RAW
+	assert sink.targets == [('10.0.0.2', 9522), ('10.0.0.3', 9600)]
+	(sink, stages, source) = output_from_config('reports', _options(type='file', path='/tmp/out.jsonl', source='reports', channels='p_consume'))
+	assert source == SOURCE_REPORTS and stages == []
+
+@pytest.mark.parametrize('options, message', [
+	(dict(type='kafka'), '"type" must be'),
+	(dict(type='file'), 'missing "path"'),
+	(dict(type='file', path='/tmp/out.jsonl', queue_size='0'), 'queue_size'),
+	(dict(type='file', path='/tmp/out.jsonl', source='raw'), '"source" must be'),
+	(dict(type='file', path='/tmp/out.jsonl', channels='power'), 'invalid channel'),
+	(dict(type='file', path='/tmp/out.jsonl', interval_in_seconds='-1'), 'must not be negative'),
+	(dict(type='file', path='/tmp/out.jsonl', aggregate_channels='p_consume'), 'requires "interval_in_seconds"'),
+	(dict(type='udp'), 'missing "address"'),
+	(dict(type='udp', address='10.0.0.2', batch_size_in_bytes='100'), 'batch_size_in_bytes'),
+])
+def test_output_from_config_errors(options, message):
+	with pytest.raises(ValueError, match=message):
+		output_from_config('test', _options(**options))
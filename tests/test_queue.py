@@ -0,0 +1,66 @@
+#  tests of smaem_queue.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_queue import OfflineQueue
+
+TOPIC = 'home/nodes/sensor/smaem/1900123456'
+
+
+def _fill(queue, start, end):
+	for n in range(start, end):
+		queue.put(TOPIC, '{{"n":{}}}'.format(n).encode(), 1, False)
+
+
+def _numbers(rows):
+	return [int(payload[5:-1]) for (rowid, topic, payload, qos, retain) in rows]
+
+
+def test_replay_order():
+	queue = OfflineQueue(':memory:')
+	_fill(queue, 0, 10)
+	assert queue.count == 10
+	rows = queue.peek(4)
+	assert _numbers(rows) == [0, 1, 2, 3]
+	assert rows[0][1:] == (TOPIC, b'{"n":0}', 1, 0)
+	#  the next batch starts after the last row sent, the rows in flight stay stored
+	assert _numbers(queue.peek(4, rows[-1][0])) == [4, 5, 6, 7]
+	assert queue.count == 10
+
+def test_delete_acknowledged():
+	queue = OfflineQueue(':memory:')
+	_fill(queue, 0, 5)
+	rows = queue.peek(5)
+	#  acknowledged out of order
+	queue.delete([rows[3][0], rows[1][0]])
+	queue.delete([])
+	assert queue.count == 3
+	assert _numbers(queue.peek(10)) == [0, 2, 4]
+	#  deleted again, e.g. dropped by the ring buffer meanwhile: the count stays right
+	queue.delete([rows[3][0]])
+	assert queue.count == 3
+
+def test_ring_buffer_drops_oldest():
+	queue = OfflineQueue(':memory:', max_messages=5)
+	_fill(queue, 0, 8)
+	assert queue.count == 5
+	assert queue.dropped == 3
+	assert _numbers(queue.peek(10)) == [3, 4, 5, 6, 7]
+
+def test_persistent(tmp_path):
+	path = str(tmp_path / 'queue.db')
+	queue = OfflineQueue(path)
+	_fill(queue, 0, 3)
+	queue.delete([queue.peek(1)[0][0]])
+	queue.close()
+	#  restarted: the unsent messages are replayed first, new ones after them
+	queue = OfflineQueue(path)
+	assert queue.count == 2
+	_fill(queue, 3, 4)
+	assert _numbers(queue.peek(10)) == [1, 2, 3]
+	queue.close()
@@ -0,0 +1,92 @@
+#  tests of smaem_recorder.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import math
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_recorder import Recorder, query, RAW_MISSING
+
+SERIAL = 1900123456
+CHANNELS = ['p_consume', 'p_consume_counter', 'freq']
+#  two records before and two after local midnight
+MIDNIGHT = datetime(2021, 5, 3).timestamp() + 86400
+TIMES = [MIDNIGHT - 2, MIDNIGHT - 1, MIDNIGHT, MIDNIGHT + 1]
+
+
+def _is_nan(value):
+	return isinstance(value, float) and math.isnan(value)
+
+def _days(path):
+	return sorted(os.listdir(os.path.join(str(path), str(SERIAL))))
+
+
+def test_record_telegram_day_rollover(tmp_path):
+	recorder = Recorder(str(tmp_path), CHANNELS)
+	for (n, timestamp) in enumerate(TIMES):
+		recorder.record_telegram(SERIAL, {'p_consume': 100.0 + n, 'p_consume_counter': 5.5 + n, 'freq': 50.0}, timestamp)
+	recorder.flush()
+	assert _days(tmp_path) == ['2021-05-03', '2021-05-04']
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1] + 1)
+	assert result['time'] == TIMES
+	assert result['p_consume'] == [100.0, 101.0, 102.0, 103.0]
+	assert result['p_consume_counter'] == [5.5, 6.5, 7.5, 8.5]
+	assert result['freq'] == [50.0] * 4
+	#  range within one day, raw values
+	result = query(str(tmp_path), SERIAL, TIMES[1], TIMES[2] + 0.5, channels=['p_consume'], scaled=False)
+	assert result == {'time': TIMES[1:3], 'p_consume': [1010, 1020]}
+
+def test_record_telegram_missing_channel(tmp_path):
+	#  the first telegram lacks freq (firmware 1.x), the column is declared anyway
+	recorder = Recorder(str(tmp_path), CHANNELS)
+	recorder.record_telegram(SERIAL, {'p_consume': 100.0, 'p_consume_counter': 5.0}, TIMES[0])
+	recorder.record_telegram(SERIAL, {'p_consume': 101.0, 'p_consume_counter': 6.0, 'freq': 50.0}, TIMES[1])
+	recorder.flush()
+	assert os.path.exists(os.path.join(str(tmp_path), str(SERIAL), '2021-05-03', 'freq.I'))
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1])
+	assert _is_nan(result['freq'][0]) and result['freq'][1] == 50.0
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1], scaled=False)
+	assert _is_nan(result['freq'][0]) and result['freq'][1] == 50000
+	#  stored as RAW_MISSING
+	with open(os.path.join(str(tmp_path), str(SERIAL), '2021-05-03', 'freq.I'), 'rb') as column_file:
+		assert column_file.read(4) == RAW_MISSING['I'].to_bytes(4, sys.byteorder)
+
+def test_query_column_missing_on_a_day(tmp_path):
+	#  p_consume is recorded on the first day only, freq from the second day on
+	recorder = Recorder(str(tmp_path), ['p_consume'])
+	for timestamp in TIMES[:2]:
+		recorder.record_telegram(SERIAL, {'p_consume': 100.0, 'freq': 50.0}, timestamp)
+	recorder.flush()
+	recorder = Recorder(str(tmp_path), ['freq'])
+	for timestamp in TIMES[2:]:
+		recorder.record_telegram(SERIAL, {'p_consume': 100.0, 'freq': 50.0}, timestamp)
+	recorder.flush()
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1] + 1)
+	assert result['time'] == TIMES
+	assert result['p_consume'][:2] == [100.0, 100.0] and all(_is_nan(value) for value in result['p_consume'][2:])
+	assert all(_is_nan(value) for value in result['freq'][:2]) and result['freq'][2:] == [50.0, 50.0]
+	#  channels asked for, also one never recorded
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1] + 1, channels=['freq', 'u1'])
+	assert sorted(result) == ['freq', 'time', 'u1']
+	assert result['freq'][2:] == [50.0, 50.0]
+	assert len(result['u1']) == 4 and all(_is_nan(value) for value in result['u1'])
+
+
+def test_record_values_declared_columns(tmp_path):
+	names = ['p_consume_mean', 'p_consume_counter_energy', 'samples']
+	recorder = Recorder(str(tmp_path), CHANNELS, names)
+	#  the first report of a run has no energy yet
+	recorder.record(SERIAL, TIMES[0], {'samples': 0})
+	recorder.record(SERIAL, TIMES[1], {'p_consume_mean': 100.5, 'p_consume_counter_energy': 1.25, 'samples': 5, 'other': 1.0})
+	recorder.record(SERIAL, TIMES[2], {'p_consume_mean': 99.5, 'samples': 5})
+	recorder.flush()
+	assert _days(tmp_path) == ['2021-05-03', '2021-05-04']
+	result = query(str(tmp_path), SERIAL, TIMES[0], TIMES[-1])
+	assert sorted(result) == sorted(names + ['time'])
+	assert result['samples'] == [0.0, 5.0, 5.0]
+	assert _is_nan(result['p_consume_mean'][0]) and result['p_consume_mean'][1:] == [100.5, 99.5]
+	assert [_is_nan(value) for value in result['p_consume_counter_energy']] == [True, False, True]
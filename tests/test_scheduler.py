@@ -0,0 +1,129 @@
+#  tests of smaem_scheduler.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import threading
+from time import time, sleep, monotonic
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_scheduler import Scheduler, Job, first_deadline, next_deadline, OVERLAP_SKIP, OVERLAP_COALESCE
+
+
+class Runs:
+	#  start and end (monotonic) of every run of a job, and the most runs at the same time
+	def __init__(self, seconds=0.0):
+		self.__name__ = 'runs'
+		self.seconds = seconds
+		self.runs = []
+		self.active = 0
+		self.max_active = 0
+		self._lock = threading.Lock()
+
+	def __call__(self, *args):
+		with self._lock:
+			self.active += 1
+			self.max_active = max(self.max_active, self.active)
+		start = monotonic()
+		sleep(self.seconds)
+		with self._lock:
+			self.active -= 1
+			self.runs.append((start, monotonic()))
+
+
+@pytest.fixture
+def scheduler():
+	scheduler = Scheduler(workers=2)
+	scheduler.start()
+	yield scheduler
+	scheduler.stop()
+
+
+def test_first_deadline():
+	assert first_deadline(60, now=1000.5) == 1020.0
+	assert first_deadline(60, align=False, now=1000.5) == 1060.5
+	assert first_deadline(60, run_now=True, now=1000.5) == 1000.5
+
+def test_next_deadline_is_drift_free():
+	job = Job('job', 10, None, (), OVERLAP_SKIP)
+	job.deadline = 1000.0
+	#  late run: the grid is kept
+	assert next_deadline(job, now=1003.0) == 1010.0
+	#  ticks missed while blocked are skipped, not run in a burst
+	assert next_deadline(job, now=1035.0) == 1040.0
+
+
+def test_skip(scheduler):
+	runs = Runs(0.12)
+	job = scheduler.every(0.05, runs, align=False, overlap=OVERLAP_SKIP)
+	sleep(0.6)
+	job.cancel()
+	sleep(0.2)
+	assert runs.max_active == 1
+	assert job.skipped >= 4
+	#  a skipped tick is not run later: the runs start on the grid, with gaps
+	gaps = [start - end for ((_, end), (start, _)) in zip(runs.runs, runs.runs[1:])]
+	assert gaps and min(gaps) > 0.01
+
+def test_coalesce(scheduler):
+	runs = Runs(0.12)
+	job = scheduler.every(0.05, runs, align=False, overlap=OVERLAP_COALESCE)
+	sleep(0.6)
+	job.cancel()
+	sleep(0.2)
+	assert runs.max_active == 1
+	assert len(runs.runs) >= 3
+	#  the ticks during a run are coalesced into one run right after it
+	gaps = [start - end for ((_, end), (start, _)) in zip(runs.runs, runs.runs[1:])]
+	assert max(gaps) < 0.03
+
+def test_cancel_drops_pending_run(scheduler):
+	runs = Runs(0.2)
+	job = scheduler.every(0.05, runs, align=False, overlap=OVERLAP_COALESCE)
+	#  first run from 0.05 to 0.25, the tick at 0.1 is pending
+	sleep(0.15)
+	assert job.running and job.pending
+	job.cancel()
+	sleep(0.4)
+	assert len(runs.runs) == 1
+	assert not job.running
+
+def test_cancel_before_first_run(scheduler):
+	runs = Runs()
+	job = scheduler.every(0.05, runs, align=False)
+	job.cancel()
+	sleep(0.2)
+	assert runs.runs == []
+
+def test_submit_burst_does_not_skip_jobs():
+	scheduler = Scheduler(workers=1, queue_size=2, task_workers=1, task_queue_size=4)
+	scheduler.start()
+	try:
+		runs = Runs()
+		job = scheduler.every(0.05, runs, align=False)
+		tasks = Runs(0.05)
+		accepted = [scheduler.submit(tasks) for n in range(50)]
+		sleep(0.5)
+		job.cancel()
+		#  the task queue is full after a few, the periodic job runs on every tick
+		assert accepted.count(True) <= 5
+		assert job.skipped == 0
+		assert len(runs.runs) >= 8
+	finally:
+		scheduler.stop()
+
+def test_failing_job_keeps_running(scheduler):
+	calls = []
+	def failing():
+		calls.append(time())
+		raise RuntimeError('broker gone')
+	job = scheduler.every(0.05, failing, align=False)
+	sleep(0.3)
+	job.cancel()
+	sleep(0.1)
+	assert len(calls) >= 3
+	assert not job.running
@@ -0,0 +1,92 @@
+#  tests of smaem_shm.py
+#
+#  run from the directory of sma-em.py:  python3 -m pytest tests
+
+import os
+import sys
+import math
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smaem_shm import SnapshotWriter, SnapshotReader, HEADER_SIZE, SLOT_SIZE, shm_size
+
+SERIAL = 1900123456
+
+
+@pytest.fixture
+def path(tmp_path):
+	return str(tmp_path / 'sma-em')
+
+
+def test_roundtrip(path):
+	writer = SnapshotWriter(path, slots=2)
+	reader = SnapshotReader(path)
+	assert reader.serials() == []
+	assert reader.read(SERIAL) is None
+	assert math.isnan(reader.value(SERIAL, 'p_consume'))
+	writer.update(SERIAL, {'timestamp': 1000, 'p_consume': 1234.5, 'u1': 230.1, 'speedwire_version': '2.3.4.R'})
+	snapshot = reader.read(SERIAL)
+	assert snapshot['serial'] == SERIAL and snapshot['timestamp'] == 1000
+	assert snapshot['p_consume'] == 1234.5 and snapshot['u1'] == 230.1
+	assert 'speedwire_version' not in snapshot
+	#  the next telegram replaces the values in the same slot
+	writer.update(SERIAL, {'timestamp': 2000, 'p_consume': 100.0})
+	assert reader.value(SERIAL, 'p_consume') == 100.0
+	assert reader.read(SERIAL)['timestamp'] == 2000
+	assert reader.serials() == [SERIAL]
+	reader.close()
+	writer.close()
+
+def test_channels_not_sent_are_nan(path):
+	writer = SnapshotWriter(path)
+	reader = SnapshotReader(path)
+	#  no freq with firmware 1.x
+	writer.update(SERIAL, {'timestamp': 1000, 'p_consume': 1.0})
+	assert math.isnan(reader.value(SERIAL, 'freq'))
+	assert 'freq' not in reader.read(SERIAL)
+	writer.update(SERIAL, {'timestamp': 2000, 'p_consume': 1.0, 'freq': 50.0})
+	writer.update(SERIAL, {'timestamp': 3000, 'p_consume': 1.0})
+	assert 'freq' not in reader.read(SERIAL)
+
+def test_more_meters_than_slots(path):
+	writer = SnapshotWriter(path, slots=2)
+	reader = SnapshotReader(path)
+	for serial in (1, 2, 3):
+		writer.update(serial, {'timestamp': 1000, 'p_consume': float(serial)})
+	assert reader.serials() == [1, 2]
+	assert reader.read(3) is None
+	assert reader.value(2, 'p_consume') == 2.0
+
+def test_reader_started_before_the_writer(path):
+	SnapshotWriter(path, slots=2).close()
+	reader = SnapshotReader(path)
+	#  daemon restarted: the file is reused, the reader keeps its mapping
+	writer = SnapshotWriter(path, slots=2)
+	assert os.path.getsize(path) == shm_size(2)
+	writer.update(SERIAL, {'timestamp': 1000, 'p_consume': 1.0})
+	assert reader.value(SERIAL, 'p_consume') == 1.0
+
+def test_slot_locked_by_a_dead_writer(path):
+	writer = SnapshotWriter(path, slots=1)
+	writer.update(SERIAL, {'timestamp': 1000, 'p_consume': 1.0})
+	reader = SnapshotReader(path)
+	#  writer died with an odd sequence
+	struct.pack_into('<I', writer._map, HEADER_SIZE, 3)
+	with pytest.raises(TimeoutError):
+		reader.read(SERIAL)
+
+@pytest.mark.parametrize('content', [
+	b'',
+	b'SMAEMSHM',
+	b'NOTSMAEM' + bytes(HEADER_SIZE + SLOT_SIZE - 8),
+	struct.pack('<8sHHHHI', b'SMAEMSHM', 2, 1, 0, 0, 0) + bytes(HEADER_SIZE + SLOT_SIZE - 20),
+	struct.pack('<8sHHHHI', b'SMAEMSHM', 1, 1, 3, SLOT_SIZE, 0) + bytes(HEADER_SIZE + SLOT_SIZE - 20),
+])
+def test_bad_file(path, content):
+	with open(path, 'wb') as shm_file:
+		shm_file.write(content)
+	with pytest.raises(ValueError):
+		SnapshotReader(path)
@@ -3,50 +3,217 @@
 *  ----------------------------------------------------------------------------
 *  Set of auxiliary functions used in smaller and larger projects
 *
-*  print_line:	
+*  log:         leveled logging facade, e.g. log.debug('payload: {}', payload)
+*               the message is only formatted if the level is enabled, the
+*               methods of disabled levels are bound to a function doing
+*               nothing, log.setup() configures levels and sinks
+*  print_line:	print one line to the console (and the file sink of log)
+*
+*  Under systemd (stdout connected to the journal) lines are written with a
+*  syslog priority prefix (e.g. "<4>") instead of ANSI colors and timestamps.
 *
 *  2021-May-03
-*  ---------------------------------------------------------------------------- 
+*  ----------------------------------------------------------------------------
 """
 #  load necessary libraries
-from colorama import init as colorama_init
-from colorama import Fore, Back, Style
-from time import localtime, strftime
+from colorama import Fore, Style
+from time import time, localtime, strftime
 from unidecode import unidecode
+import os
+import sys
+import threading
 import sdnotify
 
 #  systemd service notifications - https://github.com/bb4242/sdnotify
 sd_notifier = sdnotify.SystemdNotifier()
 
+#  log levels, their syslog priorities and console colors
+LOG_ERROR = 0
+LOG_WARNING = 1
+LOG_INFO = 2
+LOG_VERBOSE = 3
+LOG_DEBUG = 4
+
+_priorities = ('<3>', '<4>', '<6>', '<6>', '<7>')
+_colors = (Fore.RED + Style.BRIGHT + '[{}] ' + Style.RESET_ALL,
+	Fore.YELLOW + '[{}] ' + Style.RESET_ALL,
+	Fore.GREEN + '[{}] ' + Style.RESET_ALL,
+	Fore.GREEN + '[{}] ' + Fore.YELLOW + '- ',
+	Fore.CYAN + '[{}] ' + '- (DBG): ')
+_plain = ('[{}] ERROR: ', '[{}] WARNING: ', '[{}] ', '[{}] - ', '[{}] - (DBG): ')
+
+
+def journal_connected(stream=sys.stdout):
+	#  systemd sets JOURNAL_STREAM to "<device>:<inode>" of the journal stream
+	journal_stream = os.environ.get('JOURNAL_STREAM')
+	if not journal_stream:
+		return False
+	try:
+		stat = os.fstat(stream.fileno())
+	except (OSError, ValueError, AttributeError):
+		return False
+	return journal_stream == '{}:{}'.format(stat.st_dev, stat.st_ino)
+
+
+#  -----------------------
+#  timestamp, formatted at most once per second
+_timestamp_cache = [None, '', '']
+
+def _timestamps(now):
+	second = int(now)
+	if _timestamp_cache[0] != second:
+		t = localtime(second)
+		_timestamp_cache[:] = [second, strftime('%Y-%m-%d %H:%M:%S', t), strftime('%b %d %H:%M:%S', t)]
+	return _timestamp_cache
+
+
+class FileSink:
+	"""
+	*  Buffered log file, rotated to <path>.1 ... <path>.<backup_count> when it
+	*  grows beyond max_bytes
+	*
+	*  Lines are written when buffer_size bytes are pending, flush_interval
+	*  seconds have passed, for every error and on flush()/close().
+	"""
+	def __init__(self, path, max_bytes=1048576, backup_count=3, buffer_size=8192, flush_interval=5.0):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.buffer_size = buffer_size
+		self.flush_interval = flush_interval
+		self._lock = threading.Lock()
+		self._pending = []
+		self._pending_size = 0
+		self._last_flush = time()
+		self._file = open(path, 'a')
+		self._size = self._file.tell()
+
+	def write(self, line, now, urgent=False):
+		with self._lock:
+			self._pending.append(line)
+			self._pending_size += len(line)
+			if urgent or self._pending_size >= self.buffer_size or now - self._last_flush >= self.flush_interval:
+				self._flush(now)
+
+	def flush(self):
+		with self._lock:
+			self._flush(time())
+
+	def _flush(self, now):
+		self._last_flush = now
+		if not self._pending or self._file is None:
+			return
+		data = ''.join(self._pending)
+		self._pending = []
+		self._pending_size = 0
+		if self.max_bytes and self._size + len(data) > self.max_bytes and self._size > 0:
+			self._rotate()
+		self._file.write(data)
+		self._file.flush()
+		self._size += len(data)
+
+	def _rotate(self):
+		self._file.close()
+		for n in range(self.backup_count - 1, 0, -1):
+			if os.path.exists('{}.{}'.format(self.path, n)):
+				os.replace('{}.{}'.format(self.path, n), '{}.{}'.format(self.path, n + 1))
+		if self.backup_count > 0:
+			os.replace(self.path, self.path + '.1')
+			self._file = open(self.path, 'a')
+		else:
+			self._file = open(self.path, 'w')
+		self._size = 0
+
+	def close(self):
+		with self._lock:
+			self._flush(time())
+			self._file.close()
+			self._file = None
+
+
+def _noop(*args, **kwargs):
+	pass
+
+
+class Log:
+	"""
+	*  log.error(), log.warning(), log.info(), log.verbose(), log.debug()
+	*
+	*  all take (message, *args, sd_notify=False) and format the message with
+	*  message.format(*args) only if the level is enabled, guard expensive
+	*  arguments with "if log.debug_enabled:"
+	"""
+	def __init__(self):
+		self.file = None
+		self.setup()
+
+	def setup(self, verbose=False, debug=False, journal=None, logfile=None, max_bytes=1048576, backup_count=3):
+		if journal is None:
+			journal = journal_connected()
+		self.journal = journal
+		self.verbose_enabled = verbose
+		self.debug_enabled = debug
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		if logfile:
+			self.file = FileSink(logfile, max_bytes, backup_count)
+		self.error = self._emitter(LOG_ERROR)
+		self.warning = self._emitter(LOG_WARNING)
+		self.info = self._emitter(LOG_INFO)
+		self.verbose = self._emitter(LOG_VERBOSE) if verbose else _noop
+		self.debug = self._emitter(LOG_DEBUG) if debug else _noop
+
+	def _emitter(self, level):
+		def emit(message, *args, sd_notify=False):
+			self.write(level, message.format(*args) if args else message, sd_notify=sd_notify)
+		return emit
+
+	def write(self, level, text, console=True, sd_notify=False):
+		now = time()
+		timestamps = _timestamps(now)
+		if console:
+			stream = sys.stderr if level == LOG_ERROR else sys.stdout
+			if self.journal:
+				stream.write(_priorities[level] + text + '\n')
+			else:
+				stream.write(_colors[level].format(timestamps[1]) + text + Style.RESET_ALL + '\n')
+			if self.journal or level == LOG_ERROR:
+				stream.flush()
+		if self.file is not None:
+			self.file.write(_plain[level].format(timestamps[1]) + text + '\n', now, urgent=(level == LOG_ERROR))
+		if sd_notify:
+			sd_notifier.notify('STATUS={} - {}.'.format(timestamps[2], unidecode(text)))
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+log = Log()
+
+
 #  -----------------------
 #  logging function
 #  -----------------------
 def print_line(text, error=False, warning=False, info=False, verbose=False, debug=False, console=True, sd_notify=False, logfile=False):
-	timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime())
-	if console:
-		if error:
-			print(Fore.RED + Style.BRIGHT + '[{}] '.format(timestamp) + Style.RESET_ALL + text + Style.RESET_ALL, file=sys.stderr)
-		elif warning:
-			print(Fore.YELLOW + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + Style.RESET_ALL)
-		elif verbose:
-			print(Fore.GREEN + '[{}] '.format(timestamp) + Fore.YELLOW + '- ' + '{}'.format(text) + Style.RESET_ALL)
-		elif debug:
-			print(Fore.CYAN + '[{}] '.format(timestamp) + '- (DBG): ' + '{}'.format(text) + Style.RESET_ALL)
-		elif info:
-			print(Fore.GREEN + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + Style.RESET_ALL)
-			
-	if logfile:
-		if error:
-			f.write(Fore.RED + Style.BRIGHT + '[{}] '.format(timestamp) + Style.RESET_ALL + text + '\n' + Style.RESET_ALL, file=sys.stderr)
-		elif warning:
-			f.write(Fore.YELLOW + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + '\n' + Style.RESET_ALL)
-		elif verbose:
-			f.write(Fore.GREEN + '[{}] '.format(timestamp) + Fore.YELLOW + '- ' + '{}'.format(text) + '\n' + Style.RESET_ALL)
-		elif debug:
-			f.write(Fore.CYAN + '[{}] '.format(timestamp) + '- (DBG): ' + '{}'.format(text) + '\n' + Style.RESET_ALL)
-		elif info:
-			f.write(Fore.GREEN + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + '\n' + Style.RESET_ALL)
-
-	timestamp_sd = strftime('%b %d %H:%M:%S', localtime())
-	if sd_notify:
-		sd_notifier.notify('STATUS={} - {}.'.format(timestamp_sd, unidecode(text)))
+	#  level flags as before, verbose and debug usually get the option enabling
+	#  them, e.g. debug=opt_debug, lines without any level flag are not printed;
+	#  logfile is kept for compatibility, every printed line goes to the file
+	#  sink configured with log.setup()
+	if error:
+		level = LOG_ERROR
+	elif warning:
+		level = LOG_WARNING
+	elif verbose:
+		level = LOG_VERBOSE
+	elif debug:
+		level = LOG_DEBUG
+	elif info:
+		level = LOG_INFO
+	elif sd_notify:
+		sd_notifier.notify('STATUS={} - {}.'.format(_timestamps(time())[2], unidecode(text)))
+		return
+	else:
+		return
+	log.write(level, text, console, sd_notify)